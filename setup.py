@@ -8,5 +8,8 @@ setup(
 	'decorator>=5.1.1',
 	'psycopg>=3.2.1',
     ],
+    extras_require={
+	'columnar': ['numpy'],
+    },
 )
 
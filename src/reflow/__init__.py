@@ -5,7 +5,8 @@ __version__ = "0.0.1"
 #----------------------------------------------#
 
 from reflow.containers import box
-from reflow.util import get_in, upssoc_in
-from reflow.subs import subscribe, state, register_flow
+from reflow.util import Path, get_in, upssoc_in
+from reflow.subs import subscribe, unsubscribe, state, register_flow, register_sub
 from reflow.events import event
-from reflow.router import dispatch
+from reflow.router import dispatch, dispatch_batch, transaction
+from reflow.aio import AsyncRouter, dispatch_async, watch
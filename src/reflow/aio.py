@@ -0,0 +1,191 @@
+"""
+asyncio front end for the dispatch router.
+
+    async with AsyncRouter() as r:
+        await r.dispatch_async('state', ['count'], 1)
+        async for v in r.watch('var1'):
+            ...
+
+Events are processed off the event loop, on a single worker thread, so the
+loop is never blocked by handlers or flows. fx handlers that are coroutine
+functions run as tasks on the loop once state has been committed.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from reflow.containers import Box
+from reflow.registry import handler
+from reflow.router import dispatch, sync
+from reflow.subs import subscribe, unsubscribe
+
+
+# The running AsyncRouter, if any. Coroutine fx are spawned on its loop.
+current = Box(None)
+
+
+
+def _report(t, event):
+    if not t.cancelled() and (e := t.exception()):
+        handler('error', 'event_handler')(e, event, 'fx')
+
+
+
+async def _await(aw):
+    return await aw
+
+
+
+def spawn(aw, event=None):
+    """
+    Runs awaitable `aw` (typically returned by a coroutine fx handler)
+    concurrently: on the running AsyncRouter's loop, else on this thread's
+    running loop, else to completion right away. Failures are reported to
+    the event_handler error handler.
+    """
+    r = current.unbox()
+    if r is not None and r.loop is not None:
+        return r.loop.call_soon_threadsafe(r.spawn, aw, event)
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        try:
+            return asyncio.run(_await(aw))
+        except Exception as e:
+            handler('error', 'event_handler')(e, event, 'fx')
+            return
+    t = loop.create_task(_await(aw))
+    t.add_done_callback(lambda t: _report(t, event))
+
+
+
+class AsyncRouter:
+    """
+    Runs the dispatch queue as an asyncio task.
+
+    dispatch_async enqueues an event and waits until it has been processed.
+    The task drains whatever has been queued since its last run and hands it
+    to the worker thread in one go, where events go through the (synchronous)
+    router as usual.
+    """
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self.loop = None
+        self.queue = None
+        self.task = None
+        self.tasks = set()
+        self._executor = None
+
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(self.maxsize)
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='reflow-router')
+        self.task = self.loop.create_task(self._run())
+        current.reset(self)
+
+
+    async def stop(self):
+        """Processes what's queued, waits for running fx, then stops."""
+        await self.queue.join()
+        self.task.cancel()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        self._executor.shutdown()
+        current.compare_reset(self, None)
+        self.loop = None
+
+
+    async def dispatch_async(self, handler_id, qv, val):
+        fut = self.loop.create_future()
+        await self.queue.put(((handler_id, qv, val), fut))
+        await fut
+
+
+    def dispatch(self, handler_id, qv, val):
+        """Enqueues without waiting. Must be called from the loop's thread."""
+        self.queue.put_nowait(((handler_id, qv, val), None))
+
+
+    def spawn(self, aw, event=None):
+        t = self.loop.create_task(_await(aw))
+        self.tasks.add(t)
+        t.add_done_callback(self.tasks.discard)
+        t.add_done_callback(lambda t: _report(t, event))
+        return t
+
+
+    async def watch(self, id):
+        """
+        Async iterator over the values of flow `id`, starting with the
+        current value, then the latest value each time it changes. Changes
+        made while the consumer is busy are coalesced.
+        """
+        changed = asyncio.Event()
+        latest = [None]
+
+        def _set(v):
+            latest[0] = v
+            changed.set()
+
+        def on_change(v):
+            self.loop.call_soon_threadsafe(_set, v)
+
+        v = subscribe(id, on_change=on_change)
+        try:
+            yield v
+            while True:
+                await changed.wait()
+                changed.clear()
+                yield latest[0]
+        finally:
+            unsubscribe(id, on_change)
+
+
+    def _process(self, events):
+        for ev in events:
+            dispatch(*ev)
+        sync()   # another thread may be running the queue
+
+
+    async def _run(self):
+        while True:
+            items = [await self.queue.get()]
+            while not self.queue.empty():
+                items.append(self.queue.get_nowait())
+            try:
+                await self.loop.run_in_executor(
+                    self._executor, self._process, [ev for ev, _ in items])
+                for _, fut in items:
+                    if fut is not None and not fut.done():
+                        fut.set_result(None)
+            except Exception as e:
+                for _, fut in items:
+                    if fut is not None and not fut.done():
+                        fut.set_exception(e)
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+
+
+async def dispatch_async(handler_id, qv, val):
+    """dispatch_async on the running AsyncRouter."""
+    return await current.unbox().dispatch_async(handler_id, qv, val)
+
+
+
+def watch(id):
+    """watch on the running AsyncRouter."""
+    return current.unbox().watch(id)
@@ -0,0 +1,274 @@
+"""
+Benchmark suite for dispatch, the flow graph, path operations and
+subscriptions. Run with:
+
+    python -m reflow.bench [--quick] [-o results.json] [--compare old.json]
+
+Results are JSON, one record per benchmark and parameter set, so runs from
+different commits can be compared. Benchmarks run against the global
+registry, state and registered flows are restored afterwards.
+"""
+
+import contextlib
+import datetime
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import pyrsistent as pyr
+
+import reflow
+from reflow import graph
+from reflow.registry import state, handlers, flows
+from reflow.router import dispatch
+from reflow.subs import register_flow, register_sub, subscribe, sub_cache, flow
+from reflow.diff import changes
+from reflow.util import get_in, upssoc_in, dissoc_in
+
+
+benchmarks = {}   # name -> fn(quick) returning a list of results
+
+
+def bench(name):
+    def dp(f):
+        benchmarks[name] = f
+        return f
+    return dp
+
+
+
+def measure(name, fn, n, repeat=3, **params):
+    """
+    Calls fn(i) for i in range(n), `repeat` times, keeping the fastest run.
+    """
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        for i in range(n):
+            fn(i)
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return {'name': name,
+            'params': params,
+            'ops': n,
+            'seconds': best,
+            'ops_per_sec': n / best if best else None,
+            'us_per_op': best / n * 1e6}
+
+
+
+def make_state(size, depth, fanout=10):
+    """
+    A pmap of `size` leaves. The first depth-1 levels are maps of `fanout`
+    keys, the last level splits the remaining leaves evenly.
+    """
+    def _build(n, d):
+        if d == 1:
+            return pyr.pmap({i: i for i in range(n)})
+        w = min(fanout, n) or 1
+        return pyr.pmap({i: _build(max(n // w, 1), d - 1) for i in range(w)})
+    return _build(size, depth)
+
+
+
+def leaf_path(m):
+    """Path to some leaf of `m`, always following the first key."""
+    pv = []
+    while reflow.util.is_dict(m):
+        k = next(iter(m))
+        pv.append(k)
+        m = m[k]
+    return pv
+
+
+
+@contextlib.contextmanager
+def isolated():
+    """Restores state, flows and sub handlers after a benchmark."""
+    s = state.unbox()
+    fs = set(flows.unbox())
+    subs = handlers.unbox()['sub']
+    try:
+        yield
+    finally:
+        for id in set(flows.unbox()) - fs:
+            graph.drop_flow(id)
+        for id in set(handlers.unbox()['sub']) - set(subs):
+            handlers.swap(dissoc_in, ['sub', id])
+            sub_cache.discard(id)
+        state.reset(s)
+
+
+
+@bench('dispatch_state')
+def _(quick):
+    r = []
+    sizes = [1000, 10000] if quick else [1000, 10000, 100000]
+    for size in sizes:
+        for depth in (1, 3, 5):
+            with isolated():
+                state.reset(state.unbox().set('bench', make_state(size, depth)))
+                pv = ['bench'] + leaf_path(state.unbox()['bench'])
+                r.append(measure(
+                    'dispatch_state',
+                    lambda i: dispatch('state', pv, i),
+                    200 if quick else 2000, size=size, depth=depth))
+    return r
+
+
+
+@bench('dispatch_batch')
+def _(quick):
+    r = []
+    n = 1000 if quick else 10000
+    with isolated():
+        state.reset(state.unbox().set('bench', make_state(n, 2)))
+        evs = [('state', ['bench', i % 10, i], -i) for i in range(n)]
+        r.append(measure(
+            'dispatch_batch',
+            lambda i: reflow.dispatch_batch(evs), 1, events=n))
+        r[-1]['ops'] = n
+        r[-1]['ops_per_sec'] = n / r[-1]['seconds']
+        r[-1]['us_per_op'] = r[-1]['seconds'] / n * 1e6
+    return r
+
+
+
+@bench('run_graph')
+def _(quick):
+    """
+    Dispatch cost with `n` registered flows, of which `fanout` read the
+    changed leaf. The other flows read untouched paths.
+    """
+    r = []
+    counts = [10, 100, 1000] if quick else [10, 100, 1000, 5000]
+    for n in counts:
+        for fanout in (1, 10):
+            with isolated():
+                state.reset(state.unbox().set('bench', make_state(n, 1)))
+                for i in range(n):
+                    register_flow({
+                        'id': ('bench', i),
+                        'inputs': {'x': ['bench', 0 if i < fanout else i]},
+                        'output': lambda x: x})
+                dispatch('state', ['bench', 0], 0)    # run new flows
+                r.append(measure(
+                    'run_graph',
+                    lambda i: dispatch('state', ['bench', 0], i + 1),
+                    100 if quick else 1000, flows=n, fanout=fanout))
+    return r
+
+
+
+@bench('flow_chain')
+def _(quick):
+    """Dispatch cost through a chain of `n` flows, each reading the last."""
+    r = []
+    for n in ([10, 100] if quick else [10, 100, 500]):
+        with isolated():
+            register_flow({'id': ('chain', 0),
+                           'inputs': {'x': ['bench_chain']},
+                           'output': lambda x: x})
+            for i in range(1, n):
+                register_flow({'id': ('chain', i),
+                               'inputs': {'x': flow(('chain', i - 1))},
+                               'output': lambda x: x})
+            dispatch('state', ['bench_chain'], 0)
+            r.append(measure(
+                'flow_chain',
+                lambda i: dispatch('state', ['bench_chain'], i + 1),
+                50 if quick else 200, flows=n))
+    return r
+
+
+
+@bench('path_ops')
+def _(quick):
+    r = []
+    sizes = [1000, 100000] if quick else [1000, 100000, 1000000]
+    for size in sizes:
+        m = make_state(size, 5)
+        pv = leaf_path(m)
+        n = 2000 if quick else 20000
+        r.append(measure('upssoc_in', lambda i: upssoc_in(m, pv, i), n,
+                         size=size, depth=len(pv)))
+        r.append(measure('get_in', lambda i: get_in(m, pv), n,
+                         size=size, depth=len(pv)))
+        m2 = upssoc_in(m, pv, -1)
+        r.append(measure('diff', lambda i: changes(m, m2), n,
+                         size=size, depth=len(pv)))
+    return r
+
+
+
+@bench('subscribe')
+def _(quick):
+    r = []
+    n = 1000 if quick else 10000
+    with isolated():
+        state.reset(state.unbox().set('bench', make_state(n, 1)))
+        register_flow({'id': 'bench_flow',
+                       'inputs': {'x': ['bench', 0]},
+                       'output': lambda x: x})
+        dispatch('state', ['bench', 0], 0)
+        r.append(measure('subscribe_flow', lambda i: subscribe('bench_flow'),
+                         n * 10))
+
+        register_sub('bench_item',
+                     lambda qry_v: ['bench', qry_v[0]],
+                     lambda x: x)
+        sub_cache.clear()
+        r.append(measure('subscribe_param_miss',
+                         lambda i: subscribe('bench_item', i), n, repeat=1))
+        r.append(measure('subscribe_param_hit',
+                         lambda i: subscribe('bench_item', i % n), n * 10))
+    return r
+
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(__file__),
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+
+def run(names=None, quick=False):
+    results = []
+    for name, f in benchmarks.items():
+        if names and name not in names:
+            continue
+        results.extend(f(quick))
+    return {'meta': {'reflow': reflow.__version__,
+                     'commit': git_commit(),
+                     'python': sys.version.split()[0],
+                     'platform': platform.platform(),
+                     'time': datetime.datetime.now().isoformat(),
+                     'quick': quick},
+            'results': results}
+
+
+
+def key(r):
+    return (r['name'], tuple(sorted(r['params'].items())))
+
+
+
+def compare(old, new):
+    """
+    Rows of (name, params, old us/op, new us/op, new/old) for the results
+    found in both runs.
+    """
+    o = {key(r): r for r in old['results']}
+    rows = []
+    for r in new['results']:
+        if (p := o.get(key(r))) is not None:
+            rows.append((r['name'], r['params'], p['us_per_op'],
+                         r['us_per_op'], r['us_per_op'] / p['us_per_op']))
+    return rows
@@ -0,0 +1,39 @@
+import argparse
+import contextlib
+import json
+import sys
+
+from reflow.bench import benchmarks, run, compare
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(
+        prog='python -m reflow.bench',
+        description='Benchmark dispatch, flows, path ops and subscriptions.')
+    p.add_argument('names', nargs='*',
+                   help='benchmarks to run: ' + ', '.join(benchmarks))
+    p.add_argument('--quick', action='store_true',
+                   help='smaller sizes and fewer iterations')
+    p.add_argument('-o', '--output', help='write JSON results to this file')
+    p.add_argument('--compare', help='JSON results of an earlier run')
+    args = p.parse_args(argv)
+
+    with contextlib.redirect_stdout(sys.stderr):   # keep stdout for JSON
+        results = run(args.names, args.quick)
+    out = json.dumps(results, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out)
+    else:
+        print(out)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        for name, params, o, n, ratio in compare(old, results):
+            print(f"{name:24} {str(params):40} {o:10.2f}us {n:10.2f}us {ratio:6.2f}x",
+                  file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Cached coeffect providers.
+
+    @cofx.provider('now', ttl=0.01)
+    def now():
+        return time.time()
+
+    @cofx.provider('config', version=lambda: config_version)
+    def config():
+        return load_config()
+
+    register_handler('cofx', 'now', now)
+    ... inject_cofx('now') ...
+
+A provider computes a coeffect value, which its cofx handler sets in the
+event's coeffects under `key`. The value is cached, per inject_cofx val,
+and recomputed only once it has expired:
+
+    ttl:     seconds the value stays valid
+    version: fn returning a version (a counter, a timestamp...), the value
+             stays valid while the version is unchanged. per_run recomputes
+             it once per run of the router, i.e. per batch of queued events.
+
+With both, the value expires when either does. With neither it is cached
+until invalidated.
+"""
+
+import threading
+import time
+
+from reflow import router
+from reflow.util import nargs
+
+
+
+def per_run():
+    """Version fn changing with every run of the router's queue."""
+    return router.runs
+
+
+
+class _Entry:
+    __slots__ = ('value', 'version', 'time')
+
+
+
+class Provider:
+    """
+    A cached coeffect, usable as a cofx handler: provider(cofx, val=None)
+    returns cofx with the value set under `key`. fn takes val if it takes
+    an argument. Vals that aren't hashable are never cached.
+    """
+
+    def __init__(self, key, fn, ttl=None, version=None):
+        self.key = key
+        self.fn = fn
+        self.ttl = ttl
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.entries = {}   # val -> _Entry
+        self._nargs = nargs(fn)
+        self._lock = threading.Lock()
+
+
+    def __repr__(self):  # pragma: no cover
+        return f"Provider({self.key!r})"
+
+
+    def __call__(self, cofx, val=None):
+        return cofx.set(self.key, self.value(val))
+
+
+    def value(self, val=None):
+        v = self.version() if self.version is not None else None
+        now = time.monotonic() if self.ttl is not None else None
+        try:
+            e = self.entries.get(val)
+        except TypeError:   # unhashable, not cached
+            return self._compute(val)
+        if e is not None \
+                and (self.version is None or e.version is v or e.version == v) \
+                and (self.ttl is None or now - e.time < self.ttl):
+            self.hits += 1
+            return e.value
+        e = _Entry()
+        e.value, e.version, e.time = self._compute(val), v, now
+        with self._lock:
+            self.entries[val] = e
+        return e.value
+
+
+    def _compute(self, val):
+        self.misses += 1
+        return self.fn(val) if self._nargs else self.fn()
+
+
+    def invalidate(self, val=None, all=False):
+        """Drops the value cached for `val`, or every value."""
+        with self._lock:
+            if all:
+                self.entries.clear()
+            else:
+                self.entries.pop(val, None)
+
+
+    def stats(self):
+        return {'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+
+def provider(key, ttl=None, version=None):
+    """Decorator making fn a cached Provider of coeffect `key`."""
+    def dp(fn):
+        return Provider(key, fn, ttl=ttl, version=version)
+    return dp
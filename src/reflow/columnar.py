@@ -0,0 +1,244 @@
+"""
+Columnar state regions: numeric series held as NumPy arrays (requires numpy).
+
+    columnar.mount(['prices'], np.zeros(1000000))
+    dispatch('state', ['prices', 42], 101.5)             # one element
+    dispatch('state', ['prices', range(0, 10)], 0.0)     # a range
+    dispatch('region', ['prices'], [(42, 101.5), (range(0, 10), 0.0)])
+
+    register_flow({
+        'id': 'mean_price',
+        'vectorized': True,
+        'inputs': {'p': ['prices']},
+        'output': lambda p: float(p.mean())})
+
+A Region sits in state like any other value, and paths continue into it:
+an int, slice or range key (or several, one per axis) addresses elements
+of its array. Flow paths can use any of these keys.
+
+Its array is read only. Writing to it makes a new Region, leaving the old
+one, and the states holding it, untouched. The array is held in chunks of
+rows and a write copies only the chunks it touches, so writing an element
+costs a chunk (4096 rows by default), not the array. The whole array is
+joined from the chunks when a flow or subscriber reads it, once per
+version, so many element writes are best sent as one 'region' event (or
+one batch): flows then run, and the array is joined, once for all of them.
+
+Each Region has a version, new with every write, and two Regions are equal
+if they have the same version, so state diffs and graph.run see whether a
+region has changed without comparing elements. Reading a range gives a
+Region sharing its parent's version.
+
+Vectorized flows get the arrays of Region inputs rather than the Regions,
+and an array output is stored as a Region.
+"""
+
+import itertools
+
+try:
+    import numpy as np
+except ImportError:   # pragma: no cover
+    np = None
+
+
+_versions = itertools.count(1)
+
+
+
+def _key(k):
+    return slice(k.start, k.stop, k.step) if isinstance(k, range) else k
+
+
+
+def _index(keys):
+    if len(keys) == 1:
+        return _key(keys[0])
+    return tuple(_key(k) for k in keys)
+
+
+
+class Region:
+    """
+    Read only array, by copy of `data` unless `copy` is False. The version
+    is assigned unless given.
+
+    Stored as chunks of `chunk` rows (first axis). A write copies only the
+    chunks it touches, the others are shared with the Region written to. The
+    whole array is joined from the chunks when first read, once per version.
+    """
+    __slots__ = ('version', 'chunk', '_array', '_chunks', '_len')
+
+    def __init__(self, data, dtype=None, copy=True, version=None,
+                 chunk=4096):
+        if np is None:
+            raise ImportError('columnar regions require numpy')
+        a = np.array(data, dtype=dtype) if copy else np.asarray(data, dtype)
+        a.flags.writeable = False
+        self.version = next(_versions) if version is None else version
+        self.chunk = chunk
+        self._array = a
+        self._chunks = None
+        self._len = len(a) if a.ndim else 0
+
+
+    @classmethod
+    def _of_chunks(cls, chunks, n, chunk):
+        r = object.__new__(cls)
+        r.version = next(_versions)
+        r.chunk = chunk
+        r._array = None
+        r._chunks = chunks
+        r._len = n
+        return r
+
+
+    def __repr__(self):  # pragma: no cover
+        return f"Region(v{self.version}, {self.array!r})"
+
+
+    def __len__(self):
+        return self._len
+
+
+    def __iter__(self):
+        return iter(self.array)
+
+
+    def __array__(self, dtype=None, copy=None):
+        return self.array if dtype is None else self.array.astype(dtype)
+
+
+    def __eq__(self, other):
+        return self is other or (
+            type(other) is Region and self.version == other.version)
+
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+    __hash__ = None
+
+
+    @property
+    def array(self):
+        if (a := self._array) is None:
+            a = np.concatenate(self._chunks)
+            a.flags.writeable = False
+            self._array = a
+        return a
+
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+
+    @property
+    def dtype(self):
+        return (self._chunks[0] if self._array is None else self._array).dtype
+
+
+    def _split(self):
+        if self._chunks is None:
+            a, c = self._array, self.chunk
+            self._chunks = tuple(a[i:i + c] for i in range(0, len(a), c))
+        return self._chunks
+
+
+    def _row(self, i):
+        # index of row `i`, IndexError if out of bounds
+        if not -self._len <= i < self._len:
+            raise IndexError(f"index {i} is out of bounds for size {self._len}")
+        return i + self._len if i < 0 else i
+
+
+    def __getitem__(self, k):
+        try:
+            if self._array is None and isinstance(k, (int, np.integer)):
+                i = self._row(k)
+                x = self._chunks[i // self.chunk][i % self.chunk]
+            else:
+                x = self.array[_key(k)]
+        except IndexError as e:
+            raise KeyError(k) from e
+        if isinstance(x, np.ndarray):
+            return Region(x, copy=False, version=(self.version, k))
+        return x
+
+
+    def set_in(self, keys, v):
+        """New Region with the elements at path `keys` set to `v`."""
+        return self.update([(keys, v)])
+
+
+    def update(self, writes):
+        """
+        New Region with `writes` applied in order, each (index, value), the
+        index a key or a sequence of keys (one per axis). Only the chunks
+        written to are copied, unless a write indexes rows with something
+        other than an int, slice or range, which copies the whole array.
+        """
+        if self._len == 0:   # empty or 0-d
+            return self._update_all(writes)
+        chunks = list(self._split())
+        copied = set()
+        c = self.chunk
+
+        def _chunk(j):
+            if j not in copied:
+                chunks[j] = chunks[j].copy()
+                copied.add(j)
+            return chunks[j]
+
+        for k, v in writes:
+            ks = tuple(map(_key, k if isinstance(k, (list, tuple)) else (k,)))
+            first, rest = ks[0], ks[1:]
+            if isinstance(first, (int, np.integer)):
+                i = self._row(first)
+                _chunk(i // c)[(i % c,) + rest] = v
+            elif isinstance(first, slice):
+                rows = np.arange(self._len)[first]
+                trail = chunks[0][(slice(0, 1),) + rest].shape[1:]
+                vs = np.broadcast_to(np.asarray(v), (len(rows),) + trail)
+                for j in np.unique(rows // c):
+                    m = rows // c == j
+                    _chunk(j)[(rows[m] % c,) + rest] = vs[m]
+            else:
+                return self._update_all(writes)
+        for j in copied:
+            chunks[j].flags.writeable = False
+        return Region._of_chunks(tuple(chunks), self._len, c)
+
+
+    def _update_all(self, writes):
+        a = self.array.copy()
+        for k, v in writes:
+            a[_index(k if isinstance(k, (list, tuple)) else (k,))] = v
+        return Region(a, copy=False, chunk=self.chunk)
+
+
+
+def is_region(x):
+    return type(x) is Region
+
+
+
+def as_region(x):
+    """`x` as a Region if it is an array, without copying it."""
+    if np is not None and isinstance(x, np.ndarray):
+        return Region(x, copy=False)
+    return x
+
+
+
+def arrays(inputs):
+    """Inputs map with Regions replaced by their arrays."""
+    return {n: v.array if type(v) is Region else v for n, v in inputs.items()}
+
+
+
+def mount(pv, data, dtype=None):
+    """Sets a Region of `data` at path `pv` in state."""
+    from reflow.router import dispatch
+    dispatch('state', pv, Region(data, dtype=dtype))
@@ -1,5 +1,9 @@
+import collections
 import threading
+import time
 import pyrsistent as pyr
+from reflow import instrument
+from reflow.exceptions import QueueFullError
 
 """
 Lisp-like container classes
@@ -22,6 +26,10 @@ class Box:
 
     def __init__(self, x=None):
         self.x = x
+        self._lock = threading.Lock()
+        self.swaps = 0
+        self.retries = 0
+        self.max_retries = 0
 
 
     def __repr__(self):  # pragma: no cover
@@ -45,7 +53,7 @@ class Box:
 
 
     def set(self, x):
-        with threading.Lock():
+        with self._lock:
             self.x = x
             return x
 
@@ -56,8 +64,7 @@ class Box:
 
 
     def get(self):
-        with threading.Lock():
-            return self.x
+        return self.x   # reading a reference is atomic, no lock needed
 
 
     def unbox(self):
@@ -66,8 +73,12 @@ class Box:
 
 
     def compare_reset(self, expectv, newv):
-        with threading.Lock():
-            if self.x == expectv:
+        """
+        Sets newv only if the current value is expectv. Compares by identity,
+        the value is immutable so identity means nothing has changed it.
+        """
+        with self._lock:
+            if self.x is expectv:
                 self.x = newv
                 return True
             return False
@@ -86,14 +97,196 @@ class Box:
         compare_and_set of the current value and new value is valid. Thus, the
         function will only ever be applied to the most current value.
 
+        Each failed compare_and_set is counted as a retry, see `stats`.
+
         NOTE: The function supplied to swap must be free from side-effects as it
         will be called multiple times where race conditions arise.
         """
+        retries = 0
         while True:
             oldv = self.get()
             newv = fn(oldv, *args, **kwargs)
             if self.compare_reset(oldv, newv):
+                self._count(retries)
                 return newv
+            retries += 1
+
+
+    def _count(self, retries):
+        # counters are approximate under contention, never worth a lock
+        self.swaps += 1
+        self.retries += retries
+        if retries > self.max_retries:
+            self.max_retries = retries
+        if retries and instrument.sink is not None:
+            instrument.sink('swap', self, retries, {})
+
+
+    def stats(self):
+        """
+        Contention counters: number of swaps, total and worst case retries.
+        """
+        return {'swaps': self.swaps,
+                'retries': self.retries,
+                'max_retries': self.max_retries}
+
+
+
+class _Marker(threading.Event):
+    pass
+
+
+
+class EventQueue:
+    """
+    FIFO queue of dispatched events: many producer threads, one consumer (the
+    thread running the router). Mutable, unlike Box: put and get are single
+    deque operations, atomic without a lock, and allocate nothing per event.
+
+    maxsize:  bound on queued events, None for unbounded. The bound is soft,
+              producers racing past the check can overshoot it by one each.
+    overflow: what put does when the queue is full
+              'block'       wait for the consumer to make room (up to
+                            `timeout` seconds, then QueueFullError)
+              'drop_oldest' drop the oldest queued event to make room
+              'reject'      raise QueueFullError
+    The consumer itself never blocks on its own queue, events it dispatches
+    while running are queued over the bound.
+    """
+
+    policies = ('block', 'drop_oldest', 'reject')
+
+    def __init__(self, maxsize=None, overflow='block', timeout=None):
+        self._q = collections.deque()
+        self._not_full = threading.Condition(threading.Lock())
+        self._waiters = 0
+        self.consumer = None    # ident of the thread running the queue
+        self.puts = 0
+        self.gets = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.blocked = 0
+        self.high_water = 0
+        self.configure(maxsize=maxsize, overflow=overflow, timeout=timeout)
+
+
+    def __repr__(self):  # pragma: no cover
+        return f"EventQueue({list(self._q)})"
+
+
+    def __len__(self):
+        return len(self._q)
+
+
+    def __iter__(self):
+        return iter(list(self._q))
+
+
+    def configure(self, **kwargs):
+        """Sets maxsize, overflow and/or timeout."""
+        for k, v in kwargs.items():
+            if k not in ('maxsize', 'overflow', 'timeout'):
+                raise KeyError(f"Unknown event queue option: {k}")
+            if k == 'overflow' and v not in self.policies:
+                raise ValueError(f"Unknown overflow policy: {v}")
+            setattr(self, k, v)
+
+
+    def put(self, x):
+        q = self._q
+        if self.maxsize is not None and len(q) >= self.maxsize \
+                and self.consumer != threading.get_ident():
+            self._overflow(x)
+        q.append(x)
+        self.puts += 1    # counters are approximate, as Box's
+        if (n := len(q)) > self.high_water:
+            self.high_water = n
+
+
+    def _overflow(self, x):
+        if (sink := instrument.sink) is not None:
+            sink('queue', self.overflow, len(self._q), {'event': x})
+        if self.overflow == 'drop_oldest':
+            while len(self._q) >= self.maxsize:
+                try:
+                    if type(x := self._q.popleft()) is _Marker:
+                        x.set()   # the events before it are gone too
+                    else:
+                        self.dropped += 1
+                except IndexError:
+                    break
+        elif self.overflow == 'reject':
+            self.rejected += 1
+            raise QueueFullError(self.maxsize)
+        else:
+            self._wait(x)
+
+
+    def _wait(self, x):
+        self.blocked += 1
+        deadline = None if self.timeout is None \
+            else time.monotonic() + self.timeout
+        with self._not_full:
+            self._waiters += 1
+            try:
+                while len(self._q) >= self.maxsize:
+                    left = None if deadline is None \
+                        else deadline - time.monotonic()
+                    if left is not None and left <= 0:
+                        self.rejected += 1
+                        raise QueueFullError(self.maxsize)
+                    self._not_full.wait(left)
+            finally:
+                self._waiters -= 1
+
+
+    def clear(self):
+        """
+        Drops every queued event and marker, as a new queue would have. For a
+        forked process, whose copy of the queue has no producers or consumer.
+        """
+        self._q.clear()
+        self._not_full = threading.Condition(threading.Lock())
+        self._waiters = 0
+        self.consumer = None
+
+
+    def mark(self):
+        """
+        Queues a marker, returned: a threading.Event set when the consumer
+        gets to it. The consumer processes an event before getting the next,
+        so by then every event queued before the marker has been processed.
+        Markers don't count towards maxsize.
+        """
+        m = _Marker()
+        self._q.append(m)
+        return m
+
+
+    def get(self):
+        """The oldest event, removed from the queue. None if empty."""
+        try:
+            while type(x := self._q.popleft()) is _Marker:
+                x.set()
+        except IndexError:
+            return None
+        self.gets += 1
+        if self._waiters:
+            with self._not_full:
+                self._not_full.notify()
+        return x
+
+
+    def stats(self):
+        """Current depth, high water mark, and event counters."""
+        return {'depth': len(self._q),
+                'high_water': self.high_water,
+                'maxsize': self.maxsize,
+                'puts': self.puts,
+                'gets': self.gets,
+                'dropped': self.dropped,
+                'rejected': self.rejected,
+                'blocked': self.blocked}
 
 
 
@@ -117,7 +310,7 @@ def reset(b,v):
 
 def compare_reset(b, oldv, newv):
     """Functional alias for box.compare_reset()"""
-    return b.compare_reset(b, oldv, newv)
+    return b.compare_reset(oldv, newv)
 
 
 def swap(b, fn, *args, **kwargs):
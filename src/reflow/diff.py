@@ -0,0 +1,186 @@
+"""
+Path level diff of persistent states.
+
+    for kind, path, old, new in diff(o_state, n_state):
+        ...
+
+    cs = changes(o_state, n_state)
+    cs.modified   # {path: (old, new)}
+
+Subtrees that are the same object in both states are skipped without being
+looked at, so for states that share structure (every state derived from
+another with upssoc_in, assoc etc.) the cost is that of the changed spine:
+the keys of each map along the changed paths, not the size of the state.
+
+Maps (pmaps and dicts) are descended into, anything else is a leaf compared
+with ==. A map added or removed as a whole is reported at its own path, its
+contents are not listed.
+"""
+
+import pyrsistent as pyr
+
+
+ADDED = 'added'
+REMOVED = 'removed'
+MODIFIED = 'modified'
+
+_missing = object()
+_maps = (dict, pyr.PMap)
+
+
+
+def _probe():
+    # the fast path relies on pyrsistent internals (PMap._buckets: a vector
+    # of None or lists of (key, value), shared with derived maps unless
+    # changed), checked once here rather than pinning pyrsistent
+    try:
+        o = pyr.pmap({i: i for i in range(64)})
+        n = o.set(3, -3)
+        pairs = {k: v for b in n._buckets if b for k, v in b}
+        shared = sum(x is y for x, y in zip(o._buckets, n._buckets))
+        return pairs == dict(n) and shared == len(n._buckets) - 1
+    except Exception:
+        return False
+
+
+
+_buckets = _probe()
+
+
+
+def _bucket_changes(ob, nb):
+    # a pmap's buckets are shared with the pmap it was derived from, unless
+    # they were changed, so only changed buckets are compared key by key
+    for x, y in zip(ob, nb):
+        if x is y:
+            continue
+        xs = dict(x) if x else {}
+        for k, v in y or ():
+            if xs.pop(k, _missing) is not v:
+                yield k
+        yield from xs    # only in o
+
+
+
+def changed_keys(o, n):
+    """
+    Keys of maps `o` and `n` whose values are not the same object in both,
+    including keys found in only one of them.
+
+    For pmaps with as many buckets, as when one was derived from the other
+    without growing, whole buckets are compared by identity first, which is
+    much cheaper than looking up each key. Only if this pyrsistent's pmaps
+    are laid out as expected, otherwise every key is looked up.
+    """
+    if _buckets and isinstance(o, pyr.PMap) and isinstance(n, pyr.PMap) \
+            and len(o._buckets) == len(n._buckets):
+        yield from _bucket_changes(o._buckets, n._buckets)
+        return
+    added = 0
+    for k, v in n.items():
+        if (ov := o.get(k, _missing)) is not v:
+            added += ov is _missing
+            yield k
+    if len(o) > len(n) - added:   # some keys of o are not in n
+        for k in o:
+            if k not in n:
+                yield k
+
+
+
+def diff(o, n, path=()):
+    """
+    Yields (kind, path, old, new) for each change from `o` to `n`, kind being
+    ADDED, REMOVED or MODIFIED, path a tuple of keys and old/new _missing
+    where there is no value. Paths are relative to `path`.
+    """
+    if o is n:
+        return
+    if not (isinstance(o, _maps) and isinstance(n, _maps)):
+        if o != n:
+            yield MODIFIED, path, o, n
+        return
+    stack = [(path, o, n)]
+    while stack:
+        path, o, n = stack.pop()
+        for k in changed_keys(o, n):
+            ov, nv = o.get(k, _missing), n.get(k, _missing)
+            p = path + (k,)
+            if ov is _missing:
+                yield ADDED, p, ov, nv
+            elif nv is _missing:
+                yield REMOVED, p, ov, nv
+            elif isinstance(ov, _maps) and isinstance(nv, _maps):
+                stack.append((p, ov, nv))
+            elif ov != nv:
+                yield MODIFIED, p, ov, nv
+
+
+
+def changed(o, n):
+    """
+    True if `o` and `n` differ. Stops at the first change, and never looks
+    inside subtrees they share, so it's cheaper than == on large states.
+    """
+    return o is not n and next(diff(o, n), None) is not None
+
+
+
+class ChangeSet:
+    """
+    Changes from one state to another:
+
+    added:    path -> new value
+    removed:  path -> old value
+    modified: path -> (old value, new value)
+    """
+    __slots__ = ('added', 'removed', 'modified')
+
+    def __init__(self, changes=()):
+        self.added = {}
+        self.removed = {}
+        self.modified = {}
+        for kind, p, o, n in changes:
+            if kind is ADDED:
+                self.added[p] = n
+            elif kind is REMOVED:
+                self.removed[p] = o
+            else:
+                self.modified[p] = (o, n)
+
+
+    def __repr__(self):  # pragma: no cover
+        return (f"ChangeSet(added={self.added}, removed={self.removed}, "
+                f"modified={self.modified})")
+
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.modified)
+
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.modified)
+
+
+    def paths(self):
+        """Every changed path."""
+        return [*self.added, *self.removed, *self.modified]
+
+
+    def touches(self, pv):
+        """
+        True if the value at path `pv` has changed: a changed path is `pv`,
+        beneath it or above it.
+        """
+        pv = tuple(pv)
+        for p in self.paths():
+            n = min(len(p), len(pv))
+            if p[:n] == pv[:n]:
+                return True
+        return False
+
+
+
+def changes(o, n):
+    """The ChangeSet from state `o` to state `n`."""
+    return ChangeSet(diff(o, n))
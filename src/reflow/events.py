@@ -1,21 +1,23 @@
+import functools
+import inspect
 import pyrsistent as pyr
 
 from decorator import decorate
 from .graph import run_graph
+from .aio import spawn
+from . import fx
+from .router import Context, compile_chain
+from .columnar import Region
 
+from .diff import changes
 from .util import (
-    dict_diff,
-    update_in,
+    get_in,
     upssoc_in,
-    assoc,
-    dissoc,
-    update,
-    mapkv)
+    dissoc)
 
 from .registry import (
     register_handler,
     handler,
-    flows,
     state)
 
 
@@ -42,24 +44,17 @@ def debug():
         event = ctx['coeffects']['event']
         o_state = ctx['coeffects']['state']
         n_state = ctx['effects'].get('state', None)
-        if not n_state:
+        if not n_state or not (cs := changes(o_state, n_state)):
             print("[DEBUG] state unchanged post event: ", event, "\n")
         else:
-            only_before, only_after, common_d1, common_d2 = dict_diff(o_state, n_state)
-            if only_before or only_after:
-                print("[DEBUG] state change post event: ", event)
-                print("        old state: ", o_state)
-                print("        new state: ", n_state)
-                print("[DEBUG] difference between old and new state")
-                print("        only in old state: ", only_before)
-                print("        only in new state: ", only_after)
-                print("[DEBUG] common to old and new state (MUST MATCH!)")
-                print("        common old -> new: ", common_d1)
-                print("        common new -> old: ", common_d2)
-                print("        difference: ", [
-                    i for i in common_d1 if i not in common_d2], "\n")
-            else:
-                print("[DEBUG] state unchanged post event: ", event, "\n")
+            print("[DEBUG] state change post event: ", event)
+            for p, v in cs.added.items():
+                print("        added:    ", list(p), v)
+            for p, v in cs.removed.items():
+                print("        removed:  ", list(p), v)
+            for p, (o, n) in cs.modified.items():
+                print("        modified: ", list(p), o, "->", n)
+            print()
         return ctx
     return interceptor(id='debug', before=before, after=after)
 
@@ -67,14 +62,11 @@ def debug():
 
 def do_flow_fx():
     def after(ctx):
-        effects = ctx.get('fx')
-        if not effects:
-            return ctx
-        ctx = ctx['effects']
-        flow_fx = pyr.pmap({k: effects[k] for k in flow_fx_ids()})
-        mapkv(lambda k,v: handler('fx', k)(v), flow_fx)
-        ctx = update_in(ctx, ['effects', 'fx'], lambda x: dissoc(x, flow_fx_ids))
-        ctx = update(ctx, 'effects', lambda x: dissoc(x, flow_fx_ids))
+        flow_fx = {k: ctx.effects[k] for k in flow_fx_ids() if k in ctx.effects}
+        for k,v in flow_fx.items():
+            if effect_fn := handler('fx', k):
+                effect_fn(v)
+            ctx.effects = dissoc(ctx.effects, k)
         return ctx
     return interceptor(id='do_flow_fx', after=after)
 
@@ -82,23 +74,26 @@ def do_flow_fx():
 
 def flow_interceptor():
     def after(ctx):
-        nctx = upssoc_in(
-            ctx, ['effects','pre_flow_state'],
-            ctx['effects']['state'])
-        return run_graph(nctx, flows)
+        if 'state' in ctx.effects:
+            ctx.effects = ctx.effects.set(
+                'pre_flow_state', ctx.effects['state'])
+        return run_graph(ctx)
     return interceptor(id='flow', after=after)
 
 
 
 def do_fx():
     def after(ctx):
-        effects = ctx['effects']
+        effects = ctx.effects
         effects_no_state = dissoc(effects, 'state')
-        if n_state := effects.get('state'):
+        if (n_state := effects.get('state')) is not None:
             handler('fx', 'state')(n_state)
         for k,v in effects_no_state.items():
             if effect_fn := handler('fx', k):
-                effect_fn(v)
+                if fx.is_pooled(effect_fn):
+                    fx.submit(k, effect_fn, v, ctx.coeffects['event'])
+                elif inspect.isawaitable(r := effect_fn(v)):
+                    spawn(r, ctx.coeffects['event'])
         return ctx
     return interceptor(id='do_fx', after=after)
 
@@ -108,9 +103,9 @@ def inject_cofx(id, val=None):
     def before(ctx):
         if handler_fn := handler('cofx', id):
             if val:
-                ctx = update(ctx, 'coeffects', handler_fn, val)
+                ctx.coeffects = handler_fn(ctx.coeffects, val)
             else:
-                ctx = update(ctx, 'coeffects', handler_fn)
+                ctx.coeffects = handler_fn(ctx.coeffects)
         return ctx
     return interceptor(id='coeffects', before=before)
 
@@ -123,10 +118,11 @@ def inject_cofx(id, val=None):
 
 def state_handler_interceptor(fn):
     def before(ctx):
-        state = ctx['coeffects']['state']
-        event = ctx['coeffects']['event']
-        if r := fn(state, event[1], event[2]):
-            ctx = upssoc_in(ctx, ['effects', 'state'], r)
+        state = ctx.coeffects['state']
+        event = ctx.coeffects['event']
+        # None leaves state as is, an empty map (e.g. restored) is a state
+        if (r := fn(state, event[1], event[2])) is not None:
+            ctx.effects = ctx.effects.set('state', r)
         return ctx
     return interceptor(id='state_handler', before=before)
 
@@ -141,13 +137,14 @@ def default_error_handler(error, event, direction):
 
 
 def state_effects_handler(newv):
-    if not state.unbox() == newv:
+    if state.unbox() is not newv:
         state.reset(newv)
 
 
 
 def state_coeffects_handler(cofx):
-    return assoc(cofx, 'state', state.unbox())
+    # by reference: state is persistent, nothing to copy or compare
+    return cofx.set('state', state.unbox())
 
 
 
@@ -165,19 +162,56 @@ def event(id):                     # decorator decorator, returning...
         dfn = dec(f, id, 'event')
         register_handler(
             'event', id,
-            pyr.pvector([inject_cofx('state'), do_fx(),
+            compile_chain([inject_cofx('state'), do_fx(),
                          #debug(),
              flow_interceptor(), do_flow_fx(),
-             state_handler_interceptor(dfn)]))
+             state_handler_interceptor(f)]))
         return dfn                 # decorator
     return dp
 
 
+def apply_event(state, ev, flows=False):
+    """
+    Applies event `ev` to `state` with the event's state handler only, no
+    cofx, flows or fx. Unknown events leave state unchanged. With flows=True
+    the flow graph is then run over the change, as when the event was
+    processed by the router.
+    """
+    if not (interceptors := handler('event', ev[0])):
+        return state
+    ctx = Context(ev)
+    ctx.coeffects = ctx.coeffects.set('state', state)
+    for fn in compile_chain(interceptors).handlers:
+        ctx = fn(ctx)
+    if flows:
+        ctx = run_graph(ctx)
+    return ctx.effects.get('state', state)
+
+
+
 @event('state')
 def _(state, qry_v, val):
     return upssoc_in(state, qry_v, val)
 
 
+@event('batch')
+def _(state, qry_v, evs):
+    return functools.reduce(apply_event, evs, state)
+
+
+@event('restore')
+def _(state, qry_v, s):
+    return s
+
+
+@event('region')
+def _(state, qry_v, writes):
+    r = get_in(state, qry_v)
+    if not isinstance(r, Region):
+        raise TypeError(f"No columnar region at {list(qry_v)}")
+    return upssoc_in(state, qry_v, r.update(writes))
+
+
 register_handler('fx', 'state', state_effects_handler)
 register_handler('cofx', 'state', state_coeffects_handler)
 register_handler('error', 'event_handler', default_error_handler)
@@ -1,17 +1,25 @@
-# def compute_args_error(n):
-#     return """
-#            ERROR: compute_fn takes either one or two arguments only
-#                   first argument must be the input flowing from signal_fn
-#                   second argument is the query vector: qry_v (if required)
-#                   arguments given: {x}""".format(x=n)
+class ComputeArgumentError(Exception):
+    """
+    Raised when a subscription compute_fn takes the wrong number of arguments.
+    """
+    def __init__(self, n):
+        self.message = """ERROR: compute_fn takes either one or two arguments only
+       first argument must be the input flowing from signal_fn
+       second argument is the query vector: qry_v (if required)
+       arguments given: {x}""".format(x=n)
+        super().__init__(self.message)
 
 
 
-# def signal_args_error(n):
-#     return """
-#            ERROR: signal_fn takes either zero or one argument only
-#                   the argument is the query vector: qry_v (if required)
-#                   arguments given: {x}""".format(x=n)
+class SignalArgumentError(Exception):
+    """
+    Raised when a subscription signal_fn takes the wrong number of arguments.
+    """
+    def __init__(self, n):
+        self.message = """ERROR: signal_fn takes either zero or one argument only
+       the argument is the query vector: qry_v (if required)
+       arguments given: {x}""".format(x=n)
+        super().__init__(self.message)
 
 
 
@@ -48,6 +56,10 @@ class FlowArgumentError(Exception):
             self.message = 'Flow inputs need to include at least one path or one flow'
         elif kind == 'output':
             self.message = 'Flows require an "output" function'
+        elif kind == 'path':
+            self.message = 'Flow path keys must be hashable, or slices'
+        elif kind == 'lazy_input':
+            self.message = 'Only lazy flows can read a lazy flow'
         else:
             self.message = 'Unknown error'
         self.message = '[Flow ' + str(id) + ']: ' + self.message
@@ -68,3 +80,41 @@ class DictTypeError(Exception):
 
 #FIXME:
 #print("No subscription handler registered for: ".format(x=id))
+
+
+
+class JournalError(Exception):
+    """
+    Raised when the event journal failed to write, events appended since
+    the failure are not durable.
+    """
+    def __init__(self, cause):
+        self.cause = cause
+        self.message = 'ERROR: event journal write failed: ' + repr(cause)
+        super().__init__(self.message)
+
+
+
+class QueueFullError(Exception):
+    """
+    Raised when an event is dispatched to a full event queue with overflow
+    policy 'reject', or 'block' and the wait timed out.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.message = 'ERROR: event queue full, max size: ' + str(maxsize)
+        super().__init__(self.message)
+
+
+
+class ShardError(Exception):
+    """
+    Raised for requests to, and dispatches routed to, a shard whose worker
+    process has died.
+    """
+    def __init__(self, index, exitcode):
+        self.index = index
+        self.exitcode = exitcode
+        self.message = 'ERROR: shard {i} worker died, exit code: {c}'.format(
+            i=index, c=exitcode)
+        super().__init__(self.message)
@@ -0,0 +1,170 @@
+"""
+Pooled fx: effect handlers run off the dispatch thread.
+
+    @fx.pooled
+    def post(v):
+        requests.post(URL, json=v)
+
+    register_handler('fx', 'post', post)
+    fx.set_pool(fx.FxPool(max_workers=8))   # optional, 4 workers by default
+
+do_fx runs an fx handler marked pooled on the fx pool instead of in the
+event's after chain, once state has been committed, so a slow effect (an
+HTTP call, a DB write) doesn't hold up the events queued behind it.
+
+Effects of the same fx id run one at a time, in the order their events were
+processed. Effects of different ids run concurrently, on at most max_workers
+threads. A pooled handler that is a coroutine fn is spawned as usual (see
+aio.spawn). Failures are reported to the event_handler error handler.
+"""
+
+import atexit
+import collections
+import functools
+import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from reflow.aio import spawn
+from reflow.containers import Box
+from reflow.registry import handler
+
+
+
+def pooled(fn):
+    """Marks fx handler `fn` to be run on the fx pool."""
+    @functools.wraps(fn)
+    def f(v):
+        return fn(v)
+    f.pooled = True
+    return f
+
+
+
+def is_pooled(fn):
+    return getattr(fn, 'pooled', False) is True
+
+
+
+class FxPool:
+    """
+    Bounded thread pool running effects FIFO per fx id. Each fx id with
+    pending effects has a queue, drained by one worker at a time, which hands
+    the queue back to the pool every `batch` effects so one busy fx id can't
+    keep a worker from the others.
+    """
+
+    def __init__(self, max_workers=4, batch=100):
+        self.max_workers = max_workers
+        self.batch = batch
+        self.done = 0
+        self.failed = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix='reflow-fx')
+        self._queues = {}   # fx id -> deque of (fn, value, event)
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+
+    def submit(self, id, fn, v, event=None):
+        """Queues fn(v), the effect of fx `id` for `event`."""
+        with self._lock:
+            self._pending += 1
+            if (q := self._queues.get(id)) is not None:
+                q.append((fn, v, event))
+                return   # its queue is being drained
+            self._queues[id] = collections.deque([(fn, v, event)])
+        self._executor.submit(self._drain, id)
+
+
+    def _drain(self, id):
+        for _ in range(self.batch):
+            with self._lock:
+                q = self._queues[id]
+                if not q:
+                    del self._queues[id]
+                    return
+                fn, v, event = q.popleft()
+            self._call(fn, v, event)
+            with self._lock:
+                self._pending -= 1
+                if not self._pending:
+                    self._idle.notify_all()
+        self._executor.submit(self._drain, id)   # back of the line
+
+
+    def _call(self, fn, v, event):
+        try:
+            if inspect.isawaitable(r := fn(v)):
+                spawn(r, event)
+            self.done += 1
+        except Exception as e:
+            self.failed += 1
+            handler('error', 'event_handler')(e, event, 'fx')
+
+
+    def flush(self, timeout=None):
+        """Waits until every effect submitted so far has run. False on timeout."""
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._pending, timeout)
+
+
+    def shutdown(self, wait=True):
+        if wait:
+            self.flush()
+        self._executor.shutdown(wait)
+
+
+    def stats(self):
+        return {'pending': self._pending,
+                'queues': len(self._queues),
+                'done': self.done,
+                'failed': self.failed,
+                'max_workers': self.max_workers}
+
+
+
+"""
+The fx pool, created with default settings by the first pooled effect.
+"""
+pool = Box(None)
+
+
+
+def set_pool(p=None):
+    """
+    Sets the fx pool, returning the previous one, which is not shut down.
+    None means a default pool is created when next needed.
+    """
+    old = pool.unbox()
+    pool.reset(p)
+    return old
+
+
+
+def get_pool():
+    if (p := pool.unbox()) is None:
+        if pool.compare_reset(None, FxPool()):
+            atexit.register(_shutdown)
+        p = pool.unbox()
+    return p
+
+
+
+def submit(id, fn, v, event=None):
+    get_pool().submit(id, fn, v, event)
+
+
+
+def flush(timeout=None):
+    """Waits until the pooled effects submitted so far have run."""
+    if (p := pool.unbox()) is not None:
+        return p.flush(timeout)
+    return True
+
+
+
+def _shutdown():
+    if (p := pool.unbox()) is not None:
+        p.shutdown()
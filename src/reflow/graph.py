@@ -1,31 +1,681 @@
+import heapq
+import pickle
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import pyrsistent as pyr
 
-from .registry import flow_path, flows
-from .exceptions import GraphCycleError
+from . import instrument
+from .columnar import arrays, as_region
+from .containers import Box
+from .registry import (
+    flows,
+    new_flows,
+    removed_flows,
+    watchers,
+    changed,
+    handler,
+    state)
+from .exceptions import FlowArgumentError, GraphCycleError
+from . import diff
 
 from .util import (
-    cache,
+    as_path,
     get_in,
-    update_in,
+    getter,
+    path_key,
     upssoc_in,
     is_dict)
 
 
 
-def resolve_inputs(inputs, _state):
-    r = pyr.pmap()
+class FlowPlan:
+    """
+    Compiled form of a registered flow, built once by `compile_flow`.
+
+    Input specs are normalised at compile time. Flow inputs are resolved to the
+    path of the upstream flow by `link`, each time the flow register changes,
+    leaving `inputs` and `active_inputs` as tuples of (name, getter) pairs
+    prebound to a state path.
+
+    A lazy flow's output is not written to state, it is computed when read
+    (see lazy_value). A vectorized flow's output gets arrays for inputs that
+    are columnar Regions, and an array it returns is stored as a Region.
+    """
+    __slots__ = ('id', 'path', 'specs', 'is_active', 'output', 'remove',
+                 'lazy', 'vectorized', 'inputs', 'active_inputs', 'paths',
+                 'upstream', 'picklable')
+
+    def __init__(self, f):
+        self.id = f['id']
+        self.path = as_path(f['path'])
+        self.specs = (_specs(f['inputs']), _specs(f['active_inputs']))
+        self.is_active = f['is_active']
+        self.output = f['output']
+        self.remove = f['remove']
+        self.lazy = bool(f.get('lazy', False))
+        self.vectorized = bool(f.get('vectorized', False))
+        self.picklable = None   # output fn, checked on a process pool's use
+        self.link(pyr.m())
+
+
+    def __repr__(self):  # pragma: no cover
+        return f"FlowPlan({repr(self.id)})"
+
+
+    def link(self, plans):
+        """
+        Resolves flow inputs against `plans`. Inputs naming an unregistered
+        flow read None.
+        """
+        paths = []
+        upstream = []
+
+        def _resolve(specs):
+            r = []
+            for name, kind, ref in specs:
+                pv = ref
+                if kind == 'flow':
+                    pv = plans[ref].path if ref in plans else None
+                    if pv is not None:
+                        upstream.append(ref)
+                if pv is not None:
+                    paths.append(pv)
+                r.append((name, getter(pv)))
+            return tuple(r)
+
+        self.inputs = _resolve(self.specs[0])
+        self.active_inputs = _resolve(self.specs[1])
+        self.paths = tuple(paths)
+        self.upstream = tuple(upstream)
+        return self
+
+
+
+def _specs(inputs):
+    r = []
     for k,v in inputs.items():
-        r = r.set(k, pyr.pmap())
-        if is_dict(v):
-            ref = list(v)[0]
-            if ref == 'path':
-                r = r.set(k, get_in(_state, v[ref]))
-            if ref == 'flow':
-                r = r.set(k, get_in(_state, flow_path(v[ref])))
+        ref = list(v)[0]
+        r.append((k, ref, as_path(v[ref]) if ref == 'path' else v[ref]))
+    return tuple(r)
+
+
+
+def compile_flow(f):
+    return FlowPlan(f)
+
+
+
+_missing = object()
+
+
+
+def _step(x, k):
+    try:
+        return x[k]
+    except (KeyError, TypeError, IndexError):
+        return _missing
+
+
+
+def _trie_node(key=None):
+    # children are keyed by util.key_of their path key, kept as `key`
+    return {'flows': set(), 'children': {}, 'key': key}
+
+
+
+def _trie_walk(trie, pv):
+    """
+    Yields the trie nodes along path `pv`, from the root down. Stops early if
+    the path leaves the trie.
+    """
+    node = trie
+    yield node
+    for k in path_key(pv):
+        node = node['children'].get(k)
+        if node is None:
+            return
+        yield node
+
+
+
+def _trie_subtree(node):
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield from node['flows']
+        stack.extend(node['children'].values())
+
+
+
+def _trie_add(trie, pv, id):
+    node = trie
+    for hk, k in zip(path_key(pv), pv):
+        node = node['children'].setdefault(hk, _trie_node(k))
+    node['flows'].add(id)
+
+
+
+def _trie_discard(trie, pv, id):
+    nodes = list(_trie_walk(trie, pv))
+    if len(nodes) != len(pv) + 1:
+        return
+    nodes[-1]['flows'].discard(id)
+    for parent, k, node in reversed(list(zip(nodes, path_key(pv),
+                                             nodes[1:]))):
+        if node['flows'] or node['children']:
+            break
+        del parent['children'][k]   # prune empty branches
+
+
+
+def changed_flows(trie, o, n):
+    """
+    Ids of flows reading a path whose value differs between states `o` and `n`.
+    Subtrees that are identical objects in both states are skipped, so with
+    structurally shared states only the changed spine is visited. Wide maps
+    are diffed with diff.changed_keys rather than visiting each trie child.
+    """
+    acc = set()
+    stack = [(trie, o, n)]
+    while stack:
+        node, o, n = stack.pop()
+        if o is n:
+            continue
+        acc.update(node['flows'])
+        children = node['children']
+        if is_dict(o) and is_dict(n) and len(children) * 32 > len(o) + len(n):
+            ks = [k for k in diff.changed_keys(o, n) if k in children]
+        else:
+            ks = children
+        for k in ks:
+            c = children[k]
+            stack.append((c, _step(o, c['key']), _step(n, c['key'])))
+    return acc
+
+
+
+def affected_flows(trie, pv):
+    """
+    Ids of flows reading path `pv`, a parent of it, or anything beneath it.
+    """
+    acc = set()
+    nodes = list(_trie_walk(trie, pv))
+    for node in nodes:
+        acc.update(node['flows'])
+    if len(nodes) == len(pv) + 1:
+        acc.update(_trie_subtree(nodes[-1]))
+    return acc
+
+
+
+class FlowGraph:
+    """
+    The flow register as a DAG of linked flow plans, kept in topological order
+    as flows are added and removed (Pearce-Kelly dynamic topological sort).
+    Adding an edge that goes against the order only reorders the flows between
+    its two ends, so registering a flow costs O(affected edges).
+
+    plans:   id -> linked FlowPlan
+    order:   id -> position, ascending along every edge (not dense)
+    out/ins: id -> ids of downstream/upstream flows
+    trie:    reverse index of input paths, a trie keyed by path segment,
+             each node holding the ids of the flows reading that path
+    refs:    id -> ids of flows with a flow input naming it, registered or not
+    outputs: output path (its path_key) -> id, of flows writing to state
+             (not lazy ones)
+    writers: trie of those output paths, each node holding the ids of the
+             flows writing there
+    values:  id -> cached value of a lazy flow, a _Lazy entry
+    """
+
+    def __init__(self):
+        self.plans = {}
+        self.order = {}
+        self.out = {}
+        self.ins = {}
+        self.trie = _trie_node()
+        self.refs = {}
+        self.outputs = {}
+        self.writers = _trie_node()
+        self.values = {}
+        self._next = 0
+        self._levels = None
+        self._lock = threading.RLock()
+
+
+    def __contains__(self, id):
+        return id in self.plans
+
+
+    def add(self, p):
+        """
+        Adds (or replaces) flow plan `p`. Raises GraphCycleError, leaving the
+        graph as it was, if the flow would close a cycle, FlowArgumentError
+        if a flow that isn't lazy would read a lazy one.
+        """
+        with self._lock:
+            self._check_lazy(p)
+            self._levels = None
+            old = self.plans.get(p.id)
+            if old is not None:
+                self._remove(p.id)
+            try:
+                self._add(p)
+            except GraphCycleError:
+                self._remove(p.id)
+                if old is not None:
+                    self._add(old)
+                raise
+
+
+    def remove(self, id):
+        with self._lock:
+            self._levels = None
+            if id in self.plans:
+                self._remove(id)
+
+
+    def invalidate(self, id, keep):
+        """
+        Marks lazy flow `id`'s cached value stale, or drops it unless `keep`
+        (the flow has subscribers).
+        """
+        if (e := self.values.get(id)) is not None:
+            if keep:
+                e.stale = True
+            else:
+                self.values.pop(id, None)
+
+
+    def release(self, id):
+        """Drops lazy flow `id`'s cached value, its last subscriber gone."""
+        self.values.pop(id, None)
+
+
+    def levels(self):
+        """
+        id -> level: the longest path to the flow from a flow with no
+        upstream. Flows on the same level are independent. Recomputed (in
+        topological order) after the graph changes.
+        """
+        with self._lock:
+            if self._levels is None:
+                lv = {}
+                for k in sorted(self.order, key=self.order.get):
+                    lv[k] = max((lv[u] + 1 for u in self.ins[k] if u != k),
+                                default=0)
+                self._levels = lv
+            return self._levels
+
+
+    def _add(self, p):
+        id = p.id
+        self.plans[id] = p
+        self.order[id] = self._next
+        self._next += 1
+        self.out[id] = set()
+        self.ins[id] = set()
+        if not p.lazy:
+            self.outputs.setdefault(path_key(p.path), id)
+            _trie_add(self.writers, p.path, id)
+        for ref in self._flow_refs(p):
+            self.refs.setdefault(ref, set()).add(id)
+        self._link(p)
+        for u in p.upstream:
+            self._edge(u, id)
+        for pv in self._path_specs(p):
+            if (u := self._writer(pv, id)) is not None:
+                self._edge(u, id)
+            for u in self._writers_beneath(pv, id):
+                self._edge(u, id)
+        # flows waiting on this one by name
+        for d in self.refs.get(id, ()):
+            if d != id and d in self.plans:
+                self._relink(self.plans[d])
+                self._edge(id, d)
+        # flows reading at or beneath its output path
+        nodes = list(_trie_walk(self.trie, p.path))
+        if len(nodes) == len(p.path) + 1:
+            for d in set(_trie_subtree(nodes[-1])):
+                if d != id and any(self._writer(pv, d) == id
+                                   for pv in self._path_specs(self.plans[d])):
+                    self._edge(id, d)
+        # flows reading a parent of it
+        for node, n in zip(nodes[1:], range(1, len(p.path))):
+            for d in set(node['flows']):
+                if d != id and p.path[:n] in self._path_specs(self.plans[d]):
+                    self._edge(id, d)
+
+
+    def _remove(self, id):
+        p = self.plans.pop(id)
+        for pv in p.paths:
+            _trie_discard(self.trie, pv, id)
+        for u in self.ins.pop(id):
+            self.out[u].discard(id)
+        for d in self.out.pop(id):
+            self.ins[d].discard(id)
+        del self.order[id]
+        self.values.pop(id, None)
+        if self.outputs.get(pk := path_key(p.path)) == id:
+            del self.outputs[pk]
+        if not p.lazy:
+            _trie_discard(self.writers, p.path, id)
+        for ref in self._flow_refs(p):
+            self.refs[ref].discard(id)
+            if not self.refs[ref]:
+                del self.refs[ref]
+        for d in self.refs.get(id, ()):
+            if d in self.plans:
+                self._relink(self.plans[d])   # now reads None
+
+
+    def _check_lazy(self, p):
+        # lazy outputs aren't in state, only lazy flows can read them
+        if not p.lazy:
+            for ref in self._flow_refs(p):
+                if ref != p.id and ref in self.plans and self.plans[ref].lazy:
+                    raise FlowArgumentError(p.id, 'lazy_input')
+        else:
+            for d in self.refs.get(p.id, ()):
+                if d != p.id and d in self.plans and not self.plans[d].lazy:
+                    raise FlowArgumentError(d, 'lazy_input')
+
+
+    def _flow_refs(self, p):
+        return {ref for specs in p.specs for _, kind, ref in specs
+                if kind == 'flow'}
+
+
+    def _path_specs(self, p):
+        return [ref for specs in p.specs for _, kind, ref in specs
+                if kind == 'path']
+
+
+    def _writer(self, pv, id):
+        """Nearest flow, other than `id`, writing to a parent of path `pv`."""
+        pk = path_key(pv)
+        for i in range(len(pk), 0, -1):
+            w = self.outputs.get(pk[:i])
+            if w is not None and w != id:
+                return w
+
+
+    def _writers_beneath(self, pv, id):
+        """Flows, other than `id`, writing to path `pv` or beneath it."""
+        nodes = list(_trie_walk(self.writers, pv))
+        if len(nodes) != len(pv) + 1:
+            return set()
+        return set(_trie_subtree(nodes[-1])) - {id}
+
+
+    def _link(self, p):
+        p.link(self.plans)
+        for pv in p.paths:
+            _trie_add(self.trie, pv, p.id)
+
+
+    def _relink(self, p):
+        for pv in p.paths:
+            _trie_discard(self.trie, pv, p.id)
+        self._link(p)
+
+
+    def _edge(self, u, v):
+        if u == v:
+            raise GraphCycleError()   # a flow reading itself
+        if v in self.out[u]:
+            return
+        if self.order[u] > self.order[v]:
+            self._reorder(u, v)
+        self.out[u].add(v)
+        self.ins[v].add(u)
+
+
+    def _reorder(self, u, v):
+        """
+        Pearce-Kelly: for new edge u -> v with v ordered before u, moves the
+        flows reachable from v (up to u) after the flows reaching u (down to
+        v), reusing their positions.
+        """
+        order = self.order
+        lb, ub = order[v], order[u]
+
+        fwd, stack, seen = [], [v], {v}
+        while stack:
+            n = stack.pop()
+            fwd.append(n)
+            for w in self.out[n]:
+                if w == u:
+                    raise GraphCycleError()
+                if w not in seen and order[w] < ub:
+                    seen.add(w)
+                    stack.append(w)
+
+        bwd, stack, seen = [], [u], {u}
+        while stack:
+            n = stack.pop()
+            bwd.append(n)
+            for w in self.ins[n]:
+                if w not in seen and order[w] > lb:
+                    seen.add(w)
+                    stack.append(w)
+
+        slots = sorted(order[n] for n in fwd + bwd)
+        nodes = sorted(bwd, key=order.get) + sorted(fwd, key=order.get)
+        for n, o in zip(nodes, slots):
+            order[n] = o
+
+
+
+dag = FlowGraph()
+
+
+"""
+Executor for level-parallel flow evaluation, None to evaluate serially.
+"""
+executor = Box(None)
+
+
+def set_executor(pool=None):
+    """
+    Opt-in level-parallel flow evaluation. Dirty flows at the same level of the
+    graph (so with no path between them) have their outputs computed
+    concurrently on `pool`, any concurrent.futures executor:
+
+    set_executor(ThreadPoolExecutor(8))    # outputs releasing the GIL (numpy...)
+    set_executor(ProcessPoolExecutor())    # CPU heavy pure python outputs
+
+    On a process pool, outputs that can't be pickled (lambdas, closures) are
+    computed in this process instead, while the others run. The inputs of
+    those that can must be picklable too. Outputs run in another process
+    aren't timed by the instrumentation sink. Returns the previous executor,
+    which is not shut down. None (the default) evaluates serially.
+    """
+    old = executor.unbox()
+    executor.reset(pool)
+    return old
+
+
+
+def transition(k, p, o_state, n_state, new, removed):
+    """
+    Works out what flow `k` (plan `p`) needs this run: ('output', inputs),
+    ('remove', None) or (None, None), along with the (from, to) transition.
+    """
+    o_inputs = {n: g(o_state) for n, g in p.inputs}
+    n_inputs = {n: g(n_state) for n, g in p.inputs}
+
+    s0 = s1 = 'inactive'
+    if k in new:
+        s0 = 'new'
+    elif p.is_active({n: g(o_state) for n, g in p.active_inputs}):
+        s0 = 'active'
+
+    if k in removed:
+        s1 = 'removed'
+    elif p.is_active({n: g(n_state) for n, g in p.active_inputs}):
+        s1 = 'active'
+
+    if p.vectorized:
+        ins = arrays(n_inputs)
+    else:
+        ins = n_inputs
+
+    match [s0,s1]:
+        case ['active', 'active']:
+            if o_inputs != n_inputs:
+                return 'output', ins, (s0, s1)
+        case ['active', 'inactive']:
+            return 'remove', None, (s0, s1)
+        case ['inactive', 'active']:
+            return 'output', ins, (s0, s1)
+        case ['new', 'active']:
+            new_flows.swap(lambda x: x.discard(k))
+            return 'output', ins, (s0, s1)
+        case ['active', 'removed']:
+            return 'remove', None, (s0, s1)
+        case _:
+            pass
+    return None, None, (s0, s1)
+
+
+
+def _timed(sink, k, action, tr, fn, *args, **kwargs):
+    """Calls fn, reporting its duration to `sink` as flow `k`'s evaluation."""
+    t = time.perf_counter_ns()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        sink('flow', k, time.perf_counter_ns() - t,
+             {'transition': '->'.join(tr), 'action': action})
+
+
+
+_failed = object()
+
+
+
+def _report(k, ev, e):
+    if hasattr(e, 'add_note'):   # python 3.11+
+        e.add_note(f"in flow {k!r}")
+    handler('error', 'event_handler')(e, ev, 'flow')
+
+
+
+def _call(k, ev, fn, *args, **kwargs):
+    """
+    Calls flow `k`'s fn, running for event `ev`. A failure is reported to the
+    error handler, as raised 'flow' for that event with the flow id added as
+    a note (python 3.11+), and _failed returned, so one failing flow doesn't
+    abort the rest of the run.
+    """
+    try:
+        return fn(*args, **kwargs)
+    except Exception as e:
+        _report(k, ev, e)
+        return _failed
+
+
+
+def _outputs(steps, pool, sink=None, ev=None):
+    """
+    Computes the outputs of `steps`, concurrently on `pool` if there is one and
+    more than one output to compute. Results are in the order of `steps`,
+    _failed for outputs that raised.
+    """
+    def _fn(k, p, a, tr):
+        if sink is None:
+            return p.output
+        return partial(_timed, sink, k, a, tr, p.output)
+
+    if pool is None or sum(a == 'output' for _, _, a, _, _ in steps) < 2:
+        return [_call(k, ev, _fn(k, p, a, tr), **ins)
+                if a == 'output' else None
+                for k, p, a, ins, tr in steps]
+    procs = isinstance(pool, ProcessPoolExecutor)
+    fs = [(pool.submit(p.output, **ins) if procs else
+           pool.submit(_fn(k, p, a, tr), **ins))
+          if a == 'output' and not (procs and not _picklable(p)) else None
+          for k, p, a, ins, tr in steps]
+    # failures are caught here, in this process: a _failed returned from a
+    # process pool would be a copy, not _failed
+    return [_call(k, ev, f.result) if f is not None
+            else _call(k, ev, _fn(k, p, a, tr), **ins) if a == 'output'
+            else None
+            for f, (k, p, a, ins, tr) in zip(fs, steps)]
+
+
+
+def _picklable(p):
+    """Whether flow plan `p`'s output fn can be sent to a process pool."""
+    if p.picklable is None:
+        try:
+            pickle.dumps(p.output)
+            p.picklable = True
+        except Exception:
+            p.picklable = False
+    return p.picklable
+
+
+
+class _Lazy:
+    __slots__ = ('state', 'inputs', 'value', 'stale')
+
+
+
+def _lazy_inputs(graph, specs, getters, s):
+    # lazy upstream flows are read through their own cached values
+    r = []
+    for (_, kind, ref), (_, g) in zip(specs, getters):
+        if kind == 'flow' and (u := graph.plans.get(ref)) is not None \
+                and u.lazy:
+            r.append(lazy_value(ref, s, graph))
+        else:
+            r.append(g(s))
     return r
 
 
 
+def lazy_value(id, s=None, graph=None):
+    """
+    Value of lazy flow `id` in state `s` (default the current state).
+
+    The value is cached along with its inputs and reused while the flow isn't
+    marked stale, or while each of its inputs is still the identical object.
+    run marks a lazy flow stale when its inputs may have changed instead of
+    computing it, and drops the cached value if the flow has no subscribers.
+    None if the flow is inactive or its output raised.
+    """
+    graph = graph or dag
+    s = state.unbox() if s is None else s
+    p = graph.plans[id]
+    e = graph.values.get(id)
+    if e is not None and not e.stale and e.state is s:
+        return e.value
+    ins = _lazy_inputs(graph, p.specs[0], p.inputs, s)
+    act = _lazy_inputs(graph, p.specs[1], p.active_inputs, s)
+    key = (*ins, *act)
+    if e is not None and len(key) == len(e.inputs) \
+            and all(a is b for a, b in zip(key, e.inputs)):
+        e.state, e.stale = s, False
+        return e.value
+    v = None
+    if p.is_active({n: x for (n, _), x in zip(p.active_inputs, act)}):
+        kw = {n: x for (n, _), x in zip(p.inputs, ins)}
+        v = _call(id, None, p.output, **(arrays(kw) if p.vectorized else kw))
+        v = None if v is _failed else v
+        v = as_region(v) if p.vectorized else v
+    e = _Lazy()
+    e.state, e.inputs, e.value, e.stale = s, key, v, False
+    if id in graph.plans:   # not removed meanwhile
+        graph.values[id] = e
+    return v
+
+
+
 def run(ctx, graph):
     """
     active -> active:   run output (when inputs have changed)
@@ -33,107 +683,127 @@ def run(ctx, graph):
     new -> active:      run output
     active -> inactive: run remove
     active -> removed:  run remove
+
+    Only dirty flows are visited: flows reading a path changed by the event,
+    new and removed flows, and flows reading the output of a flow that ran.
+    They are visited in topological order.
+
+    With an executor set (see set_executor), dirty flows are taken a level of
+    the graph at a time instead, and a level's outputs computed concurrently.
+    Results are written to state in topological order either way.
+
+    Dirty lazy flows are not computed, only marked stale (see lazy_value),
+    along with the lazy flows reading them.
     """
-    for k,v in graph.items():
-        o_state  = get_in(ctx, ['coeffects', 'state'])
-        o_inputs = resolve_inputs(v['inputs'], o_state)
-        n_state  = ctx['effects'].get('state', o_state)
-        n_inputs = resolve_inputs(v['inputs'], n_state)
-
-        s0 = s1 = 'inactive'
-        if v['__new__']:
-            s0 = 'new'
-        elif v['is_active'](resolve_inputs(v['active_inputs'], o_state)):
-            s0 = 'active'
-
-        if v['__removed__']:
-            s1 = 'removed'
-        elif v['is_active'](resolve_inputs(v['active_inputs'], n_state)):
-            s1 = 'active'
-
-        match [s0,s1]:
-            case ['active', 'active']:
-                if o_inputs != n_inputs:
-                    n_state = upssoc_in(n_state, v['path'], v['output'](**n_inputs))
-            case ['active', 'inactive']:
-                n_state = v['remove'](n_state, v['path'])
-            case ['inactive', 'active']:
-                upssoc_in(n_state, v['path'], v['output'](**n_inputs))
-            case ['new', 'active']:
-                flows.swap(upssoc_in, [v['id'], '__new__'], False)
-                n_state = upssoc_in(n_state, v['path'], v['output'](**n_inputs))
-            case ['active', 'removed']:
-                n_state = v['remove'](n_state, v['path'])
-            case _:
-                pass
-        if n_state:
-            ctx = upssoc_in(ctx, ['effects', 'state'], n_state)
-    return ctx
+    order = graph.order
+    plans = graph.plans
+    trie = graph.trie
+    pool = executor.unbox()
+    sink = instrument.sink
+    levels = graph.levels() if pool is not None else None
+    new = new_flows.unbox()
+    removed = removed_flows.unbox()
+    ws = watchers.unbox()
+    watched = []
+    ev = get_in(ctx, ['coeffects', 'event'])
+    o_state = get_in(ctx, ['coeffects', 'state'])
+    e_state = get_in(ctx, ['effects', 'state'], o_state)
+    n_state = e_state
 
+    def _key(k):
+        if levels is None:
+            return (order[k], k)
+        return (levels[k], order[k], k)
 
+    dirty = changed_flows(trie, o_state, n_state)
+    dirty.update(k for k in new | removed if k in plans)
+    q = [_key(k) for k in dirty]
+    heapq.heapify(q)
+    seen = set()
 
-def topsort_kahn(graph):
-    top_order = pyr.pvector()
-    q = pyr.dq()
-    for k,v in graph.items():
-        if get_in(v, ['edges', 'in', 'degree']) == 0:
-            q = q.append(k)
+    while q:
+        batch = []
+        while q:
+            if batch and (levels is None or q[0][0] != levels[batch[0]]):
+                break   # one flow at a time, or one level at a time
+            k = heapq.heappop(q)[-1]
+            if k not in seen:
+                seen.add(k)
+                batch.append(k)
 
-    while len(q) > 0:
-        top_order = top_order.append(q.left)
-        for v in get_in(graph, [q.left, 'edges', 'out', 'vertices']):
-            graph = update_in(graph, [v, 'edges', 'in', 'degree'], lambda x: x-1)
-            if get_in(graph, [v, 'edges', 'in', 'degree']) == 0:
-                q = q.append(v)
-        q = q.popleft()
+        steps = []
+        for k in batch:
+            p = plans[k]
+            if p.lazy:
+                if k in new:
+                    new_flows.swap(lambda x: x.discard(k))
+                graph.invalidate(k, k in ws)
+                if k in ws:
+                    watched.append(k)
+                for d in graph.out[k]:
+                    if d not in seen:
+                        heapq.heappush(q, _key(d))
+                continue
+            action, ins, tr = transition(
+                k, p, o_state, n_state, new, removed)
+            if action:
+                steps.append((k, p, action, ins, tr))
 
-    if len(top_order) == len(graph):
-        return top_order
-    else:
-        raise GraphCycleError()
+        for (k, p, action, ins, tr), v in zip(
+                steps, _outputs(steps, pool, sink, ev)):
+            p_state = n_state
+            if action == 'remove':
+                if sink is None:
+                    v = _call(k, ev, p.remove, n_state, p.path)
+                else:
+                    v = _call(k, ev, _timed, sink, k, action, tr,
+                              p.remove, n_state, p.path)
+                if v is not _failed:
+                    n_state = v
+            elif v is not _failed:
+                if p.vectorized:
+                    v = as_region(v)
+                n_state = upssoc_in(n_state, p.path, v)
 
+            if n_state is not p_state:
+                for d in affected_flows(trie, p.path):
+                    if d not in seen:
+                        heapq.heappush(q, _key(d))
 
+    # watched flows whose output differs from before the event, whether a
+    # flow or the event itself (e.g. a history restore) wrote it
+    if ws and n_state is not o_state:
+        watched += [k for k in ws if k in plans and not plans[k].lazy
+                    and diff.changed(get_in(o_state, plans[k].path),
+                                     get_in(n_state, plans[k].path))]
+    if watched:
+        changed.swap(lambda x: x.union(watched))
 
+    for k in removed & seen:
+        drop_flow(k)
 
-def calc_graph(_flows):
-    vdm = pyr.pmap({'vertices': pyr.pvector(), 'degree': 0})
+    if n_state is not e_state:
+        ctx.effects = ctx.effects.set('state', n_state)
+    return ctx
 
-    def _update_edges(x,y):
-        if not x:
-            return pyr.pmap({'vertices':pyr.pvector([y]), 'degree':1})
-        return pyr.pmap({'vertices':x['vertices'].append(y), 'degree':x['degree']+1})
 
-    def _map_args(x, f, id):
-        if not id in x:
-            x = x.set(id, f.set('edges', pyr.pmap({'in': vdm, 'out': vdm})))
-        else:
-            if not 'in' in get_in(x, [id, 'edges']):
-                x = upssoc_in(x, [id, 'edges', 'in'], vdm)
-            if not 'out' in get_in(x, [id, 'edges']):
-                x = upssoc_in(x, [id, 'edges', 'out'], vdm)
-        return x
-
-    g = pyr.pmap()
-    for id, f in _flows.items():
-        inputs = f['inputs'].update(f['active_inputs'])
-        g = _map_args(g, f, id)
-        for k,v in inputs.items():
-            ins = list(v.items())[0]
-            if ins[0] == 'flow':
-                g = update_in(g, [id, 'edges', 'in'], _update_edges, ins[1])
-                g = _map_args(g, _flows[ins[1]], ins[1])
-                g = update_in(g, [ins[1], 'edges', 'out'], _update_edges, id)
-    return g
-
-
-
-@cache
-def topsort(_flows):
-    graph = calc_graph(_flows)
-    node_order = topsort_kahn(graph)
-    return {k: graph[k] for k in node_order}
-
-
-def run_graph(ctx, flows):
-    _flows = topsort(flows.unbox())
-    return run(ctx, _flows)
+
+def drop_flow(id):
+    """Removes flow `id` from the graph and the flow register."""
+    dag.remove(id)
+    flows.swap(lambda x: x.discard(id))
+    new_flows.swap(lambda x: x.discard(id))
+    removed_flows.swap(lambda x: x.discard(id))
+
+
+
+def topsort(graph=None):
+    """Ids of the flows in `graph` (default dag), in topological order."""
+    graph = graph or dag
+    with graph._lock:
+        return sorted(graph.order, key=graph.order.get)
+
+
+
+def run_graph(ctx, graph=None):
+    return run(ctx, graph or dag)
@@ -0,0 +1,231 @@
+"""
+State history: undo, redo and time travel.
+
+    from reflow import history
+    history.enable(max_nodes=1000000)
+    dispatch('state', ['doc', 'title'], 'draft')
+    history.undo()
+    history.state_at(seq)
+
+Once enabled the router records the state committed by each event that
+changes it, keyed by the event's sequence number: the journal's when events
+are journalled (see persist.py), else a count of the events since history
+was enabled, the state it started from being seq 0. Seqs are never reused.
+States are persistent, so successive entries share all but the paths an
+event changed and each entry costs only those.
+
+Memory is accounted in unique nodes: maps and leaf values, counting the ones
+shared between neighbouring entries once. Entries are evicted oldest first
+while the total is over max_nodes.
+
+undo and redo dispatch a 'restore' event setting state to the recorded one,
+so flows and watchers see the change like any other. Restores are not
+recorded. An event changing state after an undo discards the entries that
+could be redone.
+"""
+
+import bisect
+import collections
+import threading
+
+from reflow.diff import changed_keys, _maps, _missing
+from reflow.registry import history, journal, state
+from reflow.router import dispatch
+
+
+Entry = collections.namedtuple('Entry', 'seq state added dropped')
+
+
+
+def size(x):
+    """Nodes in `x`: one per map and per leaf value."""
+    if not isinstance(x, _maps):
+        return 1
+    n = 1
+    stack = [x]
+    while stack:
+        for v in stack.pop().values():
+            n += 1
+            if isinstance(v, _maps):
+                stack.append(v)
+    return n
+
+
+
+def delta(o, n):
+    """
+    (added, dropped): nodes of `n` not in `o`, and of `o` not in `n`, for
+    subtrees at the same paths. Shared subtrees are skipped.
+    """
+    if o is n:
+        return 0, 0
+    if not (isinstance(o, _maps) and isinstance(n, _maps)):
+        return size(n), size(o)
+    added = dropped = 1   # the maps themselves are new
+    for k in changed_keys(o, n):
+        ov, nv = o.get(k, _missing), n.get(k, _missing)
+        if ov is _missing:
+            added += size(nv)
+        elif nv is _missing:
+            dropped += size(ov)
+        else:
+            a, d = delta(ov, nv)
+            added += a
+            dropped += d
+    return added, dropped
+
+
+
+class History:
+    """
+    Bounded history ring. `base` is the node count of the oldest entry's
+    state, each later entry adds the nodes it doesn't share with the one
+    before, so nodes = base + sum of added.
+    """
+
+    def __init__(self, max_nodes=1000000, max_entries=None):
+        self.max_nodes = max_nodes
+        self.max_entries = max_entries
+        self.entries = collections.deque()
+        self.cursor = -1    # index of the current entry
+        self.seq = 0
+        self.base = 0
+        self.nodes = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def record(self, ev, s, seq=None):
+        """
+        Records state `s`, committed by event `ev`, numbered `seq` (default
+        the one after the last event seen).
+        """
+        with self._lock:
+            self.seq = self.seq + 1 if seq is None else seq
+            if ev[0] == 'restore' and ev[1] == 'history':
+                return
+            es = self.entries
+            if es and es[self.cursor].state is s:
+                return   # state unchanged
+            while len(es) > self.cursor + 1:   # drop the redo branch
+                e = es.pop()
+                self.nodes -= e.added
+            if es:
+                added, dropped = delta(es[-1].state, s)
+            else:
+                added, dropped = 0, 0
+                self.base = self.nodes = size(s)
+            es.append(Entry(self.seq, s, added, dropped))
+            self.nodes += added
+            self.cursor = len(es) - 1
+            self._evict()
+
+
+    def _evict(self):
+        es = self.entries
+        while len(es) > 1 and (
+                self.nodes > self.max_nodes
+                or (self.max_entries and len(es) > self.max_entries)):
+            es.popleft()
+            # the new oldest entry now holds all its nodes: those it added
+            # stay counted, those only the evicted entry held are freed
+            self.base += es[0].added - es[0].dropped
+            self.nodes -= es[0].dropped
+            es[0] = es[0]._replace(added=0, dropped=0)
+            self.cursor -= 1
+            self.evicted += 1
+        self.cursor = max(self.cursor, 0)
+
+
+    def _goto(self, i):
+        with self._lock:
+            if not 0 <= i < len(self.entries):
+                return None
+            self.cursor = i
+            e = self.entries[i]
+        dispatch('restore', 'history', e.state)
+        return e.seq
+
+
+    def undo(self):
+        """Restores the state before the current one. Its seq, or None."""
+        return self._goto(self.cursor - 1)
+
+
+    def redo(self):
+        """Restores the state undone last. Its seq, or None."""
+        return self._goto(self.cursor + 1)
+
+
+    def goto(self, seq):
+        """Restores the state recorded as `seq`."""
+        return self._goto(self._index(seq))
+
+
+    def _index(self, seq):
+        es = self.entries
+        i = bisect.bisect_left(es, seq, key=lambda e: e.seq)
+        if not (i < len(es) and es[i].seq == seq):
+            raise KeyError(seq)
+        return i
+
+
+    def state_at(self, seq):
+        """
+        State committed by event `seq`. KeyError if that event left state
+        unchanged, or its entry has been evicted or discarded.
+        """
+        with self._lock:
+            return self.entries[self._index(seq)].state
+
+
+    def stats(self):
+        es = self.entries
+        return {'entries': len(es),
+                'nodes': self.nodes,
+                'evicted': self.evicted,
+                'first': es[0].seq if es else None,
+                'last': es[-1].seq if es else None,
+                'current': es[self.cursor].seq if es else None}
+
+
+
+def enable(**kwargs):
+    """
+    Starts recording history, from the current state. kwargs are passed to
+    History. Returns the History.
+    """
+    h = History(**kwargs)
+    j = journal.unbox()
+    h.record((None, None, None), state.unbox(), j.seq if j is not None else 0)
+    history.reset(h)
+    return h
+
+
+
+def disable():
+    history.reset(None)
+
+
+
+def undo():
+    return history.unbox().undo()
+
+
+
+def redo():
+    return history.unbox().redo()
+
+
+
+def goto(seq):
+    return history.unbox().goto(seq)
+
+
+
+def state_at(seq):
+    return history.unbox().state_at(seq)
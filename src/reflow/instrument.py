@@ -0,0 +1,40 @@
+"""
+Instrumentation hooks.
+
+    def sink(kind, name, value, info):
+        ...
+
+    instrument.set_sink(sink)
+
+Once a sink is set it is called with:
+
+ kind           name               value                info
+ 'interceptor'  interceptor id     duration (ns)        {'phase', 'event'}
+ 'flow'         flow id            duration (ns)        {'transition', 'action'}
+ 'queue'        'depth'            events in queue      {}
+ 'queue'        overflow policy    events in queue      {'event'}
+ 'swap'         the Box            retries (> 0 only)   {}
+
+'transition' is e.g. 'new->active', 'action' is 'output' or 'remove'. The
+overflow record is sent when an event is put to a full bounded EventQueue,
+name being its policy ('block', 'drop_oldest' or 'reject') and 'event' the
+event being put.
+
+Flow timings come from executor threads when flows run concurrently (see
+graph.set_executor), so the sink must be thread safe. Exceptions raised by
+the sink propagate to the instrumented code.
+
+With no sink set, instrumented code only pays for a None check.
+"""
+
+# Module level rather than a Box: it's read on hot paths, and Box itself
+# reports to it.
+sink = None
+
+
+
+def set_sink(fn):
+    """Sets the instrumentation sink, None to remove it. Returns the old one."""
+    global sink
+    old, sink = sink, fn
+    return old
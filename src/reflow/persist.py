@@ -0,0 +1,422 @@
+"""
+Event sourced persistence for registry.state.
+
+Every event the router processes is appended to a journal, in processing
+order, along with periodic snapshots of state. On startup the latest snapshot
+is restored and only the events logged after it are replayed.
+
+    from reflow import persist
+    persist.start(persist.FileLog('/var/lib/app/reflow'), snapshot_every=10000)
+    ...
+    persist.stop()
+
+Writes are group committed: events are buffered and a writer thread writes
+them in batches, one fsync (or one COPY and commit) per batch. By default
+dispatch never waits on the journal, so events processed in the last
+`interval` seconds before a crash may be lost. With sync=True each router run
+waits, once, until all of its events are durable.
+
+Backends: FileLog, an append-only segmented file log, and PostgresLog
+(requires psycopg), writing with COPY. A backend implements write, read,
+last_seq, save_snapshot, load_snapshot and close.
+"""
+
+import atexit
+import os
+import pickle
+import struct
+import threading
+import zlib
+
+from reflow.exceptions import JournalError
+from reflow.registry import handler, journal, state
+
+try:
+    import psycopg
+    from psycopg import sql
+except ImportError:   # pragma: no cover
+    psycopg = None
+
+
+
+def dumps(x):
+    return pickle.dumps(x, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+
+def loads(b):
+    return pickle.loads(b)
+
+
+
+class FileLog:
+    """
+    Append-only event log in directory `path`.
+
+    Events go to segment files named after their first sequence number. A new
+    segment is started at each snapshot and, with compact=True, segments
+    covered by the snapshot are deleted. Each record is a length and crc32
+    header then the pickled (seq, event). A torn record at the end of the
+    last segment (a crash mid write) is truncated on open.
+    """
+    _header = struct.Struct('<II')
+
+    def __init__(self, path, compact=True):
+        self.path = path
+        self.compact = compact
+        self.f = None
+        self._last = 0
+        os.makedirs(path, exist_ok=True)
+        if segs := self._segments():
+            start, name = segs[-1]
+            end, last = self._scan(name)
+            with open(name, 'r+b') as f:
+                f.truncate(end)
+            self._last = last or start - 1
+            self.f = open(name, 'ab')
+        self._last = max(self._last, self.load_snapshot()[0])
+
+
+    def _segments(self):
+        return sorted((int(n[:-4]), os.path.join(self.path, n))
+                      for n in os.listdir(self.path) if n.endswith('.log'))
+
+
+    def _records(self, name):
+        """(end offset, seq, event) of each good record in segment `name`."""
+        h = self._header
+        with open(name, 'rb') as f:
+            while len(b := f.read(h.size)) == h.size:
+                n, crc = h.unpack(b)
+                if len(b := f.read(n)) < n or zlib.crc32(b) != crc:
+                    return
+                seq, ev = loads(b)
+                yield f.tell(), seq, ev
+
+
+    def _scan(self, name):
+        end = last = 0
+        for end, last, _ in self._records(name):
+            pass
+        return end, last
+
+
+    def _sync_dir(self):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+    def last_seq(self):
+        return self._last
+
+
+    def write(self, records):
+        if self.f is None:
+            name = os.path.join(self.path, f"{records[0][0]:020d}.log")
+            self.f = open(name, 'ab')
+            self._sync_dir()
+        bs = []
+        for r in records:
+            b = dumps(r)
+            bs.append(self._header.pack(len(b), zlib.crc32(b)))
+            bs.append(b)
+        self.f.write(b''.join(bs))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self._last = records[-1][0]
+
+
+    def read(self, after=0):
+        """(seq, event) of every logged event with seq > after, in order."""
+        segs = self._segments()
+        for i, (start, name) in enumerate(segs):
+            if i + 1 < len(segs) and segs[i + 1][0] <= after + 1:
+                continue   # segment is entirely before `after`
+            for _, seq, ev in self._records(name):
+                if seq > after:
+                    yield seq, ev
+
+
+    def save_snapshot(self, seq, s):
+        name = os.path.join(self.path, 'snapshot')
+        with open(name + '.tmp', 'wb') as f:
+            f.write(dumps((seq, s)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(name + '.tmp', name)
+        if self.f is not None:   # start a new segment after the snapshot
+            self.f.close()
+            self.f = None
+        if self.compact:
+            for start, name in self._segments():
+                if start <= seq:
+                    os.remove(name)
+        self._sync_dir()
+
+
+    def load_snapshot(self):
+        """(seq, state) of the latest snapshot, (0, None) if there is none."""
+        try:
+            with open(os.path.join(self.path, 'snapshot'), 'rb') as f:
+                return loads(f.read())
+        except FileNotFoundError:
+            return 0, None
+
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+
+class PostgresLog:
+    """
+    Event log in PostgreSQL tables `table` and `table`_snapshots. Batches are
+    written with COPY, in one transaction. With compact=True events and older
+    snapshots covered by a new snapshot are deleted.
+    """
+
+    def __init__(self, conninfo, table='reflow_events', compact=True):
+        if psycopg is None:
+            raise ImportError('PostgresLog requires psycopg')
+        self.conn = psycopg.connect(conninfo, autocommit=True)
+        self.compact = compact
+        self.events = sql.Identifier(table)
+        self.snapshots = sql.Identifier(table + '_snapshots')
+        with self.conn.transaction():
+            self.conn.execute(sql.SQL(
+                'CREATE TABLE IF NOT EXISTS {} '
+                '(seq bigint PRIMARY KEY, event bytea NOT NULL)'
+            ).format(self.events))
+            self.conn.execute(sql.SQL(
+                'CREATE TABLE IF NOT EXISTS {} '
+                '(seq bigint PRIMARY KEY, state bytea NOT NULL)'
+            ).format(self.snapshots))
+
+
+    def last_seq(self):
+        with self.conn.transaction():
+            r = self.conn.execute(sql.SQL(
+                'SELECT greatest((SELECT max(seq) FROM {}), '
+                '(SELECT max(seq) FROM {}))'
+            ).format(self.events, self.snapshots)).fetchone()
+        return r[0] or 0
+
+
+    def write(self, records):
+        with self.conn.transaction():
+            with self.conn.cursor() as cur:
+                with cur.copy(sql.SQL(
+                        'COPY {} (seq, event) FROM STDIN'
+                ).format(self.events)) as copy:
+                    for seq, ev in records:
+                        copy.write_row((seq, dumps(ev)))
+
+
+    def read(self, after=0):
+        with self.conn.transaction():
+            with self.conn.cursor(name='reflow_replay') as cur:
+                cur.execute(sql.SQL(
+                    'SELECT seq, event FROM {} WHERE seq > %s ORDER BY seq'
+                ).format(self.events), (after,))
+                for seq, ev in cur:
+                    yield seq, loads(ev)
+
+
+    def save_snapshot(self, seq, s):
+        with self.conn.transaction():
+            self.conn.execute(sql.SQL(
+                'INSERT INTO {} (seq, state) VALUES (%s, %s) '
+                'ON CONFLICT (seq) DO UPDATE SET state = EXCLUDED.state'
+            ).format(self.snapshots), (seq, dumps(s)))
+            if self.compact:
+                self.conn.execute(sql.SQL(
+                    'DELETE FROM {} WHERE seq < %s'
+                ).format(self.snapshots), (seq,))
+                self.conn.execute(sql.SQL(
+                    'DELETE FROM {} WHERE seq <= %s'
+                ).format(self.events), (seq,))
+
+
+    def load_snapshot(self):
+        with self.conn.transaction():
+            r = self.conn.execute(sql.SQL(
+                'SELECT seq, state FROM {} ORDER BY seq DESC LIMIT 1'
+            ).format(self.snapshots)).fetchone()
+        return (r[0], loads(r[1])) if r else (0, None)
+
+
+    def close(self):
+        self.conn.close()
+
+
+
+class Journal:
+    """
+    Group commit journal over a backend.
+
+    append assigns the event a sequence number and buffers it. A writer thread
+    hands the buffer to the backend whenever it holds batch_size events, or
+    every `interval` seconds. commit is called by the router at the end of
+    each run: it requests a snapshot every `snapshot_every` events and, with
+    sync=True, waits until the run's events are durable.
+    """
+
+    def __init__(self, backend, batch_size=1000, interval=0.005,
+                 snapshot_every=None, sync=False):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.interval = interval
+        self.snapshot_every = snapshot_every
+        self.sync = sync
+        self.seq = self.durable = self.snapshot_seq = backend.last_seq()
+        self.error = None
+        self._buf = []
+        self._snapshot = None   # (seq, state) to save after events <= seq
+        self._wanted = self.seq   # highest seq a flush is waiting for
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._write, name='reflow-journal', daemon=True)
+        self._thread.start()
+
+
+    def append(self, event):
+        with self._cond:
+            if self.error is not None:
+                raise JournalError(self.error)
+            self.seq += 1
+            self._buf.append((self.seq, event))
+            if len(self._buf) in (1, self.batch_size):
+                self._cond.notify_all()   # wake the writer
+            return self.seq
+
+
+    def snapshot(self, s, seq=None):
+        """Saves state `s` as of event `seq` (default: the last appended)."""
+        with self._cond:
+            self._snapshot = (self.seq if seq is None else seq, s)
+            self.snapshot_seq = self._snapshot[0]
+            self._cond.notify_all()
+
+
+    def commit(self, s):
+        """End of a router run, `s` being state after the run's events."""
+        if (self.snapshot_every is not None
+                and self.seq - self.snapshot_seq >= self.snapshot_every):
+            self.snapshot(s)
+        if self.sync:
+            self.flush()
+
+
+    def flush(self):
+        """Blocks until every event appended so far is durable."""
+        with self._cond:
+            seq = self._wanted = max(self._wanted, self.seq)
+            self._cond.notify_all()
+            while self.durable < seq and self.error is None:
+                self._cond.wait()
+            if self.error is not None:
+                raise JournalError(self.error)
+
+
+    def close(self):
+        """Writes what's buffered, then stops the writer."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self.backend.close()
+        if self.error is not None:
+            raise JournalError(self.error)
+
+
+    def _write(self):
+        while True:
+            with self._cond:
+                while not (self._buf or self._snapshot or self._closed):
+                    self._cond.wait()
+                if len(self._buf) < self.batch_size and not (
+                        self._snapshot or self._closed
+                        or self._wanted > self.durable):
+                    self._cond.wait(self.interval)   # gather a batch
+                buf, self._buf = self._buf, []
+                snap, self._snapshot = self._snapshot, None
+                if not (buf or snap) and self._closed:
+                    return
+            try:
+                if snap is not None:
+                    i = next((i for i, (seq, _) in enumerate(buf)
+                              if seq > snap[0]), len(buf))
+                    if i:
+                        self.backend.write(buf[:i])
+                    self.backend.save_snapshot(*snap)
+                    buf = buf[i:]
+                if buf:
+                    self.backend.write(buf)
+                with self._cond:
+                    if buf or snap:
+                        self.durable = max(
+                            self.durable, buf[-1][0] if buf else snap[0])
+                    self._cond.notify_all()
+            except Exception as e:
+                with self._cond:
+                    self.error = e
+                    self._cond.notify_all()
+                return
+
+
+
+def replay(j):
+    """
+    Restores state from `j`'s latest snapshot, then applies the events logged
+    after it one at a time, each followed by a run of the flows, as the
+    router did when they were first processed. Their cofx and fx are not run
+    again (events dispatched by an fx were logged themselves). An event that
+    fails is reported to the error handler and skipped. Call before anything
+    else is dispatched. Returns the number replayed.
+    """
+    from reflow.events import apply_event
+    from reflow.subs import notify
+
+    seq, s = j.backend.load_snapshot()
+    if s is None:
+        s = state.unbox()
+    n = 0
+    for _, ev in j.backend.read(seq):
+        try:
+            s = apply_event(s, ev, flows=True)
+        except Exception as e:
+            handler('error', 'event_handler')(e, ev, 'replay')
+        n += 1
+    state.reset(s)
+    notify()
+    return n
+
+
+
+def start(backend, restore=True, **kwargs):
+    """
+    Journals every event processed from now on to `backend`, after restoring
+    state from it (unless restore=False). kwargs are passed to Journal. The
+    journal is stopped, and so written out, at interpreter exit.
+    """
+    j = Journal(backend, **kwargs)
+    if restore:
+        replay(j)
+    journal.reset(j)
+    atexit.register(stop)
+    return j
+
+
+
+def stop():
+    """Stops journalling, once what's been appended is written."""
+    atexit.unregister(stop)
+    if (j := journal.unbox()) is not None:
+        journal.reset(None)
+        j.close()
@@ -8,7 +8,7 @@ Module that acts as a centralized global registry.
 import config
 import pyrsistent as pyr
 
-from reflow.containers import Box
+from reflow.containers import Box, EventQueue
 from reflow.util import get_in, upssoc_in
 
 
@@ -32,6 +32,14 @@ Flow register
 flows = Box(pyr.m())
 
 
+"""
+Flow lifecycle bookkeeping, kept out of the flow register: ids of flows yet
+to run for the first time, and of flows to remove on the next run.
+"""
+new_flows = Box(pyr.s())
+removed_flows = Box(pyr.s())
+
+
 def flow_path(id):
     return get_in(flows.unbox(), [id, 'path'])
 
@@ -40,6 +48,14 @@ def get_flow(id):
     return get_in(flows.unbox(),[id])
 
 
+"""
+Subscription watchers, keyed by flow id. Each a vector of callbacks fired
+with the new value when the flow's output changes. See subs.subscribe.
+"""
+watchers = Box(pyr.m())
+changed = Box(pyr.s())  # watched flows whose output changed, not yet notified
+
+
 """
  Handler fn register for processing all events in reflow.
  Handler map is keyed by handler kind (event, sub, error, etc.) and id.
@@ -49,7 +65,7 @@ def get_flow(id):
  Pre-configured with generic state change, and state subscription
  handler references. See events.py for those specific handlers.
 """
-handlers = Box(pyr.m(event={}, fx={}, cofx={}, error={}))
+handlers = Box(pyr.m(event={}, fx={}, cofx={}, error={}, sub={}))
 
 
 def register_handler(kind, id, interceptors):
@@ -63,4 +79,16 @@ def handler(kind, id):
 """
  Router event dispatch queue
 """
-dq = Box(pyr.dq()) # FIFO queue of incoming dispatch events.
+dq = EventQueue() # FIFO queue of incoming dispatch events, unbounded.
+
+
+"""
+ Event journal, None when events are not persisted. See persist.py.
+"""
+journal = Box(None)
+
+
+"""
+ State history, None when not kept. See history.py.
+"""
+history = Box(None)
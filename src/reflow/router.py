@@ -2,39 +2,249 @@
 Dispatch router finite state machine
 """
 
+import collections.abc
+import contextlib
+import threading
+import time
 import pyrsistent as pyr
-from reflow.registry import dq, handler
+from reflow import instrument
+from reflow.containers import Box
+from reflow.registry import dq, handler, journal, history, state
+from reflow.subs import notify
 
 
-def _exec_callbacks(ev, dq):
-    print("    _exec_callbacks : {x}, {y}".format(x=ev, y=dq))
+# Only one thread runs the queue at a time, others just enqueue.
+_running = threading.Lock()
 
+# Per thread buffer of events dispatched inside a transaction.
+_tx = threading.local()
 
+"""
+Run limits
+ max_events: events processed per run_queue cycle. Events beyond that, and
+             events queued during the cycle, are left for the next cycle.
+ max_runs:   run_queue cycles per fsm run, after which the queue is handed
+             back to dispatch, which yields to other threads and resumes.
+ None means unbounded.
+"""
+limits = Box(pyr.pmap({'max_events': 1000, 'max_runs': 100}))
 
-def context(event, interceptors):
-    return pyr.pmap({
-        'coeffects': {
-            'event': event,
-            'o_event': event},
-        'queue': pyr.pdeque(interceptors),
-        'stack': pyr.pdeque()})
+runs = 0    # run_queue cycles so far, see cofx.per_run
 
 
 
-def exec_interceptors(ctx, direction):
-    ds = 'queue'
-    if direction == 'after':
-        ds = 'stack'
-    while len(ctx[ds]) > 0:
-        fn = ctx[ds].left.get(direction, None)
-        if fn:
-            try:
-                ctx = fn(ctx)
-            except Exception as e:
-                print(e)
-        if direction == 'before':
-            ctx = ctx.set('stack', ctx['stack'].appendleft(ctx['queue'].left))
-        ctx = ctx.set(ds, ctx[ds].popleft())
+def configure(**kwargs):
+    """Sets router run limits, e.g. configure(max_events=500)."""
+    for k in kwargs:
+        if k not in limits.unbox():
+            raise KeyError(f"Unknown router limit: {k}")
+    limits.swap(lambda m: m.update(kwargs))
+
+
+
+def configure_queue(**kwargs):
+    """
+    Sets the event queue's maxsize, overflow policy and block timeout, e.g.
+    configure_queue(maxsize=10000, overflow='drop_oldest'). See EventQueue.
+    """
+    dq.configure(**kwargs)
+
+
+class Context(collections.abc.Mapping):
+    """
+    Interceptor context, one per event. Mutable: interceptors replace its
+    coeffects and effects maps (which stay persistent), rather than building
+    a new context at every step.
+
+        ctx.effects = ctx.effects.set('state', s)
+
+    It also keeps the interface of the pmap it replaces: ctx['coeffects'],
+    ctx.get('effects'), and set, update, remove and evolver, which return a
+    new Context, so util.upssoc_in(ctx, ['effects', 'db'], v) works as
+    before. Keys other than coeffects and effects are held in `other`.
+    """
+    __slots__ = ('coeffects', 'effects', 'other')
+
+    def __init__(self, event):
+        self.coeffects = pyr.m(event=event, o_event=event)
+        self.effects = pyr.m()
+        self.other = _empty
+
+
+    def __repr__(self):  # pragma: no cover
+        return f"Context(coeffects={self.coeffects}, effects={self.effects})"
+
+
+    def __getitem__(self, k):
+        if k == 'coeffects' or k == 'effects':
+            return getattr(self, k)
+        return self.other[k]
+
+
+    def __contains__(self, k):
+        return k == 'coeffects' or k == 'effects' or k in self.other
+
+
+    def __iter__(self):
+        yield 'coeffects'
+        yield 'effects'
+        yield from self.other
+
+
+    def __len__(self):
+        return 2 + len(self.other)
+
+
+    def get(self, k, default=None):
+        if k == 'coeffects' or k == 'effects':
+            return getattr(self, k)
+        return self.other.get(k, default)
+
+
+    def _copy(self):
+        c = object.__new__(Context)
+        c.coeffects, c.effects, c.other = \
+            self.coeffects, self.effects, self.other
+        return c
+
+
+    def set(self, k, v):
+        c = self._copy()
+        if k == 'coeffects' or k == 'effects':
+            setattr(c, k, v)
+        else:
+            c.other = c.other.set(k, v)
+        return c
+
+
+    def update(self, *maps):
+        c = self
+        for m in maps:
+            for k, v in m.items():
+                c = c.set(k, v)
+        return c
+
+
+    def remove(self, k):
+        if k == 'coeffects' or k == 'effects':
+            return self.set(k, _empty)
+        c = self._copy()
+        c.other = c.other.remove(k)
+        return c
+
+
+    def discard(self, k):
+        return self.remove(k) if k in self else self
+
+
+    def evolver(self):
+        return _ContextEvolver(self)
+
+
+
+class _ContextEvolver:
+    """Evolver of a Context, as pmap.evolver()."""
+
+    def __init__(self, ctx):
+        self._ctx = ctx
+
+
+    def __getitem__(self, k):
+        return self._ctx[k]
+
+
+    def __setitem__(self, k, v):
+        self._ctx = self._ctx.set(k, v)
+
+
+    def __delitem__(self, k):
+        self._ctx = self._ctx.remove(k)
+
+
+    def set(self, k, v):
+        self[k] = v
+        return self
+
+
+    def remove(self, k):
+        del self[k]
+        return self
+
+
+    def persistent(self):
+        return self._ctx
+
+
+
+_empty = pyr.m()
+
+
+
+class Chain:
+    """
+    An event handler's interceptor vector compiled into flat tuples: the
+    before fns in order, the after fns in reverse order, and the before fns of
+    the event's own handler (the 'state_handler' interceptors). before_ids and
+    after_ids are the interceptor ids matching befores and afters.
+    """
+    __slots__ = ('interceptors', 'befores', 'afters', 'handlers',
+                 'before_ids', 'after_ids')
+
+    def __init__(self, interceptors):
+        self.interceptors = pyr.pvector(interceptors)
+        bs = [i for i in interceptors if i.get('before')]
+        afs = [i for i in reversed(interceptors) if i.get('after')]
+        self.befores = tuple(i['before'] for i in bs)
+        self.afters = tuple(i['after'] for i in afs)
+        self.before_ids = tuple(i.get('id') for i in bs)
+        self.after_ids = tuple(i.get('id') for i in afs)
+        self.handlers = tuple(
+            i['before'] for i in interceptors
+            if i.get('id') == 'state_handler' and i.get('before'))
+
+
+    def __repr__(self):  # pragma: no cover
+        return f"Chain({[i.get('id') for i in self.interceptors]})"
+
+
+    def __iter__(self):
+        return iter(self.interceptors)
+
+
+
+def compile_chain(interceptors):
+    if isinstance(interceptors, Chain):
+        return interceptors
+    return Chain(interceptors)
+
+
+
+def exec_interceptors(ctx, fns, direction='before'):
+    """
+    Applies interceptor fns to `ctx` in order. A fn that raises is reported
+    to the event_handler error handler, and the chain goes on without it.
+    """
+    ev = ctx.coeffects['event']
+    for fn in fns:
+        try:
+            ctx = fn(ctx)
+        except Exception as e:
+            handler('error', 'event_handler')(e, ev, direction)
+    return ctx
+
+
+
+def exec_timed(ctx, fns, ids, phase, sink):
+    """exec_interceptors, reporting each fn's duration to `sink`."""
+    ev = ctx.coeffects['event']
+    for fn, id in zip(fns, ids):
+        t = time.perf_counter_ns()
+        try:
+            ctx = fn(ctx)
+        except Exception as e:
+            handler('error', 'event_handler')(e, ev, phase)
+        sink('interceptor', id, time.perf_counter_ns() - t,
+             {'phase': phase, 'event': ev})
     return ctx
 
 
@@ -44,29 +254,59 @@ def _run_queue(*args):
     Processes what's currently in the queue. New events will continue to be
     queued and processed in a future run.
     """
+    global runs
+    runs += 1
 
-    qlen = len(dq.unbox()) # only process what's in queue now...
-    events = dq.unbox()[qlen:]
-    for ev in events:
+    qlen = len(dq)    # only process what's in queue now...
+    if (sink := instrument.sink) is not None:
+        sink('queue', 'depth', qlen, {})
+    if (n := limits.unbox()['max_events']) is not None:
+        qlen = min(qlen, n)
+    j = journal.unbox()
+    h = history.unbox()
+    for _ in range(qlen):
+        if (ev := dq.get()) is None:
+            break   # dropped by an overflowing producer
+        seq = None
+        if j is not None:
+            try:
+                seq = j.append(ev)
+            except Exception as e:
+                handler('error', 'event_handler')(e, ev, 'journal')
 
         #fn = handler('event', ev[0])
         #r = fn(state, ev[1], ev[2])
 
         if interceptors := handler('event', ev[0]):
-            ctx = context(ev, interceptors)
-            error_handler = handler('error', 'event_handler')
+            chain = compile_chain(interceptors)
+            ctx = Context(ev)
             direction = 'before'
             try:
-                ctx = exec_interceptors(ctx, direction)
-                direction = 'after'
-                ctx = exec_interceptors(ctx, direction)
+                if sink is None:
+                    ctx = exec_interceptors(ctx, chain.befores)
+                    direction = 'after'
+                    ctx = exec_interceptors(ctx, chain.afters, direction)
+                else:
+                    ctx = exec_timed(
+                        ctx, chain.befores, chain.before_ids, 'before', sink)
+                    direction = 'after'
+                    ctx = exec_timed(
+                        ctx, chain.afters, chain.after_ids, 'after', sink)
             except Exception as e:
-                error_handler(e, ev, direction)
-        dq.swap(lambda q: q.popleft())
-        _exec_callbacks(ev, dq)
+                handler('error', 'event_handler')(e, ev, direction)
+        if h is not None:
+            h.record(ev, state.unbox(), seq)
+
+    if j is not None:
+        try:
+            j.commit(state.unbox())   # group commit, snapshots
+        except Exception as e:
+            handler('error', 'event_handler')(e, None, 'journal')
+
+    notify()    # watchers, once per run
 
     # if more events entered the queue during processing, run_queue again
-    if len(dq.unbox()) > 0:
+    if len(dq) > 0:
         return 'run_queue'
     # else, end run
     return 'end_run'
@@ -96,24 +336,101 @@ def fsm(t):
         ('running', 'end_run'):   (_end_run,   'idle')})
 
     s = 'idle'
-    def trigger_arg(t):
-        nonlocal stt
-        nonlocal s
+    runs = 0
+    max_runs = limits.unbox()['max_runs']
+    while t is not None:   # no trigger, end of run.
+        if t == 'run_queue' and max_runs is not None and runs >= max_runs:
+            return 'run_queue'   # out of runs, caller decides when to resume
         try:
             f,s = stt[(s,t)]   # fn and next state (fn, s1 <- s0, t0)
             t = f()            # next trigger <- fn (t1 <- fn)
-            if t is None:      # if no trigger, end of run.
-                return
-            trigger_arg(t)     # else, trigger next run
+            runs += 1
         except Exception as ex:
             print("exception: ", ex)
             s = 'idle'
             return
-    trigger_arg(t)
+
+
+
+def _enqueue(event):
+    dq.put(event)
+    _drain()
+
+
+
+def _drain():
+    # re-check after releasing: an event queued while the lock was held, and
+    # after the final queue check of that run, is picked up here.
+    while len(dq) > 0 and _running.acquire(blocking=False):
+        dq.consumer = threading.get_ident()
+        try:
+            t = fsm('run_queue')
+        finally:
+            dq.consumer = None
+            _running.release()
+        if t == 'run_queue':
+            time.sleep(0)   # out of runs, let other threads in before resuming
+
+
+
+def sync(timeout=None):
+    """
+    Waits until the events this thread has dispatched so far have been
+    processed, by this thread or whichever thread is running the queue.
+    Returns False on timeout. Returns at once when called while processing
+    an event (the queue can't wait on itself).
+    """
+    if dq.consumer == threading.get_ident():
+        return True
+    m = dq.mark()
+    _drain()
+    return m.wait(timeout)
 
 
 
 def dispatch(handler_id, qv, val):
     event = pyr.v(handler_id, qv, val)
-    dq.swap(lambda q, v: q.append(v), event)
-    fsm('run_queue')
+    if (tx := getattr(_tx, 'events', None)) is not None:
+        tx.append(event)
+        return
+    _enqueue(event)
+
+
+
+def dispatch_batch(events):
+    """
+    Dispatches `events`, a sequence of (handler_id, qv, val), as one 'batch'
+    event. Each event's handler is applied in order to one working state,
+    flows run once over all of the changes and state is committed once.
+    """
+    events = pyr.pvector(pyr.v(*ev) for ev in events)
+    if not events:
+        return
+    if (tx := getattr(_tx, 'events', None)) is not None:
+        tx.extend(events)
+        return
+    _enqueue(pyr.v('batch', None, events))
+
+
+
+@contextlib.contextmanager
+def transaction():
+    """
+    Collects every dispatch made in the block (by this thread) and dispatches
+    them as one batch on exit. Nothing is dispatched if the block raises.
+    Nested transactions join the outermost one.
+
+    with transaction():
+        dispatch('state', ['a'], 1)
+        dispatch('state', ['b'], 2)
+    """
+    if getattr(_tx, 'events', None) is not None:
+        yield
+        return
+    _tx.events = []
+    try:
+        yield
+        events = _tx.events
+    finally:
+        _tx.events = None
+    dispatch_batch(events)
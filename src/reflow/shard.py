@@ -0,0 +1,324 @@
+"""
+Sharded state over worker processes.
+
+    def setup(index, n):           # runs in each worker
+        register_flow({...})
+
+    with Cluster(4, setup, shared=[['config']]) as c:
+        c.dispatch('state', ['tenant-a', 'count'], 1)
+        c.get(['tenant-a', 'count'])
+
+State is partitioned by its top-level key: each key is hashed to one of n
+worker processes, each with its own state, flow graph and router, so the
+shards run on as many cores. dispatch sends an event to the shard owning the
+first key of its query vector (or the key returned by `route`), over a pipe.
+Events reaching a shard together are dispatched as one batch.
+
+Flows run on the shard they're registered on and can only read its state.
+Paths a flow needs from another shard must be declared `shared`: the owning
+shard sends the value at each shared path to every other shard whenever it
+changes, where it is written to the same path, so flows read it as usual.
+Replicas are eventually consistent and should be treated as read only.
+
+setup, route and values passed to call must be picklable when the
+multiprocessing start method is spawn.
+"""
+
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import zlib
+from concurrent.futures import Future
+
+from reflow.exceptions import ShardError
+from reflow.util import as_path
+
+
+_missing = object()
+
+
+
+def shard_of(key, n):
+    """Index of the shard owning top-level key `key`, stable across runs."""
+    return zlib.crc32(repr(key).encode()) % n
+
+
+
+def _worker(conn, index, n, setup, shared):
+    from reflow import fx, router
+    from reflow.registry import dq, get_in_state, history, journal
+    from reflow.router import dispatch, dispatch_batch
+    from reflow.subs import subscribe
+
+    # forked, the worker has copies of the parent's journal, history, queue
+    # and fx pool, but not the threads serving them
+    journal.reset(None)
+    history.reset(None)
+    dq.clear()
+    fx.set_pool(None)
+    router._running = threading.Lock()
+
+    if setup is not None:
+        setup(index, n)
+    owned = [pv for pv in shared if shard_of(pv[0], n) == index]
+    sent = dict.fromkeys(owned, _missing)
+
+    def _dispatch(events):
+        if len(events) == 1:
+            dispatch(*events[0])
+        elif events:
+            dispatch_batch(events)
+        events.clear()
+
+    def _mirror():
+        for pv in owned:
+            if (v := get_in_state(pv)) is not sent[pv]:
+                sent[pv] = v
+                conn.send([('mirror', pv, v)])
+
+    requests = {
+        'get': get_in_state,
+        'subscribe': subscribe,
+        'call': lambda fn, *args: fn(*args)}
+
+    _mirror()
+    while True:
+        try:
+            msgs = conn.recv()
+        except EOFError:
+            return
+        events = []
+        for msg in msgs:
+            if msg[0] == 'event':
+                events.append(msg[1])
+            elif msg[0] == 'events':
+                events.extend(msg[1])
+            elif msg[0] == 'mirror':
+                events.append(('state', msg[1], msg[2]))
+            elif msg[0] == 'stop':
+                _dispatch(events)
+                conn.close()
+                return
+            else:
+                _, rid, op, args = msg
+                _dispatch(events)
+                try:
+                    r = ('reply', rid, True, requests[op](*args))
+                except Exception as e:
+                    r = ('reply', rid, False, e)
+                conn.send([r])
+        _dispatch(events)
+        _mirror()
+
+
+
+class _Shard:
+    """
+    Parent side of a worker: its process, pipe, IO threads, and the futures of
+    requests awaiting a reply. `error` is set once the worker has died.
+    """
+
+    def __init__(self, cluster, index, ctx):
+        self.cluster = cluster
+        self.index = index
+        self.out = queue.SimpleQueue()
+        self.pending = {}
+        self.error = None
+        self._lock = threading.Lock()
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker, name=f'reflow-shard-{index}', daemon=True,
+            args=(child, index, cluster.n, cluster.setup, cluster.shared))
+        self.process.start()
+        child.close()
+        self.sender = threading.Thread(target=self._send, daemon=True)
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.sender.start()
+        self.reader.start()
+
+
+    def put(self, msg):
+        if self.error is not None:
+            raise self.error
+        self.out.put(msg)
+
+
+    def request(self, rid, fut, msg):
+        with self._lock:
+            if self.error is not None:
+                raise self.error
+            self.pending[rid] = fut
+        self.out.put(msg)
+
+
+    def _died(self):
+        self.process.join(1)
+        with self._lock:
+            self.error = ShardError(self.index, self.process.exitcode)
+            pending, self.pending = self.pending, {}
+        for fut in pending.values():
+            fut.set_exception(self.error)
+
+
+    def _send(self):
+        # messages queued since the last send go down the pipe as one list
+        while True:
+            msgs = [self.out.get()]
+            while len(msgs) < self.cluster.batch_size:
+                try:
+                    msgs.append(self.out.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.conn.send(msgs)
+            except OSError:
+                return   # worker gone, see _read
+            if msgs[-1][0] == 'stop':
+                return
+
+
+    def _read(self):
+        while True:
+            try:
+                msgs = self.conn.recv()
+            except (EOFError, OSError):
+                self._died()
+                return
+            for msg in msgs:
+                if msg[0] == 'reply':
+                    _, rid, ok, v = msg
+                    with self._lock:
+                        fut = self.pending.pop(rid)
+                    fut.set_result(v) if ok else fut.set_exception(v)
+                elif msg[0] == 'mirror':
+                    for s in self.cluster.shards:
+                        if s is not self and s.error is None:
+                            s.out.put(msg)
+
+
+
+class Cluster:
+    """
+    n shard worker processes (default: one per cpu).
+
+    setup:      fn(index, n) run in each worker at start, to register flows
+                and handlers
+    shared:     paths replicated from their owning shard to all others
+    route:      fn(handler_id, qv, val) returning the key an event is routed
+                by, default the first key of qv
+    batch_size: max messages sent down a pipe at once
+
+    If a worker dies (e.g. setup raised), its pending requests fail, and
+    later requests and dispatches routed to it raise, with ShardError.
+    """
+
+    def __init__(self, n=None, setup=None, shared=(), route=None,
+                 batch_size=1000, context=None):
+        self.n = n or os.cpu_count()
+        self.setup = setup
+        self.shared = tuple(as_path(pv) for pv in shared)
+        self.route = route
+        self.batch_size = batch_size
+        self.context = context
+        self.shards = []
+        self._rids = itertools.count()
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+    def start(self):
+        ctx = multiprocessing.get_context(self.context)
+        self.shards = [_Shard(self, i, ctx) for i in range(self.n)]
+        return self
+
+
+    def stop(self):
+        """Processes what's been sent, then stops the workers."""
+        for s in self.shards:
+            s.out.put(('stop',))
+        for s in self.shards:
+            if s.error is None:
+                s.sender.join()
+            s.process.join()
+            s.conn.close()
+        self.shards = []
+
+
+    def shard_of(self, key):
+        return shard_of(key, self.n)
+
+
+    def _shard(self, handler_id, qv, val):
+        if self.route is not None:
+            return self.shards[shard_of(self.route(handler_id, qv, val), self.n)]
+        if not qv:
+            raise ValueError(
+                f"Can't route event {handler_id!r} without a query vector")
+        return self.shards[shard_of(qv[0], self.n)]
+
+
+    def dispatch(self, handler_id, qv, val):
+        self._shard(handler_id, qv, val).put(('event', (handler_id, qv, val)))
+
+
+    def dispatch_batch(self, events):
+        """
+        Dispatches `events`, (handler_id, qv, val) each, as one batch per
+        shard. Atomic per shard only.
+        """
+        by_shard = {}
+        for ev in events:
+            by_shard.setdefault(self._shard(*ev), []).append(ev)
+        for s, evs in by_shard.items():
+            s.put(('events', evs))
+
+
+    def _request(self, s, op, *args):
+        rid = next(self._rids)
+        fut = Future()
+        s.request(rid, fut, ('request', rid, op, args))
+        return fut
+
+
+    def get(self, pv, timeout=None):
+        """Value at path `pv`, from its owning shard."""
+        pv = as_path(pv)
+        return self._request(
+            self.shards[shard_of(pv[0], self.n)], 'get', pv).result(timeout)
+
+
+    def subscribe(self, id, key, *args, timeout=None):
+        """Value of flow (or sub) `id` on the shard owning `key`."""
+        return self._request(
+            self.shards[shard_of(key, self.n)], 'subscribe', id, *args
+        ).result(timeout)
+
+
+    def call(self, index, fn, *args, timeout=None):
+        """fn(*args) in shard `index`, once the events sent before are done."""
+        return self._request(
+            self.shards[index], 'call', fn, *args).result(timeout)
+
+
+    def broadcast(self, fn, *args, timeout=None):
+        """fn(*args) in every shard, the results in shard order."""
+        fs = [self._request(s, 'call', fn, *args) for s in self.shards]
+        return [f.result(timeout) for f in fs]
+
+
+    def flush(self, timeout=None):
+        """Waits until every shard has processed all events sent so far."""
+        self.broadcast(_noop, timeout=timeout)
+
+
+
+def _noop():
+    pass
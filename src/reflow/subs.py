@@ -1,7 +1,41 @@
+import collections
+import threading
 import pyrsistent as pyr
-from reflow.exceptions import FlowArgumentError, SubscribeArgumentError
-from .util import is_str, upssoc_in, is_list, is_dict, any_key, dissoc
-from .registry import flows, get_in_state, flow_path, get_flow
+from reflow.exceptions import (
+    ComputeArgumentError,
+    FlowArgumentError,
+    GraphCycleError,
+    SignalArgumentError,
+    SubscribeArgumentError)
+from .util import (
+    Path,
+    as_path,
+    is_str,
+    upssoc_in,
+    is_list,
+    is_dict,
+    any_key,
+    dissoc,
+    getter,
+    nargs,
+    path_key)
+from .registry import (
+    state as app_state,
+    register_handler,
+    flows,
+    new_flows,
+    removed_flows,
+    watchers,
+    changed,
+    handler,
+    get_in_state,
+    flow_path,
+    get_flow)
+from .graph import compile_flow, dag, lazy_value
+from . import diff
+
+
+_unset = object()
 
 
 def flow(id):
@@ -9,11 +43,11 @@ def flow(id):
 
 
 def path(p):
-    return pyr.pmap({'path': p})
+    return pyr.pmap({'path': as_path(p)})
 
 
 def state(p):
-    if is_list(p):
+    if is_list(p) or isinstance(p, Path):
         return get_in_state(p)
     elif is_str(p):
         return get_in_state([p])
@@ -21,10 +55,256 @@ def state(p):
         print("ERROR")
 
 
-def subscribe(id, *args):
+class SubCache:
+    """
+    Bounded LRU cache of parameterized subscription values, keyed by
+    (id, qry_v), qry_v frozen if it holds lists or dicts. An entry is reused
+    for as long as each of its inputs is the identical object in state,
+    otherwise its value is recomputed. Query vectors that can't be hashed
+    even frozen are never cached.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+
+    def get(self, key):
+        with self._lock:
+            if (e := self.entries.get(key)) is not None:
+                self.entries.move_to_end(key)
+            return e
+
+
+    def put(self, key, e):
+        with self._lock:
+            self.entries[key] = e
+            self.entries.move_to_end(key)
+            self._evict()
+
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+    def _evict(self):
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+
+    def discard(self, id):
+        """Drops every entry of subscription `id`."""
+        with self._lock:
+            for k in [k for k in self.entries if k[0] == id]:
+                del self.entries[k]
+
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+
+    def stats(self):
+        return {'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+
+
+sub_cache = SubCache()
+
+
+
+class _SubEntry:
+    # result: (inputs, value) of the last computation, replaced as one
+    __slots__ = ('names', 'getters', 'result')
+
+
+
+def _spec_path(v):
+    if is_dict(v):
+        return v['path'] if 'path' in v else flow_path(v['flow'])
+    return v
+
+
+
+def _sub_entry(h, qry_v):
+    signal_fn, _, signal_nargs, _ = h
+    spec = signal_fn(qry_v) if signal_nargs else signal_fn()
+    e = _SubEntry()
+    if is_dict(spec) and not any_key(['flow', 'path'], spec):
+        e.names = tuple(spec)
+        e.getters = tuple(getter(_spec_path(v)) for v in spec.values())
+    else:
+        e.names = None
+        e.getters = (getter(_spec_path(spec)),)
+    e.result = None
+    return e
+
+
+
+def _sub_key(id, qry_v):
+    try:
+        hash(qry_v)
+        return (id, qry_v)
+    except TypeError:
+        pass
+    try:
+        k = (id, pyr.freeze(qry_v))
+        hash(k)
+        return k
+    except TypeError:
+        return None
+
+
+
+def _sub_value(h, id, qry_v):
+    if (key := _sub_key(id, qry_v)) is None:
+        e = _sub_entry(h, qry_v)   # not cached
+    elif (e := sub_cache.get(key)) is None:
+        e = _sub_entry(h, qry_v)
+        sub_cache.put(key, e)
+    s = app_state.unbox()
+    ins = tuple(g(s) for g in e.getters)
+    if (r := e.result) is not None \
+        and all(a is b for a, b in zip(ins, r[0])):
+        sub_cache.record(True)
+        return r[1]
+    sub_cache.record(False)
+    _, compute_fn, _, compute_nargs = h
+    x = dict(zip(e.names, ins)) if e.names is not None else ins[0]
+    v = compute_fn(x, qry_v) if compute_nargs == 2 else compute_fn(x)
+    e.result = (ins, v)
+    return v
+
+
+
+def register_sub(id, signal_fn, compute_fn):
+    """
+    Registers parameterized subscription `id`, read with subscribe(id, *qry_v).
+
+    signal_fn(qry_v) returns the inputs: a path, path(...), flow(...), or a
+    map of names to those. compute_fn(inputs, qry_v) derives the value from
+    them (inputs being a map of values if signal_fn returned one). Either fn
+    may leave out qry_v.
+
+    register_sub('item',
+                 lambda qry_v: ['items', qry_v[0]],
+                 lambda item: item['price'] * item['qty'])
+    subscribe('item', 42)
+    """
+    signal_nargs, compute_nargs = nargs(signal_fn), nargs(compute_fn)
+    if signal_nargs > 1:
+        raise SignalArgumentError(signal_nargs)
+    if compute_nargs not in (1, 2):
+        raise ComputeArgumentError(compute_nargs)
+    register_handler(
+        'sub', id, (signal_fn, compute_fn, signal_nargs, compute_nargs))
+    sub_cache.discard(id)
+
+
+
+def _flow_value(id):
+    if (p := dag.plans.get(id)) is not None and p.lazy:
+        return lazy_value(id)
     return get_in_state(flow_path(id))
 
 
+
+def subscribe(id, *args, on_change=None):
+    """
+    Current value of flow `id`. If `on_change` is given it is also registered
+    as a watcher, called with the new value whenever the flow's output
+    changes (see notify).
+
+    A lazy flow is computed here, when stale. Its value stays cached while it
+    has watchers, unsubscribing the last one drops it.
+
+    If `id` is a parameterized subscription (see register_sub), its value for
+    query vector `args`, memoized in `sub_cache`. If it is a Path, the value
+    in state at that path (no watchers).
+    """
+    if type(id) is Path:
+        if args or on_change:
+            raise SubscribeArgumentError()
+        return get_in_state(id)
+    if h := handler('sub', id):
+        if on_change:
+            raise SubscribeArgumentError()
+        return _sub_value(h, id, args)
+    if args:
+        raise SubscribeArgumentError()
+    v = _flow_value(id)
+    if on_change:
+        if id not in watchers.unbox():
+            _notified[id] = v
+        watchers.swap(lambda m: m.set(id, m.get(id, pyr.v()).append(on_change)))
+    return v
+
+
+def unsubscribe(id, on_change):
+    """Removes watcher `on_change` from flow `id`."""
+    def _remove(m):
+        if (cbs := m.get(id, pyr.v()).remove(on_change)):
+            return m.set(id, cbs)
+        return m.discard(id)
+    try:
+        watchers.swap(_remove)
+    except ValueError:
+        pass
+    if id not in watchers.unbox():
+        dag.release(id)
+        _notified.pop(id, None)
+
+
+_notified = {}  # flow id -> last value passed to its watchers
+
+
+def notify():
+    """
+    Calls the watchers of each flow whose output changed since the last call,
+    once per watcher however many events changed it. Called by the router
+    after each run of the queue, so a batch of events is coalesced. Values
+    are compared to the last notified value with diff.changed. A watcher
+    unsubscribed by an earlier one is not called.
+    """
+    if not (ids := changed.unbox()):
+        return
+    changed.swap(lambda x: x.difference(ids))
+    for id in ids:
+        if not (cbs := watchers.unbox().get(id)):
+            continue   # unsubscribed since
+        v = _flow_value(id)
+        o = _notified.get(id, _unset)
+        if o is not _unset and not diff.changed(o, v):
+            continue
+        _notified[id] = v
+        for cb in cbs:
+            if cb not in watchers.unbox().get(id, ()):
+                continue   # unsubscribed meanwhile
+            try:
+                cb(v)
+            except Exception as e:
+                handler('error', 'event_handler')(e, id, 'watcher')
+
+
 def validate_flow(m):
     if id := m['id']:
         pass
@@ -43,15 +323,22 @@ def validate_flow(m):
         pass
     else:
         raise FlowArgumentError(id, 'output')
+    # paths index the flow graph, so they must hash (see util.path_key)
+    pvs = [m['path']] + [v['path'] for ik in ('inputs', 'active_inputs')
+                         for v in m[ik].values()
+                         if is_dict(v) and 'path' in v]
+    try:
+        for pv in pvs:
+            path_key(pv)
+    except TypeError:
+        raise FlowArgumentError(id, 'path')
 
 
 
 def default_flow(id):
     return pyr.pmap({
         'id': id,
-        '__new__': True if not get_flow(id) else False,
-        '__removed__': False,
-        'path': pyr.pvector([id]),
+        'path': Path((id,)),
         'inputs': pyr.pmap(),
         'active_inputs': pyr.pmap(),
         'is_active': lambda m: True,
@@ -62,26 +349,41 @@ def default_flow(id):
 def register_flow(d):
     mid = d['id']
     m = default_flow(mid)
-    m = m.update(d)
+    m = m.update(pyr.freeze(d, strict=False))
 
     def _input_paths(x,y,ik):
         if ik in y:
             for k,v in y.get(ik).items():
-                x = upssoc_in(x, [ik,k], path(v) if is_list(v) else v)
+                if is_list(v) or isinstance(v, Path):
+                    v = path(v)
+                x = upssoc_in(x, [ik,k], v)
         return x
 
+    m = m.set('path', as_path(m['path']))
     m = _input_paths(m, d, 'inputs')
     m = _input_paths(m, d, 'active_inputs')
 
     try:
         validate_flow(m)
-    except FlowArgumentError as e:
+        dag.add(compile_flow(m))
+    except (FlowArgumentError, GraphCycleError) as e:
         print(e.message)
         return
 
+    if not get_flow(mid):
+        new_flows.swap(lambda x: x.add(mid))
     flows.swap(upssoc_in, pyr.pvector([mid]), m)
 
 
+def remove_flow(id):
+    """
+    Marks flow `id` for removal. Its remove fn runs, and it leaves the flow
+    register, on the next run of the flow graph.
+    """
+    if get_flow(id):
+        removed_flows.swap(lambda x: x.add(id))
+
+
 
 #TODO:
 #register_fx
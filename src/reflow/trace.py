@@ -0,0 +1,150 @@
+"""
+Sampling trace of state changes, cheap enough to leave on under load.
+
+    from reflow import trace
+    t = trace.Tracer(size=10000, rate=0.01)
+    trace.install(t)
+    ...
+    t.export('/tmp/reflow-trace.jsonl')
+
+For a sampled event the tracer records the event, its processing time and
+the paths it changed (flow outputs included), found with diff so the cost is
+that of the changed spines. Records are kept in a ring buffer of `size`
+records, each holding at most `max_paths` changes with values cut to
+`max_value` characters, so memory is bounded whatever the traffic and state.
+"""
+
+import collections
+import itertools
+import json
+import random
+import time
+
+from reflow.diff import diff, REMOVED
+from reflow.events import interceptor
+from reflow.registry import handlers, register_handler
+from reflow.router import compile_chain
+
+
+
+def _short(v, n):
+    r = repr(v)
+    return r if len(r) <= n else r[:n] + '...'
+
+
+
+class Tracer:
+    """
+    Ring buffer of trace records, filled by its interceptor.
+
+    size:      records kept, older records are dropped
+    rate:      fraction of events sampled, 0 to 1
+    max_paths: changes recorded per event, the rest are only counted
+    max_value: characters of each value's repr recorded
+    """
+
+    def __init__(self, size=1000, rate=1.0, max_paths=20, max_value=80):
+        self.records = collections.deque(maxlen=size)
+        self.rate = rate
+        self.max_paths = max_paths
+        self.max_value = max_value
+        self.seen = 0
+        self.sampled = 0
+        self._seq = itertools.count(1)
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    def interceptor(self):
+        """
+        The trace interceptor. Place it between do_fx and flow_interceptor,
+        so it sees state after flows have run, as install does.
+        """
+        def before(ctx):
+            self.seen += 1
+            if self.rate >= 1 or random.random() < self.rate:
+                ctx.coeffects = ctx.coeffects.set(
+                    'trace', time.perf_counter_ns())
+            return ctx
+
+        def after(ctx):
+            if (t := ctx.coeffects.get('trace')) is not None:
+                self._record(ctx, time.perf_counter_ns() - t)
+            return ctx
+
+        return interceptor(id='trace', before=before, after=after)
+
+
+    def _record(self, ctx, ns):
+        self.sampled += 1
+        ev = ctx.coeffects['event']
+        o = ctx.coeffects.get('state')
+        n = ctx.effects.get('state', o)
+        changes = []
+        count = 0
+        for kind, p, ov, nv in diff(o, n):
+            count += 1
+            if count > self.max_paths:
+                break   # only know there are more, don't walk them all
+            v = ov if kind is REMOVED else nv
+            changes.append((kind, list(p), _short(v, self.max_value)))
+        self.records.append({
+            'seq': next(self._seq),
+            'time': time.time(),
+            'event': ev[0],
+            'query': _short(ev[1], self.max_value),
+            'value': _short(ev[2], self.max_value),
+            'us': ns / 1000,
+            'changes': changes,
+            'truncated': count > self.max_paths})
+
+
+    def clear(self):
+        self.records.clear()
+
+
+    def export(self, f):
+        """
+        Writes the buffered records, oldest first, as JSON lines to `f`, a
+        path or a file object. Returns the number of records written.
+        """
+        records = list(self.records)
+        if isinstance(f, str):
+            with open(f, 'w') as fp:
+                return self.export(fp)
+        for r in records:
+            f.write(json.dumps(r, default=repr))
+            f.write('\n')
+        return len(records)
+
+
+
+def _chain_with(chain, i):
+    ids = [x.get('id') for x in chain]
+    ics = [x for x in chain if x.get('id') != 'trace']
+    if i is not None:
+        ics.insert(ids.index('do_fx') + 1 if 'do_fx' in ids else 0, i)
+    return compile_chain(ics)
+
+
+
+def install(tracer, ids=None):
+    """
+    Adds `tracer`'s interceptor to the registered event handlers `ids`, all of
+    them by default, replacing any tracer already there. Event handlers
+    registered afterwards are not traced.
+    """
+    i = tracer.interceptor()
+    for id, chain in handlers.unbox()['event'].items():
+        if ids is None or id in ids:
+            register_handler('event', id, _chain_with(chain, i))
+
+
+
+def uninstall(ids=None):
+    """Removes the trace interceptor from event handlers `ids` (default all)."""
+    for id, chain in handlers.unbox()['event'].items():
+        if ids is None or id in ids:
+            register_handler('event', id, _chain_with(chain, None))
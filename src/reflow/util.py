@@ -1,5 +1,4 @@
 import copy
-import operator
 import typing
 import inspect
 from decorator import decorator
@@ -7,13 +6,23 @@ import pyrsistent as pyr
 from concurrent.futures import ThreadPoolExecutor
 import asyncio
 import functools
+from collections.abc import Mapping
 from .exceptions import DictTypeError
 
 
+_executor = ThreadPoolExecutor(thread_name_prefix='reflow')
+
+
 def as_async(fn, *args):
-    loop = asyncio.new_event_loop()
-    result = loop.run_in_executor(ThreadPoolExecutor(max_workers=1), fn, *args)
-    return result
+    """
+    Runs fn(*args) on a shared worker pool. Returns an awaitable asyncio
+    future when called from a running loop, else a concurrent future.
+    """
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return _executor.submit(fn, *args)
+    return loop.run_in_executor(_executor, fn, *args)
 
 
 def cache(f):
@@ -24,37 +33,221 @@ def partial(f,a):
     return functools.partial(f,a)
 
 
+class Path(tuple):
+    """
+    A path into nested maps, an immutable and hashable tuple of keys.
+
+    Paths are interned: Path(['a', 'b']) returns the same object every time,
+    so the thousands of flows reading the same path share one, and paths make
+    cheap dict keys. Equal to, and hashing as, the plain tuple of its keys.
+    Keys are kept as given. A path with unhashable keys (a slice, before
+    python 3.12) isn't interned or hashable, see path_key.
+    """
+    __slots__ = ()
+    _interned = {}
+    _max_interned = 100000   # paths made beyond this are not shared
+
+    def __new__(cls, keys=()):
+        if type(keys) is cls:
+            return keys
+        t = tuple(keys)
+        try:
+            p = cls._interned.get(t)
+        except TypeError:   # unhashable keys
+            return super().__new__(cls, t)   # not interned
+        if p is not None:
+            return p
+        p = super().__new__(cls, t)
+        if len(cls._interned) < cls._max_interned:
+            p = cls._interned.setdefault(t, p)
+        return p
+
+
+    def __repr__(self):
+        return f"Path({list(self)!r})"
+
+
+    def __getnewargs__(self):
+        return (tuple(self),)
+
+
+
+def key_of(k):
+    """Hashable form of path key `k`: a slice as (slice, start, stop, step)."""
+    if type(k) is slice:
+        return (slice, k.start, k.stop, k.step)
+    return k
+
+
+
+def path_key(pv):
+    """
+    Hashable form of path `pv`, for indexing paths: `pv` itself, or the tuple
+    of its keys' key_of if it has unhashable (slice) keys. Raises TypeError
+    if it has other unhashable keys.
+    """
+    try:
+        hash(pv)
+        return pv
+    except TypeError:
+        pk = tuple(map(key_of, pv))
+        hash(pk)
+        return pk
+
+
+
+def as_path(pv):
+    """
+    `pv` as a Path: a Path, a list, tuple or pvector of keys, or a single
+    string key. None stays None.
+    """
+    if pv is None or type(pv) is Path:
+        return pv
+    if isinstance(pv, str):
+        return Path((pv,))
+    return Path(pv)
+
+
 def get_in(m,pv,default=None):
     try:
-        return functools.reduce(operator.getitem, pv, m)
+        for k in pv:
+            m = m[k]
+        return m
     except (KeyError, TypeError):
         return default
 
 
+def getter(pv,default=None):
+    """
+    Prebinds path `pv`, returning a fn of a map equivalent to get_in(m, pv).
+    """
+    if pv is None:
+        return lambda m: default
+    pv = as_path(pv)
+    def get(m):
+        try:
+            for k in pv:
+                m = m[k]
+            return m
+        except (KeyError, TypeError):
+            return default
+    return get
+
+
 def key_in(m,pv):
     if get_in(m,pv):
         return True
     return False
 
 
+_missing = object()
+
+
+def _frozen(v):
+    """
+    Freeze plain python containers on their way into a pmap. Persistent values
+    are returned as is so their structure stays shared.
+    """
+    if type(v) in (dict, list, set):
+        return pyr.freeze(v, strict=False)
+    return v
+
+
+def _is_pmap(m):
+    # a pmap, or a persistent map with its interface (router.Context)
+    return isinstance(m, pyr._pmap.PMap) \
+        or (isinstance(m, Mapping) and hasattr(m, 'evolver'))
+
+
+def _node_get(node, k):
+    if _is_pmap(node):
+        return node.get(k, _missing)
+    return node[k] if k in node else _missing
+
+
+def _node_set(node, k, v):
+    if _is_pmap(node):
+        return node.set(k, v)
+    nm = dict(node)
+    nm[k] = v
+    return nm
+
+
+def _node_del(node, k):
+    if _is_pmap(node):
+        return node.remove(k)
+    nm = dict(node)
+    del nm[k]
+    return nm
+
+
+class _Nested(Exception):
+    """
+    Raised by _spine at a node on the path that sets the rest of the path
+    itself (it has a set_in method, e.g. a columnar.Region), at pv[:i].
+    """
+    def __init__(self, i, node):
+        self.i = i
+        self.node = node
+
+
+
+def _spine(m, pv, create):
+    """
+    Collects the maps along path `pv` (excluding the last key). Missing or
+    non-map nodes are replaced by an empty map when `create` is set, otherwise
+    a KeyError is raised.
+    """
+    frozen = dict_type(m) == 'pmap'
+    nodes = [m]
+    for k in pv[:-1]:
+        c = _node_get(nodes[-1], k)
+        if c is _missing or not dict_type(c):
+            if create and hasattr(c, 'set_in'):
+                raise _Nested(len(nodes), c)
+            if not create:
+                raise KeyError(k)
+            c = pyr.m() if frozen else {}
+        elif frozen and type(c) is dict:
+            c = pyr.freeze(c, strict=False)
+        nodes.append(c)
+    return nodes
+
+
+def _rebuild(nodes, pv, v):
+    """
+    Rebuilds the spine bottom up, from the new value `v` of the last node.
+    Only the maps along the path are replaced, siblings are shared.
+    """
+    for node, k in zip(reversed(nodes), reversed(pv[:-1])):
+        v = _node_set(node, k, v)
+    return v
+
+
 def mset(m,pv,v):
     """
     `mset`
 
     Map set. Set or update a value in nested map `m` by path `pv`.
     Path (or part thereof) will be created if it doesn't already exist.
+
+    Only the maps along the path are copied (a pmap `set` per level), every
+    other subtree is shared with `m`. Plain python containers written into a
+    pmap are frozen.
+
+    A node on the path with a set_in method (a columnar.Region) sets the rest
+    of the path itself: node.set_in(rest, v) returns its new value.
     """
-    _nm = nm = dict_copy(m)
-    for i, k in enumerate(pv):
-        if i == len(pv) - 1:
-            _nm[k] = v
-        else:
-            if not k in _nm:
-                _nm[k] = {}
-            elif not dict_type(_nm[k]):
-                _nm[k] = {}
-            _nm = _nm[k]
-    return pyr.freeze(nm, strict=True) if dict_type(m) == 'pmap' else nm
+    if not pv:
+        return m
+    pv = list(pv)
+    try:
+        nodes = _spine(m, pv, True)
+    except _Nested as e:
+        return mset(m, pv[:e.i], e.node.set_in(pv[e.i:], v))
+    if dict_type(m) == 'pmap':
+        v = _frozen(v)
+    return _rebuild(nodes[:-1], pv, _node_set(nodes[-1], pv[-1], v))
 
 
 
@@ -64,8 +257,17 @@ def upssoc_in(m,pv,v):
     If pv path exists and current v == new v, return orig unmodified map.
     If pv path exists and current v != new v, set v, return new map.
     If pv path does not exist, create key(s), set v, return new map.
+
+    Identical values short circuit. Persistent containers that are not
+    identical are treated as changed rather than deep compared, as setting them
+    is cheaper than comparing them.
     """
-    if get_in(m, pv) != v:
+    o = get_in(m, pv, _missing)
+    if o is v:
+        return m
+    if o is _missing \
+        or isinstance(v, (pyr._pmap.PMap, pyr._pvector.PVector)) \
+        or o != v:
         m = mset(m, pv, v)
     return m
 
@@ -76,19 +278,16 @@ def assoc(m,k,v):
 
 
 def dissoc(m,k):
-    nm = dict_copy(m)
     try:
-        del nm[k]
+        return _node_del(m, k)
     except (KeyError):
-        pass
-    return pyr.freeze(nm, strict=True) if dict_type(m) == 'pmap' else nm
+        return m
 
 
 def dissoc_in(m,pv):
-    *_pv, k = pv
-    nm = dict_copy(m)
-    del functools.reduce(operator.getitem, _pv, nm)[k]
-    return pyr.freeze(nm, strict=True) if dict_type(m) == 'pmap' else nm
+    pv = list(pv)
+    nodes = _spine(m, pv, False)
+    return _rebuild(nodes[:-1], pv, _node_del(nodes[-1], pv[-1]))
 
 
 def update(m,k,f,*args):
@@ -212,7 +411,7 @@ def dict_copy(m,thaw=True):
 
 
 def dict_type(m):
-    if isinstance(m, pyr._pmap.PMap):
+    if _is_pmap(m):
         return 'pmap'
     elif isinstance(m, typing.Dict):
         return 'dict'
@@ -220,30 +419,6 @@ def dict_type(m):
         return False
 
 
-def dict_diff(m1,m2):
-    acc={'m1': [], 'm2': [], 'common_m1': [], 'common_m2': []}
-
-    def _sort(m):
-        return sorted(m, key=lambda x: x['path'])
-
-    def _diff(x,y,m,acc,path):
-        c = 'common_' + str(m)
-        for k in x:
-            if k in y:
-                if is_dict(x[k]):
-                    _diff(x[k],y[k], m, acc, path.__add__([k]))
-                elif x[k] != y[k]:
-                    acc[m] = acc[m] + [{'path': path.__add__([k]), 'val': y[k]}]
-                elif x[k] == y[k]:
-                    acc[c] = acc[c] + [{'path': path.__add__([k]), 'val': x[k]}]
-            else:
-                acc[m] = acc[m] + [{'path': path.__add__([k]), 'val': x[k]}]
-
-    _diff(m1,m2,'m2',acc, [])
-    _diff(m2,m1,'m1',acc, [])
-    return _sort(acc['m1']),_sort(acc['m2']), _sort(acc['common_m1']), _sort(acc['common_m2'])
-
-
 def any_key(kv,m):
     if not is_list(kv):
         kv = [kv]
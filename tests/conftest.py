@@ -0,0 +1,36 @@
+import config   # puts src on sys.path
+import pyrsistent as pyr
+import pytest
+
+from reflow import persist
+from reflow.graph import drop_flow
+from reflow import subs
+from reflow.registry import changed, handlers, state, watchers
+from reflow.subs import register_flow
+
+
+@pytest.fixture
+def app_state():
+    """Empty state, with the handlers and watchers restored after the test."""
+    boxes = [(b, b.unbox()) for b in (state, handlers, watchers, changed)]
+    notified = dict(subs._notified)
+    state.reset(pyr.m())
+    yield state
+    persist.stop()
+    for b, v in boxes:
+        b.reset(v)
+    subs._notified.clear()
+    subs._notified.update(notified)
+
+
+@pytest.fixture
+def register():
+    """register_flow, dropping the flows registered after the test."""
+    ids = []
+
+    def _register(d):
+        register_flow(d)
+        ids.append(d['id'])
+    yield _register
+    for id in ids:
+        drop_flow(id)
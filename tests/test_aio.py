@@ -0,0 +1,90 @@
+import asyncio
+import threading
+
+import pyrsistent as pyr
+
+from reflow import AsyncRouter, dispatch, dispatch_async
+from reflow.events import do_fx, interceptor
+from reflow.registry import register_handler
+from reflow.router import compile_chain
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 10))
+
+
+def test_dispatch_async(app_state):
+    async def main():
+        async with AsyncRouter():
+            await dispatch_async('state', ['a'], 1)
+            return app_state.unbox()
+    assert run(main()) == pyr.m(a=1)
+
+
+def test_resolves_once_processed_by_a_busy_router(app_state):
+    gate, entered = threading.Event(), threading.Event()
+
+    def block(ctx):
+        entered.set()
+        gate.wait(5)
+        return ctx
+
+    register_handler('event', 'block', compile_chain([
+        interceptor('block', before=block)]))
+    t = threading.Thread(target=dispatch, args=('block', None, None))
+    t.start()                         # holds the router until the gate opens
+    assert entered.wait(5)
+
+    async def main():
+        async with AsyncRouter() as r:
+            task = asyncio.ensure_future(r.dispatch_async('state', ['a'], 1))
+            await asyncio.sleep(0.05)
+            pending = not task.done()
+            gate.set()
+            await task
+            return pending, app_state.unbox()
+    try:
+        assert run(main()) == (True, pyr.m(a=1))
+    finally:
+        gate.set()
+        t.join(5)
+
+
+def test_watch(app_state, register):
+    register({'id': 'dbl', 'inputs': {'x': ['x']},
+              'output': lambda x: (x or 0) * 2})
+
+    async def main():
+        async with AsyncRouter() as r:
+            await r.dispatch_async('state', ['x'], 1)
+            seen = []
+            it = r.watch('dbl')
+            seen.append(await it.__anext__())
+            await r.dispatch_async('state', ['x'], 2)
+            seen.append(await it.__anext__())
+            await it.aclose()
+            return seen
+    assert run(main()) == [2, 4]
+
+
+def test_coroutine_fx_run_on_the_loop(app_state):
+    done = []
+
+    async def effect(v):
+        await asyncio.sleep(0)
+        done.append((v, asyncio.get_running_loop()))
+
+    def before(ctx):
+        ctx.effects = ctx.effects.set('afx', ctx.coeffects['event'][2])
+        return ctx
+
+    register_handler('fx', 'afx', effect)
+    register_handler('event', 'afx', compile_chain([
+        do_fx(), interceptor('afx', before=before)]))
+
+    async def main():
+        async with AsyncRouter() as r:
+            await r.dispatch_async('afx', None, 7)
+        return asyncio.get_running_loop()
+    loop = run(main())
+    assert done == [(7, loop)]
@@ -0,0 +1,97 @@
+import time
+
+import pyrsistent as pyr
+import pytest
+
+from reflow import cofx, router
+from reflow.events import inject_cofx, interceptor
+from reflow.registry import dq, register_handler
+from reflow.router import compile_chain
+
+
+def counter():
+    n = [0]
+
+    def fn():
+        n[0] += 1
+        return n[0]
+    return fn
+
+
+def test_cached_until_invalidated():
+    p = cofx.Provider('n', counter())
+    assert (p.value(), p.value()) == (1, 1)
+    p.invalidate()
+    assert p.value() == 2
+    assert p.stats() == {'size': 1, 'hits': 1, 'misses': 2}
+
+
+def test_ttl():
+    p = cofx.Provider('n', counter(), ttl=0.05)
+    assert (p.value(), p.value()) == (1, 1)
+    time.sleep(0.06)
+    assert p.value() == 2
+
+
+def test_version():
+    v = [0]
+    p = cofx.Provider('n', counter(), version=lambda: v[0])
+    assert (p.value(), p.value()) == (1, 1)
+    v[0] += 1
+    assert (p.value(), p.value()) == (2, 2)
+
+
+def test_ttl_and_version_expire_on_either():
+    v = [0]
+    p = cofx.Provider('n', counter(), ttl=60, version=lambda: v[0])
+    p.value()
+    v[0] += 1
+    assert p.value() == 2
+
+
+def test_cached_per_val():
+    calls = []
+
+    @cofx.provider('sq')
+    def sq(x):
+        calls.append(x)
+        return x * x
+
+    assert (sq.value(2), sq.value(3), sq.value(2)) == (4, 9, 4)
+    assert calls == [2, 3]
+    sq.invalidate(2)
+    sq.value(2)
+    sq.value(3)
+    assert calls == [2, 3, 2]
+    sq.invalidate(all=True)
+    assert sq.stats()['size'] == 0
+    assert cofx.Provider('l', len).value([1, 2]) == 2   # unhashable val
+    assert cofx.Provider('c', lambda: 1)(pyr.m(), None) == pyr.m(c=1)
+
+
+@pytest.fixture
+def limits():
+    old = router.limits.unbox()
+    yield router.configure
+    router.limits.reset(old)
+
+
+def test_per_run_across_a_multi_run_drain(app_state, limits):
+    seen = []
+    p = cofx.Provider('run', counter(), version=cofx.per_run)
+    register_handler('cofx', 'run', p)
+
+    def before(ctx):
+        seen.append((ctx.coeffects['event'][2], ctx.coeffects['run']))
+        return ctx
+
+    register_handler('event', 'tick', compile_chain([
+        inject_cofx('run'), interceptor('record', before=before)]))
+    limits(max_events=2)
+    runs = router.runs
+    for i in range(5):
+        dq.put(pyr.v('tick', None, i))
+    router._drain()
+    assert router.runs - runs == 3
+    assert seen == [(0, 1), (1, 1), (2, 2), (3, 2), (4, 3)]
+    assert p.stats()['misses'] == 3
@@ -0,0 +1,75 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from reflow import dispatch, subscribe
+from reflow.columnar import Region, mount
+
+
+def test_element_write_copies_only_its_chunk():
+    r = Region(np.arange(10), chunk=4)
+    r2 = r.set_in([5], -1)
+    assert r2[5] == -1 and r[5] == 5
+    a, b = r._split(), r2._split()
+    assert a[0] is b[0] and a[2] is b[2]
+    assert a[1] is not b[1]
+    assert list(r2) == [0, 1, 2, 3, 4, -1, 6, 7, 8, 9]
+
+
+def test_slice_write_across_chunks():
+    r = Region(np.zeros(10), chunk=4)
+    r2 = r.update([(range(3, 9), 1.0)])
+    assert list(r2.array) == [0, 0, 0, 1, 1, 1, 1, 1, 1, 0]
+    assert not r.array.any()
+    r3 = r2.update([(slice(0, 10, 3), 2.0), (-1, 5.0)])
+    assert list(r3.array) == [2, 0, 0, 2, 1, 1, 2, 1, 1, 5]
+    assert r3._split()[1] is not r2._split()[1]
+
+
+def test_multi_axis_write():
+    r = Region(np.zeros((6, 2)), chunk=4)
+    r2 = r.update([((4, 1), 3.0), ((slice(0, 2), 0), 1.0)])
+    assert r2.array.tolist() == [[1, 0], [1, 0], [0, 0], [0, 0],
+                                 [0, 3], [0, 0]]
+
+
+def test_arrays_are_read_only():
+    r = Region(np.arange(4)).set_in([0], 9)
+    with pytest.raises(ValueError):
+        r.array[0] = 1
+    with pytest.raises(ValueError):
+        r._split()[0][0] = 1
+
+
+def test_out_of_bounds():
+    r = Region(np.arange(4), chunk=2).set_in([0], 1)
+    with pytest.raises(KeyError):
+        r[4]
+    with pytest.raises(IndexError):
+        r.set_in([-5], 0)
+
+
+def test_version_equality():
+    r = Region(np.arange(4))
+    same = Region(np.arange(4))
+    assert r == r and r != same                   # by version, not elements
+    r2 = r.set_in([0], 0)                         # same values, new version
+    assert r2 != r and r2.version > r.version
+    assert Region(np.arange(4), version=r.version) == r
+    assert r[0:2] == r[0:2] and r[0:2] != r[1:3]
+    with pytest.raises(TypeError):
+        hash(r)
+
+
+def test_regions_in_state(app_state, register):
+    mount(['p'], np.arange(10.0))
+    register({'id': 'head', 'vectorized': True,
+              'inputs': {'h': ['p', slice(0, 3)]},
+              'output': lambda h: float(h.sum())})
+    dispatch('state', ['p', 1], 10.0)
+    assert subscribe('head') == 12.0
+    r = app_state.unbox()['p']
+    dispatch('region', ['p'], [(0, 1.0), (range(8, 10), 0.0)])
+    assert subscribe('head') == 13.0
+    assert list(app_state.unbox()['p'].array[[0, 8, 9]]) == [1, 0, 0]
+    assert r[0] == 0.0                            # old state untouched
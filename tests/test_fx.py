@@ -0,0 +1,108 @@
+import random
+import threading
+import time
+
+from reflow import dispatch, fx
+from reflow.events import do_fx, interceptor
+from reflow.fx import FxPool
+from reflow.registry import register_handler
+from reflow.router import compile_chain
+
+
+def test_fifo_per_id():
+    done = []
+    rnd = random.Random(3)
+
+    def effect(v):
+        time.sleep(rnd.random() / 1000)
+        done.append(v)
+
+    p = FxPool(max_workers=4, batch=3)
+    for n in range(50):
+        for id in ('a', 'b', 'c', 'd'):
+            p.submit(id, effect, (id, n))
+    assert p.flush(10)
+    p.shutdown()
+    assert len(done) == 200
+    for id in ('a', 'b', 'c', 'd'):
+        assert [n for i, n in done if i == id] == list(range(50))
+    assert p.stats()['done'] == 200
+
+
+def test_ids_run_concurrently():
+    gate = threading.Event()
+    waited = []
+    p = FxPool(max_workers=2)
+    p.submit('slow', lambda v: waited.append(gate.wait(5)), None)
+    p.submit('fast', lambda v: gate.set(), None)
+    assert p.flush(10)
+    p.shutdown()
+    assert waited == [True]
+
+
+def test_one_id_runs_one_at_a_time():
+    running, overlap = [0], []
+    lock = threading.Lock()
+
+    def effect(v):
+        with lock:
+            running[0] += 1
+            overlap.append(running[0])
+        time.sleep(0.001)
+        with lock:
+            running[0] -= 1
+
+    p = FxPool(max_workers=4, batch=2)
+    for n in range(20):
+        p.submit('x', effect, n)
+    assert p.flush(10)
+    p.shutdown()
+    assert max(overlap) == 1
+
+
+def test_failures_are_reported(app_state):
+    errors = []
+    register_handler('error', 'event_handler',
+                     lambda e, ev, d: errors.append((str(e), ev, d)))
+    p = FxPool(max_workers=1)
+    p.submit('x', lambda v: 1 / v, 0, event='ev')
+    p.submit('x', lambda v: v, 1)
+    assert p.flush(5)
+    p.shutdown()
+    assert errors == [('division by zero', 'ev', 'fx')]
+    assert p.stats()['failed'] == 1 and p.stats()['done'] == 1
+
+
+def test_pooled_marks_handlers():
+    f = fx.pooled(lambda v: v)
+    assert fx.is_pooled(f) and not fx.is_pooled(lambda v: v)
+    assert f(2) == 2
+
+
+def test_dispatched_effects_keep_their_order(app_state):
+    done = []
+    rnd = random.Random(5)
+
+    @fx.pooled
+    def effect(v):
+        time.sleep(rnd.random() / 1000)
+        done.append(v)
+
+    def before(ctx):
+        n = ctx.coeffects['event'][2]
+        ctx.effects = ctx.effects.update({'fa': ('a', n), 'fb': ('b', n)})
+        return ctx
+
+    register_handler('fx', 'fa', effect)
+    register_handler('fx', 'fb', effect)
+    register_handler('event', 'both', compile_chain([
+        do_fx(), interceptor('both', before=before)]))
+    old = fx.set_pool(FxPool(max_workers=4, batch=2))
+    try:
+        for n in range(30):
+            dispatch('both', None, n)
+        assert fx.flush(10)
+    finally:
+        fx.set_pool(old).shutdown()
+    assert [n for i, n in done if i == 'a'] == list(range(30))
+    assert [n for i, n in done if i == 'b'] == list(range(30))
@@ -0,0 +1,246 @@
+import random
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pyrsistent as pyr
+import pytest
+
+from reflow.exceptions import GraphCycleError
+from reflow.graph import (
+    FlowGraph,
+    compile_flow,
+    run,
+    set_executor,
+    topsort)
+from reflow.router import Context
+from reflow.subs import default_flow
+from reflow.util import as_path
+
+
+def plan(id, path=None, output=None, **inputs):
+    """Plan of flow `id`, inputs a flow id (str) or a path (list) each."""
+    ins = {k: pyr.m(flow=v) if isinstance(v, str) else pyr.m(path=as_path(v))
+           for k, v in inputs.items()}
+    f = default_flow(id).update({
+        'inputs': pyr.pmap(ins),
+        'output': output or (lambda **kw: None)})
+    if path is not None:
+        f = f.set('path', as_path(path))
+    return compile_flow(f)
+
+
+def run_event(g, o, n):
+    """State after running graph `g` over an event changing `o` to `n`."""
+    ctx = Context(pyr.v('state', None, None))
+    ctx.coeffects = ctx.coeffects.set('state', o)
+    ctx.effects = ctx.effects.set('state', n)
+    return run(ctx, g).effects['state']
+
+
+def counted(fn, calls, id):
+    def f(**kw):
+        calls.append(id)
+        return fn(**kw)
+    return f
+
+
+def assert_ordered(g):
+    for u, ds in g.out.items():
+        for d in ds:
+            assert g.order[u] < g.order[d], (u, d)
+
+
+def test_downstream_registered_first_is_reordered():
+    g = FlowGraph()
+    g.add(plan('c', x='b'))
+    g.add(plan('b', x='a'))
+    g.add(plan('a', x=['src']))
+    assert g.out == {'a': {'b'}, 'b': {'c'}, 'c': set()}
+    assert_ordered(g)
+    assert topsort(g) == ['a', 'b', 'c']
+    assert g.levels() == {'a': 0, 'b': 1, 'c': 2}
+
+
+def test_path_input_beneath_an_output_depends_on_its_writer():
+    g = FlowGraph()
+    g.add(plan('reader', x=['out', 'k']))
+    g.add(plan('writer', path=['out'], x=['src']))
+    assert g.out['writer'] == {'reader'}
+    assert_ordered(g)
+
+
+def test_cycle_is_rejected_and_graph_unchanged():
+    g = FlowGraph()
+    g.add(plan('a', x='c'))
+    g.add(plan('b', x='a'))
+    g.add(plan('c', x=['src']))
+    before = {k: set(v) for k, v in g.out.items()}
+    with pytest.raises(GraphCycleError):
+        g.add(plan('c', x='b'))
+    assert {k: set(v) for k, v in g.out.items()} == before
+    assert_ordered(g)
+    assert g.plans['c'].upstream == ()
+
+
+def test_self_loop_is_rejected():
+    g = FlowGraph()
+    with pytest.raises(GraphCycleError):
+        g.add(plan('selfy', x='selfy'))
+    assert 'selfy' not in g
+    assert g.out == {} and g.ins == {}
+
+
+def test_replacing_a_flow_with_a_self_loop_keeps_the_old_one():
+    g = FlowGraph()
+    g.add(plan('a', x=['src']))
+    g.add(plan('b', x='a'))
+    with pytest.raises(GraphCycleError):
+        g.add(plan('a', x='a'))
+    assert g.plans['a'].specs[0][0][1] == 'path'
+    assert g.out['a'] == {'b'}
+    assert g.levels() == {'a': 0, 'b': 1}
+
+
+def test_remove_and_re_add():
+    g = FlowGraph()
+    g.add(plan('a', x=['src']))
+    g.add(plan('b', x='a'))
+    g.remove('a')
+    assert 'a' not in g
+    assert g.ins['b'] == set()
+    assert g.plans['b'].upstream == ()      # reads None meanwhile
+    g.add(plan('a', x=['src']))
+    assert g.out['a'] == {'b'}
+    assert g.plans['b'].upstream == ('a',)
+    assert_ordered(g)
+
+
+def test_random_dags_stay_ordered():
+    rnd = random.Random(7)
+    for _ in range(20):
+        n = 30
+        edges = {i: rnd.sample(range(i), min(i, rnd.randrange(3)))
+                 for i in range(n)}          # i reads from lower ids only
+        g = FlowGraph()
+        for i in rnd.sample(range(n), n):
+            ups = {f'x{j}': f'f{u}' for j, u in enumerate(edges[i])}
+            g.add(plan(f'f{i}', **(ups or {'x': ['src']})))
+        assert_ordered(g)
+        for i, us in edges.items():
+            assert g.ins[f'f{i}'] == {f'f{u}' for u in us}
+        # closing any path into a cycle is rejected
+        i = max(edges, key=lambda i: len(edges[i]))
+        if edges[i]:
+            u = edges[i][0]
+            with pytest.raises(GraphCycleError):
+                g.add(plan(f'f{u}', x=f'f{i}'))
+            assert_ordered(g)
+
+
+def test_reader_of_a_parent_path_depends_on_writers_beneath_it():
+    g = FlowGraph()
+    g.add(plan('r', path=['r'], output=lambda a: dict(a or {}), a=['a']))
+    g.add(plan('w', path=['a', 'w'], output=lambda x: x, x=['a', 'x']))
+    assert g.out['w'] == {'r'}
+    assert_ordered(g)
+    o = pyr.freeze({'a': {'x': 1, 'w': 1}})
+    s = run_event(g, o, o.set('a', o['a'].set('x', 2)))
+    assert s['a'] == pyr.m(x=2, w=2)
+    assert s['r'] == {'x': 2, 'w': 2}
+
+
+def test_writer_added_beneath_a_registered_reader():
+    g = FlowGraph()
+    g.add(plan('w', path=['a', 'w'], x=['x']))
+    g.add(plan('r', a=['a']))
+    g.remove('w')
+    assert g.ins['r'] == set()
+    g.add(plan('w', path=['a', 'w'], x=['x']))
+    assert g.out['w'] == {'r'}
+    assert_ordered(g)
+
+
+def test_run_visits_only_dirty_flows():
+    calls = []
+    g = FlowGraph()
+    g.add(plan('b', output=counted(lambda a: a + 1, calls, 'b'), a=['a']))
+    g.add(plan('c', output=counted(lambda b: b * 2, calls, 'c'), b='b'))
+    g.add(plan('y', output=counted(lambda x: x, calls, 'y'), x=['x']))
+    o = pyr.m(a=1, b=2, c=4, x=0, y=0)
+    s = run_event(g, o, o.set('a', 2))
+    assert s == pyr.m(a=2, b=3, c=6, x=0, y=0)
+    assert calls == ['b', 'c']
+
+
+def test_run_stops_where_an_output_is_unchanged():
+    calls = []
+    g = FlowGraph()
+    g.add(plan('b', output=counted(lambda a: a % 2, calls, 'b'), a=['a']))
+    g.add(plan('c', output=counted(lambda b: b * 10, calls, 'c'), b='b'))
+    o = pyr.m(a=1, b=1, c=10)
+    s = run_event(g, o, o.set('a', 3))
+    assert s == pyr.m(a=3, b=1, c=10)
+    assert calls == ['b']
+
+
+def test_run_evaluates_diamonds_once_in_order():
+    calls = []
+    g = FlowGraph()
+    g.add(plan('d', output=counted(lambda b, c: b + c, calls, 'd'),
+               b='b', c='c'))
+    g.add(plan('c', output=counted(lambda a: a * 3, calls, 'c'), a=['a']))
+    g.add(plan('b', output=counted(lambda a: a * 2, calls, 'b'), a=['a']))
+    o = pyr.m(a=1, b=2, c=3, d=5)
+    s = run_event(g, o, o.set('a', 2))
+    assert s == pyr.m(a=2, b=4, c=6, d=10)
+    assert sorted(calls[:2]) == ['b', 'c'] and calls[2:] == ['d']
+
+
+def test_a_failing_flow_leaves_its_output_and_the_rest_run(capsys):
+    g = FlowGraph()
+    g.add(plan('b', output=lambda a: 1 / a, a=['a']))
+    g.add(plan('c', output=lambda a: a + 1, a=['a']))
+    o = pyr.m(a=1, b=1.0, c=2)
+    s = run_event(g, o, o.set('a', 0))
+    assert s == pyr.m(a=0, b=1.0, c=1)
+    assert 'division by zero' in capsys.readouterr().out
+
+
+def test_slice_input_paths():
+    g = FlowGraph()
+    g.add(plan('head', output=lambda h: sum(h), h=['a', slice(0, 2)]))
+    g.add(plan('w', path=['a'], output=lambda x: pyr.pvector(x), x=['x']))
+    assert g.out['w'] == {'head'}
+    o = pyr.freeze({'a': [1, 2, 3], 'x': [1, 2, 3], 'head': 3})
+    s = run_event(g, o, o.set('x', pyr.v(5, 6, 7)))
+    assert s['head'] == 11
+    g.remove('head')
+    assert set(g.trie['children']) == {'x'}   # 'a' pruned
+
+
+def double(a):
+    return a * 2
+
+
+def _levels_graph():
+    g = FlowGraph()
+    g.add(plan('b', output=double, a=['a']))
+    g.add(plan('c', output=lambda a: a + 1, a=['a']))     # not picklable
+    g.add(plan('d', output=lambda b, c: b + c, b='b', c='c'))
+    g.add(plan('e', output=lambda a: 1 / a, a=['a']))
+    return g
+
+
+@pytest.mark.parametrize('pool', [ThreadPoolExecutor, ProcessPoolExecutor])
+def test_set_executor(pool, capsys):
+    with pool(2) as ex:
+        old = set_executor(ex)
+        try:
+            g = _levels_graph()
+            o = pyr.m(a=1, b=2, c=2, d=4, e=1.0)
+            assert run_event(g, o, o.set('a', 2)) == pyr.m(
+                a=2, b=4, c=3, d=7, e=0.5)
+            s = run_event(g, o, o.set('a', 0))
+        finally:
+            set_executor(old)
+    assert s == pyr.m(a=0, b=0, c=1, d=1, e=1.0)
+    assert 'division by zero' in capsys.readouterr().out
@@ -0,0 +1,99 @@
+import pyrsistent as pyr
+import pytest
+
+from reflow import dispatch, history, persist
+from reflow.history import delta, size
+from reflow.persist import FileLog
+
+
+@pytest.fixture
+def hist(app_state):
+    yield history
+    history.disable()
+
+
+def expected_nodes(h):
+    es = list(h.entries)
+    return size(es[0].state) + sum(
+        delta(a.state, b.state)[0] for a, b in zip(es, es[1:]))
+
+
+def test_undo_redo(hist, app_state):
+    h = hist.enable()
+    dispatch('state', ['a'], 1)
+    dispatch('state', ['a'], 2)
+    assert hist.undo() == 1
+    assert app_state.unbox() == pyr.m(a=1)
+    assert hist.undo() == 0
+    assert app_state.unbox() == pyr.m()
+    assert hist.undo() is None          # nothing before the start
+    assert hist.redo() == 1
+    assert hist.redo() == 2
+    assert app_state.unbox() == pyr.m(a=2)
+    assert hist.redo() is None
+    assert len(h) == 3                  # restores aren't recorded
+
+
+def test_new_event_discards_redo(hist, app_state):
+    h = hist.enable()
+    dispatch('state', ['a'], 1)
+    dispatch('state', ['a'], 2)
+    hist.undo()
+    dispatch('state', ['b'], 3)
+    assert hist.redo() is None
+    assert [e.seq for e in h.entries] == [0, 1, 4]
+    assert app_state.unbox() == pyr.m(a=1, b=3)
+    with pytest.raises(KeyError):
+        hist.state_at(2)
+    assert h.nodes == expected_nodes(h)
+
+
+def test_undo_past_the_ring_capacity(hist, app_state):
+    h = hist.enable(max_entries=3)
+    for i in range(1, 6):
+        dispatch('state', ['a'], i)
+    assert [e.seq for e in h.entries] == [3, 4, 5]
+    assert h.evicted == 3
+    assert hist.undo() == 4
+    assert hist.undo() == 3
+    assert hist.undo() is None
+    assert app_state.unbox() == pyr.m(a=3)
+    with pytest.raises(KeyError):
+        hist.state_at(1)
+    assert hist.redo() == 4
+
+
+def test_node_accounting_under_eviction(hist, app_state):
+    app_state.reset(pyr.freeze({'big': {i: {'v': i} for i in range(50)}}))
+    h = hist.enable(max_nodes=150)
+    for i in range(20):
+        dispatch('state', ['big', i, 'v'], -i)
+        dispatch('state', ['small', i], i)
+        assert h.nodes == expected_nodes(h)
+    assert h.nodes <= 150 or len(h) == 1
+    assert h.evicted > 0
+    assert h.stats()['last'] == 40
+
+
+def test_unchanged_state_is_not_recorded(hist):
+    h = hist.enable()
+    dispatch('state', ['a'], 1)
+    dispatch('state', ['a'], 1)
+    assert [e.seq for e in h.entries] == [0, 1]
+    assert h.seq == 2
+
+
+def test_seqs_follow_the_journal(hist, app_state, tmp_path):
+    j = persist.start(FileLog(str(tmp_path)))
+    dispatch('state', ['a'], 1)
+    h = hist.enable()
+    dispatch('state', ['a'], 2)
+    dispatch('state', ['a'], 2)
+    dispatch('state', ['a'], 3)
+    assert [e.seq for e in h.entries] == [1, 2, 4]
+    assert j.seq == 4
+    assert hist.state_at(2) == pyr.m(a=2)
+    assert hist.goto(2) == 2
+    assert j.seq == 5                   # the restore is journalled too
+    dispatch('state', ['a'], 6)
+    assert [e.seq for e in h.entries] == [1, 2, 6]
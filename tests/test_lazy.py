@@ -0,0 +1,72 @@
+import pyrsistent as pyr
+import pytest
+
+from reflow import dispatch, subscribe, unsubscribe
+from reflow.graph import dag
+
+
+@pytest.fixture
+def lazy(app_state, register):
+    """Lazy flow 'sq' = x * x, counting its computations."""
+    calls = []
+
+    def sq(x):
+        calls.append(x)
+        return None if x is None else x * x
+
+    dispatch('state', ['x'], 3)
+    register({'id': 'sq', 'lazy': True, 'inputs': {'x': ['x']},
+              'output': sq})
+    dispatch('state', ['y'], 0)       # the flow's first run
+    yield calls
+    dag.release('sq')
+
+
+def test_computed_on_subscribe_not_on_dispatch(lazy, app_state):
+    assert lazy == []
+    assert 'sq' not in app_state.unbox()
+    assert subscribe('sq') == 9
+    assert subscribe('sq') == 9
+    assert lazy == [3]
+
+
+def test_unwatched_value_is_dropped_on_change(lazy):
+    subscribe('sq')
+    assert 'sq' in dag.values
+    dispatch('state', ['x'], 4)
+    assert 'sq' not in dag.values
+    assert lazy == [3]
+    assert subscribe('sq') == 16
+
+
+def test_watched_value_is_kept_and_recomputed_once(lazy):
+    seen = []
+    assert subscribe('sq', on_change=seen.append) == 9
+    dispatch('state', ['y'], 1)       # unrelated
+    assert 'sq' in dag.values and lazy == [3]
+    dispatch('state', ['x'], 4)
+    assert seen == [16]               # computed once, to notify
+    assert subscribe('sq') == 16
+    assert lazy == [3, 4]
+    unsubscribe('sq', seen.append)
+
+
+def test_last_unsubscribe_drops_the_value(lazy):
+    a, b = [], []
+    subscribe('sq', on_change=a.append)
+    subscribe('sq', on_change=b.append)
+    unsubscribe('sq', a.append)
+    assert 'sq' in dag.values
+    unsubscribe('sq', b.append)
+    assert 'sq' not in dag.values
+    dispatch('state', ['x'], 5)
+    assert a == b == []
+
+
+def test_lazy_flows_read_lazy_flows(lazy, register):
+    register({'id': 'sq_plus', 'lazy': True, 'inputs': {'s': {'flow': 'sq'}},
+              'output': lambda s: s + 1})
+    assert subscribe('sq_plus') == 10
+    dispatch('state', ['x'], 2)
+    assert subscribe('sq_plus') == 5
+    dag.release('sq_plus')
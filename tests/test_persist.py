@@ -0,0 +1,153 @@
+import os
+
+import pyrsistent as pyr
+import pytest
+
+from reflow import dispatch, event, persist
+from reflow.persist import FileLog, Journal
+
+
+def journal(path, **kwargs):
+    return Journal(FileLog(str(path)), **kwargs)
+
+
+def segments(path):
+    return sorted(n for n in os.listdir(path) if n.endswith('.log'))
+
+
+def test_append_flush_read(tmp_path):
+    j = journal(tmp_path)
+    assert [j.append(('e', i)) for i in range(3)] == [1, 2, 3]
+    j.flush()
+    assert j.durable == 3
+    assert list(j.backend.read()) == [(1, ('e', 0)), (2, ('e', 1)),
+                                      (3, ('e', 2))]
+    assert list(j.backend.read(after=2)) == [(3, ('e', 2))]
+    j.close()
+
+
+def test_reopen_continues_the_sequence(tmp_path):
+    j = journal(tmp_path)
+    j.append('a')
+    j.append('b')
+    j.close()
+    j = journal(tmp_path)
+    assert j.seq == 2
+    assert j.append('c') == 3
+    j.close()
+    assert [seq for seq, _ in FileLog(str(tmp_path)).read()] == [1, 2, 3]
+
+
+def test_torn_tail_is_truncated(tmp_path):
+    j = journal(tmp_path)
+    j.append('a')
+    j.append('b')
+    j.close()
+    name = os.path.join(tmp_path, segments(tmp_path)[-1])
+    size = os.path.getsize(name)
+    with open(name, 'r+b') as f:
+        f.truncate(size - 3)   # crash mid write of 'b'
+    log = FileLog(str(tmp_path))
+    assert log.last_seq() == 1
+    assert list(log.read()) == [(1, 'a')]
+    log.write([(2, 'c')])
+    log.close()
+    assert list(FileLog(str(tmp_path)).read()) == [(1, 'a'), (2, 'c')]
+
+
+def test_snapshot_compacts_covered_segments(tmp_path):
+    j = journal(tmp_path)
+    for i in range(3):
+        j.append(i)
+    j.snapshot(pyr.m(n=3))
+    j.append(3)
+    j.append(4)
+    j.flush()
+    assert segments(tmp_path) == [f"{4:020d}.log"]
+    assert j.backend.load_snapshot() == (3, pyr.m(n=3))
+    assert list(j.backend.read(after=3)) == [(4, 3), (5, 4)]
+    j.close()
+    j = journal(tmp_path)
+    assert j.seq == 5
+    j.close()
+
+
+def test_snapshot_without_compaction_keeps_segments(tmp_path):
+    j = Journal(FileLog(str(tmp_path), compact=False))
+    j.append('a')
+    j.snapshot(pyr.m())
+    j.append('b')
+    j.flush()
+    assert len(segments(tmp_path)) == 2
+    assert [seq for seq, _ in j.backend.read()] == [1, 2]
+    assert list(j.backend.read(after=1)) == [(2, 'b')]
+    j.close()
+
+
+def test_snapshot_every(tmp_path):
+    j = journal(tmp_path, snapshot_every=2)
+    j.append('a')
+    j.commit(pyr.m(n=1))
+    j.append('b')
+    j.commit(pyr.m(n=2))
+    j.flush()
+    assert j.backend.load_snapshot() == (2, pyr.m(n=2))
+    j.close()
+
+
+def test_replay_restores_snapshot_then_tail(tmp_path, app_state):
+    log = FileLog(str(tmp_path))
+    log.save_snapshot(2, pyr.m(a=1, b=1))
+    log.write([(3, ('state', ['b'], 2)), (4, ('state', ['c'], 3))])
+    log.close()
+    j = journal(tmp_path)
+    assert persist.replay(j) == 2
+    assert app_state.unbox() == pyr.m(a=1, b=2, c=3)
+    j.close()
+
+
+def test_start_journals_and_restores(tmp_path, app_state):
+    persist.start(FileLog(str(tmp_path)), sync=True)
+    dispatch('state', ['a'], 1)
+    dispatch('state', ['b'], 2)
+    persist.stop()
+    app_state.reset(pyr.m())
+    j = persist.start(FileLog(str(tmp_path)))
+    assert app_state.unbox() == pyr.m(a=1, b=2)
+    assert j.seq == 2
+
+
+def test_replay_runs_flows_after_each_event(tmp_path, app_state, register):
+    @event('copy_double')
+    def _(s, qv, v):
+        return s.set('copied', s.get('double'))
+
+    register({'id': 'double',
+              'inputs': {'x': ['x']},
+              'output': lambda x: None if x is None else x * 2})
+    persist.start(FileLog(str(tmp_path)), sync=True)
+    dispatch('state', ['x'], 1)
+    dispatch('copy_double', None, None)
+    dispatch('state', ['x'], 5)
+    live = app_state.unbox()
+    persist.stop()
+    assert live == pyr.m(x=5, double=10, copied=2)
+
+    app_state.reset(pyr.m())
+    persist.start(FileLog(str(tmp_path)))
+    assert app_state.unbox() == live
+
+
+def test_replay_skips_a_failing_event(tmp_path, app_state):
+    @event('boom')
+    def _(s, qv, v):
+        raise ValueError(v)
+
+    log = FileLog(str(tmp_path))
+    log.write([(1, ('state', ['a'], 1)), (2, ('boom', None, 'x')),
+               (3, ('state', ['b'], 2))])
+    log.close()
+    j = journal(tmp_path)
+    assert persist.replay(j) == 3
+    assert app_state.unbox() == pyr.m(a=1, b=2)
+    j.close()
@@ -0,0 +1,126 @@
+import threading
+
+import pytest
+
+from reflow.containers import EventQueue
+from reflow.exceptions import QueueFullError
+
+
+def drain(q):
+    out = []
+    while (x := q.get()) is not None:
+        out.append(x)
+    return out
+
+
+def test_unbounded_is_fifo():
+    q = EventQueue()
+    for i in range(5):
+        q.put(i)
+    assert drain(q) == [0, 1, 2, 3, 4]
+    assert q.get() is None
+
+
+def test_reject_raises_and_counts():
+    q = EventQueue(maxsize=2, overflow='reject')
+    q.put(1)
+    q.put(2)
+    with pytest.raises(QueueFullError):
+        q.put(3)
+    assert drain(q) == [1, 2]
+    assert q.stats()['rejected'] == 1
+
+
+def test_drop_oldest_keeps_the_newest():
+    q = EventQueue(maxsize=3, overflow='drop_oldest')
+    for i in range(10):
+        q.put(i)
+    assert len(q) == 3
+    assert drain(q) == [7, 8, 9]
+    assert q.stats()['dropped'] == 7
+
+
+def test_drop_oldest_sets_dropped_markers():
+    q = EventQueue(maxsize=1, overflow='drop_oldest')
+    q.put(1)
+    m = q.mark()
+    q.put(2)
+    assert m.is_set()
+    assert drain(q) == [2]
+
+
+def test_block_times_out():
+    q = EventQueue(maxsize=1, overflow='block', timeout=0.05)
+    q.put(1)
+    with pytest.raises(QueueFullError):
+        q.put(2)
+    s = q.stats()
+    assert (s['blocked'], s['rejected']) == (1, 1)
+
+
+def test_block_waits_for_the_consumer():
+    q = EventQueue(maxsize=1, overflow='block', timeout=5)
+    q.put(1)
+    t = threading.Thread(target=q.put, args=(2,))
+    t.start()
+    t.join(0.05)
+    assert t.is_alive()     # blocked on the full queue
+    assert q.get() == 1
+    t.join(5)
+    assert not t.is_alive()
+    assert drain(q) == [2]
+
+
+def test_consumer_is_never_blocked():
+    q = EventQueue(maxsize=1, overflow='reject')
+    q.consumer = threading.get_ident()
+    q.put(1)
+    q.put(2)
+    assert drain(q) == [1, 2]
+    assert q.stats()['rejected'] == 0
+
+
+def test_high_water_and_counters():
+    q = EventQueue()
+    for i in range(4):
+        q.put(i)
+    q.get()
+    q.get()
+    q.put(4)
+    assert q.stats() == {'depth': 3, 'high_water': 4, 'maxsize': None,
+                         'puts': 5, 'gets': 2, 'dropped': 0, 'rejected': 0,
+                         'blocked': 0}
+
+
+def test_marker_is_set_once_reached():
+    q = EventQueue(maxsize=1, overflow='reject')
+    q.put(1)
+    m = q.mark()            # doesn't count towards maxsize
+    assert not m.is_set()
+    assert q.get() == 1
+    assert not m.is_set()
+    assert q.get() is None
+    assert m.is_set()
+
+
+def test_configure():
+    q = EventQueue()
+    q.configure(maxsize=1, overflow='reject')
+    q.put(1)
+    with pytest.raises(QueueFullError):
+        q.put(2)
+    with pytest.raises(ValueError):
+        q.configure(overflow='spill')
+    with pytest.raises(KeyError):
+        q.configure(size=3)
+
+
+def test_clear():
+    q = EventQueue(maxsize=2, overflow='reject')
+    q.put(1)
+    q.put(2)
+    q.consumer = threading.get_ident()
+    q.clear()
+    assert len(q) == 0 and q.consumer is None
+    q.put(3)
+    assert drain(q) == [3]
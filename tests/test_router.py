@@ -0,0 +1,128 @@
+import pyrsistent as pyr
+import pytest
+
+from reflow import dispatch, dispatch_batch, transaction
+from reflow.events import interceptor, inject_cofx, do_fx
+from reflow.registry import register_handler
+from reflow.router import Context, compile_chain
+from reflow.util import get_in, update, upssoc_in
+
+
+def errors():
+    """Error handler recording (error, event, direction)."""
+    acc = []
+    register_handler('error', 'event_handler',
+                     lambda e, ev, d: acc.append((e, ev, d)))
+    return acc
+
+
+def test_context_keeps_the_map_interface():
+    ctx = Context(pyr.v('e', None, 1))
+    c = upssoc_in(ctx, ['effects', 'db'], {'a': 1})
+    c = update(c, 'coeffects', lambda x: x.set('now', 2))
+    assert type(c) is Context
+    assert get_in(c, ['effects', 'db', 'a']) == 1
+    assert c['coeffects']['now'] == 2
+    assert ctx.effects == pyr.m() and 'now' not in ctx.coeffects
+    c = c.set('queue', 3).update({'stack': 4})
+    assert (c['queue'], c.get('stack')) == (3, 4)
+    assert set(c) == {'coeffects', 'effects', 'queue', 'stack'}
+    assert 'queue' not in c.remove('queue')
+    e = c.evolver()
+    e['effects'] = pyr.m(x=1)
+    assert e.persistent().effects == pyr.m(x=1)
+    assert c.effects['db'] == pyr.m(a=1)
+
+
+def test_map_style_interceptor(app_state):
+    def before(ctx):
+        return upssoc_in(ctx, ['effects', 'state', 'seen'], True)
+
+    register_handler('event', 'mapped', compile_chain([
+        inject_cofx('state'), do_fx(), interceptor('m', before=before)]))
+    dispatch('mapped', None, None)
+    assert app_state.unbox() == pyr.m(seen=True)
+
+
+def test_interceptor_errors_go_to_the_error_handler(app_state):
+    acc = errors()
+
+    def boom(ctx):
+        raise ValueError('boom')
+
+    def after(ctx):
+        ctx.effects = ctx.effects.set('state', pyr.m(after=True))
+        return ctx
+
+    register_handler('event', 'boom', compile_chain([
+        do_fx(), interceptor('a', after=after),
+        interceptor('b', before=boom)]))
+    dispatch('boom', None, 1)
+    [(e, ev, d)] = acc
+    assert str(e) == 'boom' and ev == pyr.v('boom', None, 1)
+    assert d == 'before'
+    assert app_state.unbox() == pyr.m(after=True)   # the chain went on
+
+
+@pytest.fixture
+def summed(app_state, register):
+    """Flow 'total' = a + b, counting its runs."""
+    calls = []
+
+    def total(a, b):
+        calls.append((a, b))
+        return (a or 0) + (b or 0)
+
+    register({'id': 'total', 'inputs': {'a': ['a'], 'b': ['b']},
+              'output': total})
+    dispatch('state', ['a'], 0)
+    calls.clear()
+    return calls
+
+
+def test_batch_runs_flows_once(summed):
+    dispatch_batch([('state', ['a'], 1), ('state', ['b'], 2)])
+    assert summed == [(1, 2)]
+
+
+def test_batch_handlers_apply_in_order(app_state):
+    dispatch_batch([('state', ['a'], 1), ('state', ['a'], 2),
+                    ('state', ['b'], 3)])
+    assert app_state.unbox() == pyr.m(a=2, b=3)
+
+
+def test_empty_batch(app_state):
+    dispatch_batch([])
+    assert app_state.unbox() == pyr.m()
+
+
+def test_transaction_is_one_batch(summed):
+    with transaction():
+        dispatch('state', ['a'], 1)
+        dispatch('state', ['b'], 2)
+        assert summed == []       # nothing dispatched yet
+    assert summed == [(1, 2)]
+
+
+def test_nested_transactions_join_the_outermost(summed, app_state):
+    with transaction():
+        dispatch('state', ['a'], 1)
+        with transaction():
+            dispatch_batch([('state', ['b'], 2), ('state', ['c'], 3)])
+        assert 'b' not in app_state.unbox()
+    assert summed == [(1, 2)]
+    assert app_state.unbox() == pyr.m(a=1, b=2, c=3, total=3)
+
+
+def test_transaction_discards_events_on_error(summed, app_state):
+    before = app_state.unbox()
+    with pytest.raises(RuntimeError):
+        with transaction():
+            dispatch('state', ['a'], 1)
+            with transaction():
+                dispatch('state', ['b'], 2)
+            raise RuntimeError()
+    assert app_state.unbox() is before
+    assert summed == []
+    dispatch('state', ['b'], 2)       # not buffered any more
+    assert app_state.unbox()['b'] == 2
@@ -0,0 +1,87 @@
+import time
+
+import pytest
+
+from reflow import persist
+from reflow.exceptions import ShardError
+from reflow.persist import FileLog
+from reflow.registry import get_in_state, state
+from reflow.shard import Cluster, shard_of
+
+
+KEYS = [f't{i}' for i in range(8)]
+
+
+def _keys():
+    return set(state.unbox())
+
+
+def _fail_on_1(index, n):
+    if index == 1:
+        raise RuntimeError('setup failed')
+
+
+def eventually(fn, timeout=5):
+    end = time.monotonic() + timeout
+    while not (r := fn()) and time.monotonic() < end:
+        time.sleep(0.01)
+    return r
+
+
+def test_shard_of_is_stable():
+    assert shard_of('tenant', 4) == shard_of('tenant', 4)
+    assert {shard_of(k, 4) for k in KEYS} <= {0, 1, 2, 3}
+
+
+def test_events_are_routed_by_first_key():
+    with Cluster(2) as c:
+        for i, k in enumerate(KEYS):
+            c.dispatch('state', [k, 'n'], i)
+        assert [c.get([k, 'n'], timeout=5) for k in KEYS] == list(range(8))
+        ks = c.broadcast(_keys, timeout=5)
+    for k in KEYS:
+        assert k in ks[shard_of(k, 2)]
+        assert k not in ks[1 - shard_of(k, 2)]
+
+
+def test_dispatch_batch_splits_by_shard():
+    with Cluster(2) as c:
+        c.dispatch_batch([('state', [k], 1) for k in KEYS])
+        c.flush(timeout=5)
+        assert all(c.get([k], timeout=5) == 1 for k in KEYS)
+
+
+def test_shared_paths_are_mirrored():
+    with Cluster(2, shared=[['config']]) as c:
+        c.dispatch('state', ['config', 'rate'], 3)
+        other = 1 - shard_of('config', 2)
+        assert eventually(lambda: c.call(
+            other, get_in_state, ['config', 'rate'], timeout=5) == 3)
+
+
+def test_unroutable_event():
+    with Cluster(2) as c:
+        with pytest.raises(ValueError):
+            c.dispatch('state', [], 1)
+
+
+def test_a_dead_worker_fails_its_requests():
+    with Cluster(2, setup=_fail_on_1) as c:
+        k = next(k for k in KEYS if shard_of(k, 2) == 1)
+        with pytest.raises(ShardError):
+            c.get([k], timeout=5)
+        assert eventually(lambda: c.shards[1].error is not None)
+        with pytest.raises(ShardError):
+            c.dispatch('state', [k], 1)
+        j = next(k for k in KEYS if shard_of(k, 2) == 0)
+        c.dispatch('state', [j], 1)
+        assert c.get([j], timeout=5) == 1
+
+
+def test_workers_dont_inherit_the_journal(tmp_path, app_state):
+    persist.start(FileLog(str(tmp_path)), sync=True)
+    with Cluster(2) as c:
+        c.dispatch('state', ['t', 'n'], 1)
+        assert c.get(['t', 'n'], timeout=5) == 1
+    persist.stop()
+    assert list(FileLog(str(tmp_path)).read()) == []
@@ -0,0 +1,72 @@
+import pyrsistent as pyr
+import pytest
+
+from reflow import dispatch, register_sub, subscribe
+from reflow.subs import sub_cache
+
+
+@pytest.fixture
+def items(app_state):
+    calls = []
+
+    def price(item, qry_v):
+        calls.append(qry_v)
+        return item['price'] * item['qty']
+
+    app_state.reset(pyr.freeze({'items': {
+        1: {'price': 2, 'qty': 3}, 2: {'price': 5, 'qty': 1}}}))
+    sub_cache.clear()
+    register_sub('item', lambda qry_v: ['items', qry_v[0]], price)
+    yield calls
+    sub_cache.clear()
+    sub_cache.resize(10000)
+
+
+def test_memoized_while_inputs_are_identical(items):
+    assert subscribe('item', 1) == 6
+    assert subscribe('item', 1) == 6
+    assert subscribe('item', 2) == 5
+    assert items == [(1,), (2,)]
+    dispatch('state', ['items', 2, 'qty'], 4)     # another item
+    assert subscribe('item', 1) == 6
+    assert items == [(1,), (2,)]
+
+
+def test_recomputed_when_an_input_changes(items):
+    assert subscribe('item', 1) == 6
+    dispatch('state', ['items', 1, 'qty'], 10)
+    assert subscribe('item', 1) == 20
+    assert items == [(1,), (1,)]
+
+
+def test_hits_and_misses(items):
+    h, m = sub_cache.hits, sub_cache.misses
+    subscribe('item', 1)
+    subscribe('item', 1)
+    subscribe('item', 1)
+    assert (sub_cache.hits - h, sub_cache.misses - m) == (2, 1)
+
+
+def test_lru_eviction(items):
+    sub_cache.resize(1)
+    e = sub_cache.evictions
+    subscribe('item', 1)
+    subscribe('item', 2)          # evicts 1
+    subscribe('item', 1)
+    assert items == [(1,), (2,), (1,)]
+    assert sub_cache.stats()['size'] == 1
+    assert sub_cache.evictions - e == 2
+
+
+def test_reregistering_drops_cached_values(items):
+    subscribe('item', 1)
+    register_sub('item', lambda qry_v: ['items', qry_v[0]],
+                 lambda item: -item['qty'])
+    assert subscribe('item', 1) == -3
+
+
+def test_unhashable_query_vector(items):
+    register_sub('at', lambda qry_v: list(qry_v[0]), lambda v: v)
+    assert subscribe('at', ['items', 1, 'qty']) == 3
+    assert subscribe('at', ['items', 1, 'qty']) == 3
+    assert ('at', (pyr.v('items', 1, 'qty'),)) in sub_cache.entries
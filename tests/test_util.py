@@ -0,0 +1,107 @@
+import pyrsistent as pyr
+import pytest
+
+from reflow.util import Path, dissoc_in, get_in, mset, path_key, upssoc_in
+
+
+def _state():
+    return pyr.freeze({'a': {'b': {'c': 1, 'd': 2}, 'e': {'f': 3}},
+                       'g': {'h': 4}})
+
+
+def test_mset_copies_only_the_spine():
+    m = _state()
+    n = mset(m, ['a', 'b', 'c'], 10)
+    assert get_in(n, ['a', 'b', 'c']) == 10
+    assert get_in(m, ['a', 'b', 'c']) == 1     # original untouched
+    assert n['g'] is m['g']                     # siblings shared
+    assert n['a']['e'] is m['a']['e']
+    assert n['a'] is not m['a']
+    assert n['a']['b'] is not m['a']['b']
+
+
+def test_mset_creates_missing_path():
+    m = _state()
+    n = mset(m, ['x', 'y', 'z'], 1)
+    assert get_in(n, ['x', 'y', 'z']) == 1
+    assert isinstance(n['x'], pyr.PMap)
+    assert n['a'] is m['a']
+
+
+def test_mset_replaces_non_map_on_path():
+    n = mset(_state(), ['g', 'h', 'i'], 5)
+    assert get_in(n, ['g', 'h', 'i']) == 5
+
+
+def test_mset_freezes_plain_containers():
+    n = mset(_state(), ['a', 'new'], {'k': [1, 2]})
+    assert isinstance(n['a']['new'], pyr.PMap)
+    assert isinstance(n['a']['new']['k'], pyr.PVector)
+
+
+def test_mset_on_dict_leaves_it_unchanged():
+    m = {'a': {'b': 1}, 'c': {'d': 2}}
+    n = mset(m, ['a', 'b'], 3)
+    assert m == {'a': {'b': 1}, 'c': {'d': 2}}
+    assert n['a']['b'] == 3
+    assert n['c'] is m['c']
+
+
+def test_upssoc_in_returns_same_map_when_unchanged():
+    m = _state()
+    assert upssoc_in(m, ['a', 'b', 'c'], 1) is m
+    v = m['a']['e']
+    assert upssoc_in(m, ['a', 'e'], v) is m
+
+
+def test_upssoc_in_sets_changed_value():
+    m = _state()
+    n = upssoc_in(m, ['a', 'b', 'd'], 20)
+    assert n is not m
+    assert get_in(n, ['a', 'b', 'd']) == 20
+    assert n['g'] is m['g']
+
+
+def test_upssoc_in_sets_new_path():
+    m = _state()
+    n = upssoc_in(m, ['a', 'b', 'new'], None)
+    assert 'new' in n['a']['b']
+
+
+def test_dissoc_in_removes_key_and_shares_siblings():
+    m = _state()
+    n = dissoc_in(m, ['a', 'b', 'c'])
+    assert 'c' not in n['a']['b']
+    assert get_in(n, ['a', 'b', 'd']) == 2
+    assert n['a']['e'] is m['a']['e']
+    assert n['g'] is m['g']
+    assert 'c' in m['a']['b']
+
+
+def test_dissoc_in_missing_path_raises():
+    with pytest.raises(KeyError):
+        dissoc_in(_state(), ['nope', 'x'])
+
+
+def test_path_keeps_slice_keys():
+    s = pyr.freeze({'a': [1, 2, 3]})
+    pv = ['a', slice(0, 2)]
+    assert Path(pv)[1] == slice(0, 2)
+    assert get_in(s, Path(pv)) == get_in(s, pv) == pyr.v(1, 2)
+    assert get_in(s, Path(['a', slice(1, None)])) == pyr.v(2, 3)
+
+
+def test_paths_are_interned():
+    assert Path(['a', 'b']) is Path(('a', 'b'))
+    assert Path(['a', 'b']) == ('a', 'b')
+    assert hash(Path(['a', 'b'])) == hash(('a', 'b'))
+
+
+def test_path_key():
+    assert path_key(Path(['a', 1])) is Path(['a', 1])
+    pk = path_key(Path(['a', slice(0, 2)]))
+    assert pk == path_key(['a', slice(0, 2)])
+    assert pk != path_key(['a', slice(0, 3)])
+    assert hash(pk) == hash(path_key(Path(['a', slice(0, 2)])))
+    with pytest.raises(TypeError):
+        path_key(['a', ['b']])
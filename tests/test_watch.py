@@ -0,0 +1,84 @@
+import pyrsistent as pyr
+import pytest
+
+from reflow import dispatch, router, subscribe, transaction, unsubscribe
+from reflow.registry import dq
+
+
+@pytest.fixture
+def dbl(app_state, register):
+    """Flow 'dbl' = {'v': x * 2}, a new map each run."""
+    register({'id': 'dbl', 'inputs': {'x': ['x']},
+              'output': lambda x: pyr.m(v=(x or 0) * 2)})
+    dispatch('state', ['x'], 1)
+
+
+def test_watcher_called_on_change(dbl):
+    seen = []
+    assert subscribe('dbl', on_change=seen.append) == pyr.m(v=2)
+    dispatch('state', ['x'], 2)
+    dispatch('state', ['y'], 0)           # unrelated
+    assert seen == [pyr.m(v=4)]
+
+
+def test_events_of_one_run_are_coalesced(dbl):
+    seen = []
+    subscribe('dbl', on_change=seen.append)
+    for x in (2, 3, 4):
+        dq.put(pyr.v('state', ['x'], x))
+    router._drain()
+    assert seen == [pyr.m(v=8)]
+    with transaction():
+        dispatch('state', ['x'], 5)
+        dispatch('state', ['x'], 6)
+    assert seen == [pyr.m(v=8), pyr.m(v=12)]
+
+
+def test_equal_values_are_suppressed(dbl):
+    seen = []
+    subscribe('dbl', on_change=seen.append)
+    dispatch('state', ['x'], -1)          # a new map, equal value...
+    dispatch('state', ['x'], 1)           # ...to the one last notified
+    assert seen == [pyr.m(v=-2), pyr.m(v=2)]
+    for x in (3, 1):                      # changed and back in one run
+        dq.put(pyr.v('state', ['x'], x))
+    router._drain()
+    assert seen == [pyr.m(v=-2), pyr.m(v=2)]
+
+
+def test_every_watcher_called_once(dbl):
+    a, b = [], []
+    subscribe('dbl', on_change=a.append)
+    subscribe('dbl', on_change=b.append)
+    dispatch('state', ['x'], 2)
+    assert a == b == [pyr.m(v=4)]
+
+
+def test_unsubscribe_during_notify(dbl):
+    seen = []
+
+    def first(v):
+        seen.append(('first', v['v']))
+        unsubscribe('dbl', first)
+        unsubscribe('dbl', second)
+
+    def second(v):
+        seen.append(('second', v['v']))
+
+    subscribe('dbl', on_change=first)
+    subscribe('dbl', on_change=second)
+    dispatch('state', ['x'], 2)
+    dispatch('state', ['x'], 3)
+    assert seen == [('first', 4)]
+
+
+def test_watcher_errors_are_reported(dbl, app_state):
+    from reflow.registry import register_handler
+    errors, seen = [], []
+    register_handler('error', 'event_handler',
+                     lambda e, ev, d: errors.append((ev, d)))
+    subscribe('dbl', on_change=lambda v: 1 / 0)
+    subscribe('dbl', on_change=seen.append)
+    dispatch('state', ['x'], 2)
+    assert errors == [('dbl', 'watcher')]
+    assert seen == [pyr.m(v=4)]